@@ -30,14 +30,26 @@ def main():
             config_manager.setDefault(DefaultOptions(
                 sorter=args['sorter'],
                 max_images=args['max_images'],
+                image_size=args['image_size'],
+                image_budget=args['image_budget'],
                 nsfw_mode=args['nsfw_mode'],
                 api_key=args['api_key'],
                 with_prompt=args['with_prompt'],
                 without_model=args['without_model'],
                 limit_rate=args['limit_rate'],
+                global_limit_rate=args['global_limit_rate'],
+                limit_burst=args['limit_burst'],
                 retry_count=args['retry_count'],
                 pause_time=args['pause_time'],
+                max_concurrent_models=args['max_concurrent_models'],
+                prefetch_count=args['prefetch_count'],
+                segments=args['segments'],
                 cache_mode=args['cache_mode'],
+                cache_link_mode=args['cache_link_mode'],
+                store_mode=args['store_mode'],
+                store_dir=args['store_dir'],
+                metadata_cache=args['metadata_cache'],
+                metadata_cache_ttl=args['metadata_cache_ttl'],
                 strict_mode=args['strict_mode'],
                 model_overwrite=args['model_overwrite'],
                 with_color=args['with_color']
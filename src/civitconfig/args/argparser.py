@@ -4,8 +4,7 @@ from typing import Dict, List, Union
 
 import argparse
 
-from helpers.core.utils import get_version
-from helpers.argparse import PwdAction, ConfirmAction, ColoredArgParser, BooleanOptionalAction
+from helpers.argparse import PwdAction, ConfirmAction, ColoredArgParser, BooleanOptionalAction, VersionAction
 
 __all__ = ['get_args']
 
@@ -17,7 +16,7 @@ def add_shared_option(par):
     par.add_argument(
         '--verbose', action=BooleanOptionalAction, help='Prints out traceback and other useful information.')
     par.add_argument(
-        '-v', '--version', action='version', version=f'civitdl v{get_version()}', help='Prints out the version of the program.'
+        '-v', '--version', action=VersionAction, help='Prints out the version of the program.'
     )
 
 
@@ -39,6 +38,12 @@ default_parser = subparsers.add_parser(
 default_parser.add_argument('-i', '--max-images', metavar='INT', type=int,
                             help='Set the default max number of images to download per model.')
 
+default_parser.add_argument('--image-size', type=str,
+                            help='Set the default max width of images in pixels. Set it to original to download images as listed by CivitAI.')
+
+default_parser.add_argument('--image-budget', type=str,
+                            help='Set the default max bytes of images to download per model. Set it to 0 to disable budget.')
+
 default_parser.add_argument('--nsfw-mode', type=str,
                             help='Set the default nsfw mode when downloading images. Setting to 0 means the program will only download sfw. Setting to 1 means the program will download sfw, and nsfw images depending on the nsfw rating of the model. Setting to 2 means the program will download both sfw and nsfw.')
 
@@ -58,6 +63,14 @@ default_parser.add_argument('--limit-rate', type=str,
                             help='Set the default limit for the download speed/rate of resources downloaded from CivitAI. Set it to 0 to disable limit.'
                             )
 
+default_parser.add_argument('--global-limit-rate', type=str,
+                            help='Set the default limit for the combined download speed/rate of every download running at the same time. Set it to 0 to disable limit.'
+                            )
+
+default_parser.add_argument('--limit-burst', type=str,
+                            help='Set the default number of bytes that may be downloaded at full speed before the limit rates apply. Set it to 0 for one second worth of bytes.'
+                            )
+
 default_parser.add_argument('--retry-count', type=int,
                             help='Set the default max number of times to retry downloading a model if it fails.'
                             )
@@ -65,8 +78,27 @@ default_parser.add_argument('--retry-count', type=int,
 default_parser.add_argument('--pause-time', type=float,
                             help='Set the default number of seconds to pause between each model\'s download'
                             )
+default_parser.add_argument('--max-concurrent-models', type=int,
+                            help='Set the default max number of models to download at the same time.'
+                            )
+default_parser.add_argument('--prefetch-count', type=int,
+                            help='Set the default number of upcoming models to fetch metadata for in the background.'
+                            )
+default_parser.add_argument('--segments', type=int,
+                            help='Set the default number of byte ranges to download a large model file in at the same time.'
+                            )
 default_parser.add_argument('--cache-mode', type=str,
                             help='Set the default cache mode. Valid modes are 0 and 1. 0 to not use cache. 1 to use cache and copy existant models based on file path. Please refer to documentation for more detail.')
+default_parser.add_argument('--cache-link-mode', type=str,
+                            help='Set the default way a model found in cache is placed at the new path. Valid modes are reflink, hardlink, symlink and copy.')
+default_parser.add_argument('--store-mode', type=str,
+                            help='Set the default store mode. Valid modes are 0 and 1. 0 to not use the store. 1 to keep a single copy of every model file in a content-addressed store, linked from every root directory it is downloaded to.')
+default_parser.add_argument('--store-dir', type=str,
+                            help='Set the default directory of the store. Set it to "" for the store directory in the user cache directory.')
+default_parser.add_argument('--metadata-cache', type=str,
+                            help='Set the default metadata cache mode. Valid modes are off, use and refresh.')
+default_parser.add_argument('--metadata-cache-ttl', type=float,
+                            help='Set the default number of seconds a cached API response is used without asking CivitAI if it changed.')
 default_parser.add_argument('--strict-mode', type=str,
                             help='Sets the default strict mode. Valid modes are 0 and 1. 0 to disable integrity check. 1 to enable maximum integrity check. In scenarios where the user have previously downloaded the model and the program recognizes the repeated download, strict-mode of 1 adds a further integrity check with SHA256 hash against the local model file.')
 default_parser.add_argument('--model-overwrite', action=BooleanOptionalAction,
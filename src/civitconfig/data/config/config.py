@@ -6,24 +6,36 @@ import shutil
 from typing import Dict, List, Union
 
 from helpers.sorter import basic, tags
-from helpers.core.utils import Styler, UnexpectedException, getDate, sprint
+from helpers.core.utils import Styler, UnexpectedException, getDate, print_verbose, sprint
 from helpers.core._validation import Validation
 
 DEFAULT_CONFIG = {
-    "version": "1",
+    "version": "2",
     "default": {
         "sorter": "basic",
         "max_images": 3,
+        "image_size": 'original',
+        "image_budget": '0',
         "nsfw_mode": "2",
         "api_key": "",
 
         "with_prompt": True,
         "without_model": False,
         "limit_rate": '0',
+        "global_limit_rate": '0',
+        "limit_burst": '0',
         "retry_count": 3,
-        "pause_time": 3.0,
+        "pause_time": 0.0,
+        "max_concurrent_models": 1,
+        "prefetch_count": 2,
+        "segments": 1,
 
         "cache_mode": '1',
+        "cache_link_mode": 'reflink',
+        "store_mode": '0',
+        "store_dir": '',
+        "metadata_cache": 'use',
+        "metadata_cache_ttl": 86400.0,
         "strict_mode": '1',
         "model_overwrite": False,
 
@@ -34,7 +46,14 @@ DEFAULT_CONFIG = {
 }
 
 
-CURRENT_VERSION = "1"
+CURRENT_VERSION = "2"
+
+# Defaults of version 1, replaced by the current default when a version 1 config is loaded. Every default is saved to the config,
+# so the old value is there even if the user never set it.
+_LEGACY_DEFAULTS = {
+    # A fixed pause after every model, requests are now paced by helpers.scheduler instead.
+    "pause_time": (3.0, DEFAULT_CONFIG['default']['pause_time'])
+}
 
 _config = None  # Do not do async operations with this
 
@@ -61,18 +80,45 @@ class Config:
     def _configExists(self):
         return os.path.exists(self._config_path)
 
+    def _createDirs(self):
+        """Creates the config directories. Called before writing to them rather than when the config is constructed, so that commands that do not touch the config do no disk I/O."""
+        for dirpath in [self._config_dir_path, self._config_trash_dir_path, self._sorters_dir_path, self._sorters_trash_dir_path]:
+            os.makedirs(dirpath, exist_ok=True)
+
     def _getConfig(self):
         global _config
         if not _config:
+            if not self._configExists():
+                self._saveConfig(DEFAULT_CONFIG)
+                return _config
             with open(self._config_path, encoding='UTF-8') as file:
                 _config = json.load(file)
             if _config == None:
                 raise UnexpectedException('JSON config file was not read...')
+            if self._migrateConfig(_config):
+                try:
+                    self._saveConfig(_config)
+                except OSError as e:
+                    print_verbose(f'Unable to save migrated config: {e}')
 
         return _config
 
+    @staticmethod
+    def _migrateConfig(config: Dict) -> bool:
+        """Updates a config saved by an older version to CURRENT_VERSION, replacing the defaults of that version with the current ones.
+        Returns whether config was changed."""
+        if config.get('version') == CURRENT_VERSION:
+            return False
+        defaults = config.get('default', {})
+        for key, (legacy_value, value) in _LEGACY_DEFAULTS.items():
+            if key in defaults and defaults[key] == legacy_value:
+                defaults[key] = value
+        config['version'] = CURRENT_VERSION
+        return True
+
     def _saveConfig(self, dic: Dict):
         global _config
+        self._createDirs()
         with open(self._config_path, 'w', encoding='UTF-8') as file:
             json.dump(dic, file, indent=2)
             _config = dic
@@ -12,6 +12,7 @@ class SorterConfig(Config):
         super(SorterConfig, self).__init__(*args)
 
     def _copyPyFile(self, filepath) -> str:
+        self._createDirs()
         dst_filename = f'{getDate()}.py'
         dstpath = os.path.join(
             self._sorters_dir_path, dst_filename)
@@ -35,6 +36,7 @@ class SorterConfig(Config):
         trashpath = os.path.join(
             self._sorters_trash_dir_path, filename)
         if os.path.exists(filepath):
+            self._createDirs()
             shutil.move(filepath, trashpath)
             return trashpath
         else:
@@ -46,6 +48,7 @@ class SorterConfig(Config):
         filepath = os.path.join(
             self._sorters_dir_path, filename)
         if os.path.exists(trashpath):
+            self._createDirs()
             shutil.move(trashpath, filepath)
             return filepath
         else:
@@ -3,7 +3,6 @@ import shutil
 
 from helpers.core.utils import Styler, UnexpectedException, getDate, print_verbose, sprint
 from helpers.options import DefaultOptions
-from helpers.core.iohelper import IOHelper
 from helpers.core.constants import app_dirs
 
 from .config.config import Config, DEFAULT_CONFIG
@@ -36,15 +35,10 @@ class ConfigManager(Config):
         self._aliasConfig = AliasConfig(*args)
         self._defaultConfig = DefaultConfig(*args)
         self._sorterConfig = SorterConfig(*args)
-
-        # Make sure all directories exist
-        IOHelper.createDirsIfNotExist(args[1:])
-
-        # make sure config file exist
-        if not self._configExists():
-            self._setFallback()
+        # The directories and the config file are created on first use, see Config._getConfig().
 
     def _trashConfig(self):
+        self._createDirs()
         dst_filename = f'{getDate()}.json'
         trashpath = os.path.join(
             self._config_trash_dir_path, dst_filename)
@@ -100,6 +94,8 @@ class ConfigManager(Config):
 
         sprint(Styler.stylize(
             f'Downloading zipped config to {dst_path}.zip', color='main'))
+        # Creates the config if it does not exist yet, so that there is something to zip.
+        self._getConfig()
         shutil.make_archive(dst_path, 'zip',
                             self._config_dir_path)
 
@@ -1,20 +1,61 @@
+import os
 import traceback
 
-from .batch.batch_download import batch_download, BatchOptions
 from .args.argparser import get_args
 
-from helpers.core.utils import print_verbose, run_verbose, print_exc, set_verbose, sprint
+from helpers.core.utils import Styler, InputException, print_verbose, print_trace_summary, run_verbose, print_exc, set_trace_file, set_verbose, sprint
+
+# Arguments that are not stored in the journal, as they are given again when resuming.
+_UNJOURNALED_ARGS = ['api_key', 'with_color', 'verbose', 'journal',
+                     'resume', 'trace_file', 'metrics_file', 'metrics_port']
+
+
+def get_journal(args):
+    """Opens the journal to resume, or creates a new one for the batch. Returns the journal and the arguments of the batch."""
+    from .batch._journal import Journal, get_default_journal_path, is_default_journal_path
+
+    if args['resume'] is not None:
+        journal = Journal.open(args['resume'])
+        states = journal.count_states()
+        sprint(Styler.stylize(
+            f'Resuming batch from journal "{journal.filepath}" ({states.get("done", 0)} of {sum(states.values())} models already done)...', color='info'))
+        # Journals saved in the default directory are deleted once done, even when resumed.
+        return (journal, {**journal.get_args(), **{key: args[key] for key in _UNJOURNALED_ARGS if key in args},
+                          'journal': None if is_default_journal_path(journal.filepath) else journal.filepath})
+
+    # Batchfiles and the root directory must still be found when resuming from another directory.
+    journal_args = {key: value for key, value in args.items()
+                    if key not in _UNJOURNALED_ARGS}
+    journal_args['source_strings'] = [os.path.abspath(string) if os.path.exists(string) else string
+                                      for string in args['source_strings']]
+    journal_args['rootdir'] = os.path.abspath(args['rootdir'])
+
+    journal = Journal.create(
+        args['journal'] or get_default_journal_path(), journal_args)
+    print_verbose(f'Journal: {journal.filepath}')
+    return (journal, args)
 
 
 def main():
+    journal = None
+    exporter = None
     try:
         args = get_args()
 
+        # Imported once the arguments are parsed, so that --help and --version do not wait on requests and the rest of the batch code.
+        from .batch.batch_download import batch_download, BatchOptions
+        from helpers.metrics import MetricsExporter
+
         if args['verbose']:
             set_verbose(True)
         else:
             set_verbose(False)
 
+        journal, args = get_journal(args)
+
+        if args['trace_file'] is not None:
+            set_trace_file(args['trace_file'])
+
         tempargs = args.copy()
         tempargs.pop('api_key')
         print_verbose('Arguments: ', str(tempargs))
@@ -22,16 +63,28 @@ def main():
         batchOptions = BatchOptions(
             sorter=args['sorter'],
             max_images=args['max_images'],
+            image_size=args['image_size'],
+            image_budget=args['image_budget'],
             nsfw_mode=args['nsfw_mode'],
             api_key=args['api_key'],
 
             with_prompt=args['with_prompt'],
             without_model=args['without_model'],
             limit_rate=args['limit_rate'],
+            global_limit_rate=args['global_limit_rate'],
+            limit_burst=args['limit_burst'],
             retry_count=args['retry_count'],
             pause_time=args['pause_time'],
+            max_concurrent_models=args['max_concurrent_models'],
+            prefetch_count=args['prefetch_count'],
+            segments=args['segments'],
 
             cache_mode=args['cache_mode'],
+            cache_link_mode=args['cache_link_mode'],
+            store_mode=args['store_mode'],
+            store_dir=args['store_dir'],
+            metadata_cache=args['metadata_cache'],
+            metadata_cache_ttl=args['metadata_cache_ttl'],
             strict_mode=args['strict_mode'],
             model_overwrite=args['model_overwrite'],
 
@@ -39,14 +92,42 @@ def main():
             verbose=args['verbose']
         )
 
-        batch_download(
+        if args['metrics_file'] is not None or args['metrics_port'] is not None:
+            exporter = MetricsExporter(textfile_path=args['metrics_file'], port=args['metrics_port'],
+                                       get_concurrency=lambda: batchOptions.scheduler.concurrency)
+
+        summary = batch_download(
             source_strings=args['source_strings'],
             rootdir=args['rootdir'],
-            batchOptions=batchOptions
+            batchOptions=batchOptions,
+            journal=journal,
+            resume=args['resume'] is not None
         )
+        print_trace_summary()
+
+        if summary.failed > 0:
+            sprint(Styler.stylize(
+                f'Run "civitdl --resume {journal.filepath}" to retry the models that failed.', color='info'))
+        elif args['journal'] is None:
+            journal.discard()
 
+    except KeyboardInterrupt as e:
+        if journal is not None:
+            sprint(Styler.stylize(
+                f'\nBatch interrupted. Run "civitdl --resume {journal.filepath}" to continue it.', color='info'))
+        raise e
     except Exception as e:
         sprint('---------')
         run_verbose(traceback.print_exc)
         print_exc(e)
         sprint('---------')
+        if (isinstance(e, InputException) and journal is not None and args['journal'] is None
+                and args['resume'] is None and sum(journal.count_states().values()) == 0):
+            # Bad sources are reported before any of them is tracked, so there is nothing to resume.
+            journal.discard()
+        elif journal is not None:
+            sprint(Styler.stylize(
+                f'Run "civitdl --resume {journal.filepath}" to continue the batch.', color='info'))
+    finally:
+        if exporter is not None:
+            exporter.close()
@@ -1,11 +1,9 @@
 
 import argparse
 import os
+import sys
 
-
-from civitconfig.data.configmanager import ConfigManager
-from helpers.argparse import PwdAction, ColoredArgParser, BooleanOptionalAction
-from helpers.core.utils import get_version
+from helpers.argparse import PwdAction, ColoredArgParser, BooleanOptionalAction, VersionAction
 
 
 def parse_sorter(sorters, sorter_str):
@@ -55,6 +53,14 @@ parser.add_argument('-s', '--sorter', type=str,
 parser.add_argument('-i', '--max-images', metavar='INT', type=int,
                     help='Specify max images to download for each model.')
 
+parser.add_argument(
+    '--image-size', metavar='WIDTH', type=str, help='Specify the max width of images in pixels. Larger CivitAI images are downloaded resized to this width instead of at their full size. Set it to original (default) to download images as listed by CivitAI.'
+)
+
+parser.add_argument(
+    '--image-budget', metavar='BYTE', type=str, help='Specify the max bytes of images to download for each model, estimated from their dimensions before any image is requested. Images that do not fit are skipped. Set it to 0 (default) for no budget.'
+)
+
 parser.add_argument(
     '--nsfw-mode', metavar='MODE', type=str, help='Specify the nsfw mode when downloading images. Setting to 0 means the program will only download sfw. Setting to 1 means the program will download sfw, and nsfw images depending on the nsfw rating of the model. Setting to 2 means the program will download both sfw and nsfw.'
 )
@@ -74,18 +80,58 @@ parser.add_argument(
     '--limit-rate', metavar='BYTE', type=str, help='Limit the download speed/rate of resources downloaded from CivitAI.'
 )
 
+parser.add_argument(
+    '--global-limit-rate', metavar='BYTE', type=str, help='Limit the combined download speed/rate of every model, image and metadata download running at the same time.'
+)
+
+parser.add_argument(
+    '--limit-burst', metavar='BYTE', type=str, help='Specify how many bytes may be downloaded at full speed before --limit-rate and --global-limit-rate apply. The default is one second worth of bytes at the limited rate.'
+)
+
 parser.add_argument(
     '--retry-count', metavar='INT', type=int, help='Specify max number of times to retry downloading a model if it fails.'
 )
 
 parser.add_argument(
-    '--pause-time', metavar='FLOAT', type=float, help='Specify the number of seconds to pause between each model\'s download.'
+    '--pause-time', metavar='FLOAT', type=float, help='Specify the number of seconds to pause between each model\'s download. The default is 0, as requests are already slowed down when CivitAI throttles them.'
+)
+
+parser.add_argument(
+    '--max-concurrent-models', metavar='INT', type=int, help='Specify the max number of models to download at the same time. The default is 1 (download models one by one).'
+)
+
+parser.add_argument(
+    '--prefetch-count', metavar='INT', type=int, help='Specify how many of the upcoming models to fetch metadata for in the background while the current models are downloading. The default is 2. 0 to disable prefetching.'
+)
+
+parser.add_argument(
+    '--segments', metavar='INT', type=int, help='Specify the number of byte ranges to download a large model file in at the same time (1 to 16). The default is 1 (single stream). Falls back to a single stream if the server does not support ranges.'
 )
 
 parser.add_argument(
     '--cache-mode', metavar='MODE', type=str, help='Specify the cache mode. 0 to not use cache. 1 to use cache and copy existant models based on file path. See documentation on github for more info.'
 )
 
+parser.add_argument(
+    '--cache-link-mode', metavar='MODE', type=str, help='Specify how a model found in cache is placed at the new path. reflink (default) makes a copy-on-write clone where the filesystem supports it, else copies. hardlink and symlink link to the cached file. copy always copies. Falls back to copying if links are not possible (e.g. across filesystems).'
+)
+
+parser.add_argument(
+    '--store-mode', metavar='MODE', type=str, help='Specify the store mode. 0 (default) to not use the store. 1 to keep a single copy of every model file in a content-addressed store, and place it in the root directory as a link to the store, so that a model downloaded to many root directories only takes up disk space once. See documentation on github for more info.'
+)
+
+parser.add_argument(
+    '--store-dir', metavar='DIRPATH', type=str, help='Specify the directory of the store. The default is the store directory in the user cache directory. Links work best when the store is on the same filesystem as the root directories.'
+)
+
+parser.add_argument(
+    '--metadata-cache', metavar='MODE', type=str, choices=['off', 'use', 'refresh'], help='Specify the metadata cache mode. off to not cache API responses. use (default) to reuse cached responses younger than --metadata-cache-ttl and revalidate older ones with ETag. refresh to request every response again and update the cache.'
+)
+
+parser.add_argument(
+    '--metadata-cache-ttl', metavar='SECONDS', type=float, help='Specify how many seconds a cached API response is used without asking CivitAI if it changed. The default is 86400 (1 day).'
+)
+
 parser.add_argument('--strict-mode', metavar='MODE', type=str,
                     help='Specify the strict mode. Valid modes are 0 and 1. 0 to disable integrity check. 1 to enable maximum integrity check. In scenarios where the user have previously downloaded the model and the program recognizes the repeated download, strict-mode of 1 adds a further integrity check with SHA256 hash against the local model file.')
 
@@ -102,12 +148,75 @@ parser.add_argument(
 )
 
 parser.add_argument(
-    '-v', '--version', action='version', version=f'civitdl v{get_version()}', help='Prints out the version of the program.'
+    '--journal', metavar='PATH', type=str, help='Specify where to save the journal of the batch, which records the state of every model so that the batch can be resumed with --resume. By default, the journal is saved in the user data directory and deleted once every model is downloaded.'
+)
+
+parser.add_argument(
+    '--resume', metavar='JOURNAL', type=str, help='Resume an interrupted batch from its journal. Sources, root directory and options are read from the journal, so only --api-key, --with-color, --verbose, --trace-file, --metrics-file and --metrics-port may be passed with it.\nExample: civitdl --resume ./batch.db'
+)
+
+parser.add_argument(
+    '--trace-file', metavar='PATH', type=str, help='Append the timing of every phase of the batch (metadata requests, model and image downloads, hashing, cache...) to PATH as JSON lines, and print a summary of the time spent in each phase at the end of the batch.'
+)
+
+parser.add_argument(
+    '--metrics-file', metavar='PATH', type=str, help='Write Prometheus metrics of the batch (bytes downloaded, models done, retries, cache hits, throughput...) to PATH every 10 seconds, for the textfile collector of the node exporter. PATH should end with .prom.'
+)
+
+parser.add_argument(
+    '--metrics-port', metavar='PORT', type=int, help='Serve Prometheus metrics of the batch on http://127.0.0.1:PORT/metrics while it runs.'
 )
 
+parser.add_argument(
+    '-v', '--version', action=VersionAction, help='Prints out the version of the program.'
+)
+
+
+resume_parser = ColoredArgParser(
+    prog='civitdl',
+    description='Resume an interrupted batch from its journal.',
+    formatter_class=argparse.RawTextHelpFormatter
+)
+resume_parser.add_argument('--resume', metavar='JOURNAL', type=str, required=True,
+                           help='Path to the journal of the batch to resume.')
+resume_parser.add_argument('-k', '--api-key', action=PwdAction, type=str, required=False, nargs='?',
+                           help='Prompt user for api key to download models that require users to log in.')
+resume_parser.add_argument(
+    '--with-color', action=BooleanOptionalAction, help='Enable styles like colors, background colors and bold/italized texts.')
+resume_parser.add_argument(
+    '--verbose', action=BooleanOptionalAction, help='Prints out traceback and other useful information.')
+resume_parser.add_argument(
+    '--trace-file', metavar='PATH', type=str, help='Append the timing of every phase of the batch to PATH as JSON lines.')
+resume_parser.add_argument(
+    '--metrics-file', metavar='PATH', type=str, help='Write Prometheus metrics of the batch to PATH every 10 seconds.')
+resume_parser.add_argument(
+    '--metrics-port', metavar='PORT', type=int, help='Serve Prometheus metrics of the batch on http://127.0.0.1:PORT/metrics.')
+
+
+def get_resume_args():
+    """Returns the arguments that may be passed along with --resume. The rest are read from the journal."""
+    parser_result = resume_parser.parse_args()
+    from civitconfig.data.configmanager import ConfigManager
+    config_defaults = ConfigManager().getDefault()
+
+    return {
+        "resume": parser_result.resume,
+        "api_key": parser_result.api_key or config_defaults.get('api_key', None),
+        "with_color": parser_result.with_color if parser_result.with_color is not None else config_defaults.get('with_color', None),
+        "trace_file": parser_result.trace_file,
+        "metrics_file": parser_result.metrics_file,
+        "metrics_port": parser_result.metrics_port,
+        "verbose": False if parser_result.verbose == None else parser_result.verbose
+    }
+
 
 def get_args():
+    if any(arg == '--resume' or arg.startswith('--resume=') for arg in sys.argv[1:]):
+        return get_resume_args()
+
     parser_result = parser.parse_args()
+    # Imported once the arguments are parsed, so that --help does not wait on the config.
+    from civitconfig.data.configmanager import ConfigManager
     config_manager = ConfigManager()
     config_defaults = config_manager.getDefault()
     sorters = config_manager.getSortersList()
@@ -119,20 +228,38 @@ def get_args():
 
         "sorter": parse_sorter(sorters, parser_result.sorter or config_defaults.get('sorter', None)),
         "max_images": parser_result.max_images or config_defaults.get('max_images', None),
+        "image_size": parser_result.image_size or config_defaults.get('image_size', None),
+        "image_budget": parser_result.image_budget or config_defaults.get('image_budget', None),
         "nsfw_mode": parser_result.nsfw_mode or config_defaults.get('nsfw_mode', None),
         "api_key": parser_result.api_key or config_defaults.get('api_key', None),
 
         "with_prompt": parser_result.with_prompt if parser_result.with_prompt is not None else config_defaults.get('with_prompt', None),
         "without_model": parser_result.without_model if parser_result.without_model is not None else config_defaults.get('without_model', None),
         "limit_rate": parser_result.limit_rate or config_defaults.get('limit_rate', None),
+        "global_limit_rate": parser_result.global_limit_rate or config_defaults.get('global_limit_rate', None),
+        "limit_burst": parser_result.limit_burst or config_defaults.get('limit_burst', None),
         "retry_count": parser_result.retry_count or config_defaults.get('retry_count', None),
-        "pause_time": parser_result.pause_time or config_defaults.get('pause_time', None),
+        "pause_time": parser_result.pause_time if parser_result.pause_time is not None else config_defaults.get('pause_time', None),
+        "max_concurrent_models": parser_result.max_concurrent_models or config_defaults.get('max_concurrent_models', None),
+        "prefetch_count": parser_result.prefetch_count if parser_result.prefetch_count is not None else config_defaults.get('prefetch_count', None),
+        "segments": parser_result.segments or config_defaults.get('segments', None),
 
         "cache_mode": parser_result.cache_mode or config_defaults.get('cache_mode', None),
+        "cache_link_mode": parser_result.cache_link_mode or config_defaults.get('cache_link_mode', None),
+        "store_mode": parser_result.store_mode or config_defaults.get('store_mode', None),
+        "store_dir": parser_result.store_dir or config_defaults.get('store_dir', None),
+        "metadata_cache": parser_result.metadata_cache or config_defaults.get('metadata_cache', None),
+        "metadata_cache_ttl": parser_result.metadata_cache_ttl if parser_result.metadata_cache_ttl is not None else config_defaults.get('metadata_cache_ttl', None),
         "strict_mode": parser_result.strict_mode or config_defaults.get('strict_mode', None),
         "model_overwrite": parser_result.model_overwrite if parser_result.model_overwrite is not None else config_defaults.get('model_overwrite', None),
 
         "with_color": parser_result.with_color if parser_result.with_color is not None else config_defaults.get('with_color', None),
 
+        "journal": parser_result.journal,
+        "resume": None,
+        "trace_file": parser_result.trace_file,
+        "metrics_file": parser_result.metrics_file,
+        "metrics_port": parser_result.metrics_port,
+
         "verbose": False if parser_result.verbose == None else parser_result.verbose
     }
@@ -0,0 +1,214 @@
+import os
+import re
+import json
+import time
+import threading
+import concurrent.futures
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import urlsplit
+
+from requests import Session
+
+from helpers.core.utils import Styler, ResourcesException, get_print_prefix, get_progress_bar, print_verbose, set_print_prefix, span, sprint
+from helpers.core.iohelper import IOHelper
+from helpers.core.ratelimiter import RateLimiter
+from helpers.metrics import count_bytes, get_reason, inc
+from helpers.store import Store
+
+
+# At most _MAX_WORKERS images are downloaded at the same time, each holding at most one chunk in memory.
+_MAX_WORKERS = 4
+_CHUNK_SIZE = 64 * 1024
+# Seconds to wait for the connection and for each read.
+_REQUEST_TIMEOUT = (10, 30)
+# Seconds an image may take in total before the attempt is abandoned.
+_IMAGE_TIMEOUT = 120
+_IMAGE_RETRY_COUNT = 2
+# Client errors that will not go away by retrying.
+_NON_RETRYABLE_STATUS_CODES = (400, 401, 403, 404, 410)
+# CivitAI image urls look like https://image.civitai.com/<account>/<uuid>/<transformations, e.g. width=450>/<name>.jpeg
+_IMAGE_UUID_REGEX = re.compile(
+    r'/([0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12})(/.*)?$')
+# Keys of the images in an image directory by filename (see get_image_key()), so that an image is only reused if it was downloaded
+# from the same image at the same size. Filenames are chosen by the sorter, so they do not change with --image-size.
+_INDEX_FILENAME = '.images.json'
+
+
+def get_image_key(url: str) -> str:
+    """Returns the key of the image at url in the store. CivitAI images are keyed by their uuid and transformations,
+    so that the same image is found whichever host or account it is served from. Other urls are their own key."""
+    match = _IMAGE_UUID_REGEX.search(urlsplit(url).path)
+    if match is None:
+        return url
+    return f'{match.group(1).lower()}{match.group(2) or ""}'
+
+
+def get_resized_image_url(url: str, max_width: int) -> str:
+    """Returns the url of the CivitAI image at url resized to max_width pixels wide, by setting width=max_width in its transformations.
+    CivitAI resizes and re-encodes the image on its side. Other urls are returned as is."""
+    parts = urlsplit(url)
+    match = _IMAGE_UUID_REGEX.search(parts.path)
+    if match is None or match.group(2) is None:
+        return url
+    segments = match.group(2)[1:].split('/')
+    if len(segments) > 2 or (len(segments) == 2 and '=' not in segments[0]):
+        return url
+    # e.g. 'anim=false,width=1024'. original=true would serve the uploaded image whatever its width.
+    transformations = [transformation for transformation in segments[0].split(',')
+                       if transformation.split('=')[0] not in ('width', 'original')] if len(segments) == 2 else []
+    transformations.append(f'width={max_width}')
+    path = f'{parts.path[:match.start(2)]}/{",".join(transformations)}/{segments[-1]}'
+    return parts._replace(path=path).geturl()
+
+
+class ImageDownloader:
+    """Streams images straight to disk as each response arrives. A failed image is retried, then reported and skipped,
+    so one slow or broken image does not hold up or fail the rest.
+    Images that already exist at their path are not requested again, if they were downloaded from the same image at the same size.
+    If store is provided, downloaded images are added to it,
+    and images that were downloaded before, by any model or to any directory, are linked from it instead of being requested."""
+    __session: Session
+    __limiter: RateLimiter
+    __store: Optional[Store]
+
+    reused: int
+    """Number of images of the last download() that already existed or were placed from the store, without being requested."""
+
+    def __init__(self, session: Session, limiter: RateLimiter, store: Optional[Store] = None):
+        self.__session = session
+        self.__limiter = limiter
+        self.__store = store
+        self.reused = 0
+
+    def __iter_with_deadline(self, chunks: Iterable, deadline: float):
+        for chunk in chunks:
+            if time.monotonic() > deadline:
+                raise ResourcesException(
+                    f'Image took longer than {_IMAGE_TIMEOUT} seconds to download.')
+            yield chunk
+
+    def __download_image(self, url: str, filepath: str) -> Optional[str]:
+        """Returns the SHA256 hash of the image if it is added to the store."""
+        iter = 0
+        while True:
+            status_code = None
+            try:
+                with self.__session.get(url, stream=True, timeout=_REQUEST_TIMEOUT) as res:
+                    status_code = res.status_code
+                    if res.status_code != 200:
+                        raise ResourcesException(
+                            f'Image request returned status code {res.status_code}.')
+                    return IOHelper.write_to_file(filepath, self.__iter_with_deadline(
+                        count_bytes(res.iter_content(_CHUNK_SIZE), 'image'), time.monotonic() + _IMAGE_TIMEOUT), mode='wb', limiter=self.__limiter,
+                        with_hash=self.__store is not None)
+            except Exception as e:
+                if iter >= _IMAGE_RETRY_COUNT or status_code in _NON_RETRYABLE_STATUS_CODES:
+                    raise e
+                iter += 1
+                inc('civitdl_retries_total', scope='image',
+                    reason=status_code if status_code not in (None, 200) else get_reason(e))
+                print_verbose(
+                    f'Retrying image ({iter}/{_IMAGE_RETRY_COUNT}) "{url}": {e}')
+                time.sleep(iter)
+
+    def __place_from_store(self, key: str, filepath: str) -> bool:
+        sha256_hash = self.__store.get_url_hash(key)
+        if sha256_hash is None:
+            inc('civitdl_cache_requests_total', cache='image', result='miss')
+            return False
+        self.__store.place(sha256_hash, filepath)
+        inc('civitdl_cache_requests_total', cache='image', result='hit')
+        inc('civitdl_cache_saved_bytes_total',
+            os.path.getsize(filepath), cache='image')
+        return True
+
+    def __add_to_store(self, key: str, filepath: str, sha256_hash: str):
+        self.__store.add(filepath, sha256_hash)
+        self.__store.place(sha256_hash, filepath)
+        self.__store.set_url_hash(key, sha256_hash)
+
+    @staticmethod
+    def __read_index(dirpath: str) -> Dict[str, str]:
+        try:
+            with open(os.path.join(dirpath, _INDEX_FILENAME), encoding='UTF-8') as file:
+                index = json.load(file)
+            return index if isinstance(index, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def __get_image(self, url: str, filepath: str, indexed_key: Optional[str]) -> bool:
+        """Downloads url to filepath unless it can be reused. Returns whether the image was reused without being requested."""
+        key = get_image_key(url)
+        if os.path.isfile(filepath):
+            if indexed_key == key:
+                print_verbose(f'Image already exists: {filepath}')
+                return True
+            print_verbose(
+                f'Image already exists, but was downloaded from another image or at another size: {filepath}')
+
+        if self.__store is not None:
+            try:
+                if self.__place_from_store(key, filepath):
+                    print_verbose(f'Placed image from the store: {filepath}')
+                    return True
+            except OSError as e:
+                print_verbose(f'Unable to place image from the store: {e}')
+
+        sha256_hash = self.__download_image(url, filepath)
+        if self.__store is not None and sha256_hash is not None:
+            try:
+                self.__add_to_store(key, filepath, sha256_hash)
+            except OSError as e:
+                print_verbose(f'Unable to add image to the store: {e}')
+        return False
+
+    def download(self, dirpath: str, urls: List[str], filenames: List[str]) -> List[str]:
+        """Downloads every url to the matching filename in dirpath. Returns the urls of the images that failed."""
+        self.reused = 0
+        if len(urls) == 0:
+            return []
+
+        os.makedirs(dirpath, exist_ok=True)
+        prefix = get_print_prefix()
+        progress_bar = get_progress_bar(len(urls), 'Images')
+        index = self.__read_index(dirpath)
+        new_index = dict(index)
+        index_lock = threading.Lock()
+
+        def download_in_worker(url: str, filename: str) -> bool:
+            set_print_prefix(prefix)
+            try:
+                with span('image', url=url) as s:
+                    reused = self.__get_image(
+                        url, os.path.join(dirpath, filename), index.get(filename))
+                    s.set(reused=reused)
+                with index_lock:
+                    new_index[filename] = get_image_key(url)
+                return reused
+            finally:
+                set_print_prefix(None)
+
+        failed_urls = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(_MAX_WORKERS, len(urls))) as executor:
+            futures = {executor.submit(download_in_worker, url, filename): url
+                       for url, filename in zip(urls, filenames)}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    if future.result():
+                        self.reused += 1
+                except Exception as e:
+                    failed_urls.append(futures[future])
+                    sprint(Styler.stylize(
+                        f'Skipping image that could not be downloaded: {futures[future]}', color='warning'))
+                    print_verbose(e)
+                progress_bar.update(1)
+        progress_bar.close()
+
+        if new_index != index:
+            try:
+                IOHelper.write_to_file(os.path.join(dirpath, _INDEX_FILENAME), [
+                                       json.dumps(new_index, indent=2)], encoding='UTF-8')
+            except Exception as e:
+                print_verbose(f'Unable to save the image index: {e}')
+
+        return failed_urls
@@ -0,0 +1,152 @@
+from json import dumps, loads
+import os
+import re
+import time
+from typing import Dict, Iterable, Iterator, Literal, Optional
+
+from helpers.core.utils import InputException, getDate, print_verbose
+from helpers.core.constants import app_dirs
+from helpers.core.database import Database
+from helpers.core.iohelper import IOHelper
+from helpers.sourcemanager import Id, SourceManager
+
+
+JournalState = Literal['pending', 'metadata', 'images', 'model', 'done', 'failed']
+
+_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)',
+    """CREATE TABLE IF NOT EXISTS entries (
+        position INTEGER PRIMARY KEY,
+        source TEXT NOT NULL,
+        state TEXT NOT NULL DEFAULT 'pending',
+        error TEXT,
+        updated_at REAL NOT NULL
+    )"""
+]
+
+# Number of sources inserted in a single transaction while they are being tracked.
+_INSERT_BATCH_SIZE = 500
+
+
+_default_journal_dirpath = os.path.join(app_dirs.user_data_dir, 'journals')
+
+
+def get_default_journal_path():
+    return os.path.join(_default_journal_dirpath, f'{getDate()}.db')
+
+
+def is_default_journal_path(filepath: str):
+    return os.path.dirname(os.path.abspath(filepath)) == os.path.abspath(_default_journal_dirpath)
+
+
+class JournalEntry:
+    """A single source of the batch and its position in the journal."""
+    position: int
+    id: Id
+
+    def __init__(self, journal: 'Journal', position: int, id: Id):
+        self.__journal = journal
+        self.position = position
+        self.id = id
+
+    def set_state(self, state: JournalState, error: Optional[str] = None):
+        self.__journal.set_state(self.position, state, error)
+
+
+class Journal:
+    """Records the state of every source of a batch in a SQLite file, so that a batch that crashed or was interrupted can be resumed.
+    The arguments of the batch (except the api key) are stored with it.
+
+    States: pending -> metadata (metadata resolved) -> images (metadata and images written) -> model (model written) -> done, or failed with its error.
+    Every entry that is not done is downloaded again on resume. Files already written are skipped by the usual checks."""
+    __db: Database
+
+    def __init__(self, filepath: str):
+        self.__db = Database(filepath, _SCHEMA)
+
+    @property
+    def filepath(self):
+        return self.__db.filepath
+
+    @classmethod
+    def create(cls, filepath: str, args: Dict) -> 'Journal':
+        if os.path.exists(filepath):
+            raise InputException(
+                f'Journal already exists at "{filepath}".', f'Use "civitdl --resume {filepath}" to resume it.')
+        journal = cls(filepath)
+        journal.__set_meta('args', dumps(args))
+        journal.__set_meta('created_at', getDate())
+        return journal
+
+    @classmethod
+    def open(cls, filepath: str) -> 'Journal':
+        if not os.path.isfile(filepath):
+            raise InputException(f'Journal does not exist at "{filepath}".')
+        journal = cls(filepath)
+        if journal.__get_meta('args') is None:
+            raise InputException(
+                f'File at "{filepath}" is not a civitdl journal.')
+        return journal
+
+    def __get_meta(self, key: str) -> Optional[str]:
+        row = self.__db.fetchone('SELECT value FROM meta WHERE key = ?', (key,))
+        return row[0] if row is not None else None
+
+    def __set_meta(self, key: str, value: str):
+        self.__db.execute(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def discard(self):
+        """Deletes the journal, once every thread is done with it. Files still in use by other processes are left behind."""
+        self.__db.close_all()
+        for filepath in (self.filepath, f'{self.filepath}-wal', f'{self.filepath}-shm'):
+            try:
+                IOHelper.delete_file_if_exists(filepath)
+            except OSError as e:
+                print_verbose(f'Unable to delete "{filepath}": {e}')
+
+    def get_args(self) -> Dict:
+        return loads(self.__get_meta('args'))
+
+    def set_state(self, position: int, state: JournalState, error: Optional[str] = None):
+        if error is not None:
+            error = re.sub(r'\033\[[0-9;]*m', '', error).strip()
+        self.__db.execute('UPDATE entries SET state = ?, error = ?, updated_at = ? WHERE position = ?',
+                          (state, error, time.time(), position))
+
+    def count_states(self) -> Dict[str, int]:
+        return dict(self.__db.fetchall('SELECT state, COUNT(*) FROM entries GROUP BY state'))
+
+    def track(self, ids: Iterable[Id], start: int = 0) -> Iterator[JournalEntry]:
+        """Records every id as pending, in batches as they are read, and yields them. Ids before start are already in the journal and are skipped."""
+        batch = []
+
+        def flush():
+            self.__db.executemany('INSERT OR IGNORE INTO entries (position, source, updated_at) VALUES (?, ?, ?)',
+                                  [(entry.position, entry.id.original, time.time()) for entry in batch])
+            for entry in batch:
+                yield entry
+            batch.clear()
+
+        for position, id in enumerate(ids):
+            if position < start:
+                continue
+            batch.append(JournalEntry(self, position, id))
+            if len(batch) >= _INSERT_BATCH_SIZE:
+                yield from flush()
+        yield from flush()
+        self.__set_meta('sources_complete', '1')
+
+    def resume(self) -> Iterator[JournalEntry]:
+        """Yields every entry that is not done. If the sources of the batch were not all recorded before it stopped, the rest are read from the sources again."""
+        rows = self.__db.fetchall(
+            "SELECT position, source FROM entries WHERE state != 'done' ORDER BY position")
+        print_verbose(f'Resuming {len(rows)} unfinished entries from journal.')
+        for position, source in rows:
+            # Every entry is a single source that was already deduplicated when it was tracked.
+            yield JournalEntry(self, position, next(SourceManager().parse_src([source])))
+
+        if self.__get_meta('sources_complete') is None:
+            tracked = self.__db.fetchone('SELECT COUNT(*) FROM entries')[0]
+            args = self.get_args()
+            yield from self.track(SourceManager().parse_src_all(args['source_strings']), start=tracked)
@@ -1,26 +1,215 @@
-from typing import Dict, List, Tuple, Optional
-from helpers.core.utils import Styler, InputException, ResourcesException, UnexpectedException, APIException, sprint, print_verbose
+from json import dumps, loads
+import threading
+import time
+from typing import Dict, Iterable, List, Literal, Tuple, Optional
+from helpers.core.utils import Styler, InputException, ResourcesException, UnexpectedException, APIException, format_bytes, span, sprint, print_verbose
+from helpers.core.ratelimiter import RateLimiter
 
 from helpers.sourcemanager import Id
 from helpers.options import BatchOptions
+from helpers.cache import MetadataCache
+from helpers.session import API_URL_PREFIX
+from helpers.metrics import count_bytes, inc
 
-from requests import Session
+from requests import Response, Session
 
+from ._images import get_resized_image_url
 
-# Convert id to appopriate format
 
-# get metadata
+# Max number of model ids requested at once from the models endpoint, which is also its max page size.
+_BULK_IDS_SIZE = 100
+_CHUNK_SIZE = 64 * 1024
+# Images are selected for the image budget by their estimated size, as their actual size is only known once requested.
+# Roughly the size of a JPEG of a generated image. Images without dimensions are estimated at 1024x1024 pixels.
+_ESTIMATED_BYTES_PER_PIXEL = 0.3
+_DEFAULT_IMAGE_BYTES = round(1024 * 1024 * _ESTIMATED_BYTES_PER_PIXEL)
+
+
+def _get_model_metadata_url(model_id: str):
+    return f'{API_URL_PREFIX}api/v1/models/{model_id}'
+
+
+def _get_cached_metadata(url: str, cache_mode: Literal['off', 'use', 'refresh']) -> Optional[Dict]:
+    if cache_mode != 'use':
+        return None
+    try:
+        return MetadataCache.get(url)
+    except Exception as e:
+        sprint(Styler.stylize(
+            f'Unable to access metadata cache: {e}', color='warning'))
+        return None
+
+
+def _set_cached_metadata(url: str, etag: Optional[str], body: str, cache_mode: Literal['off', 'use', 'refresh']):
+    if cache_mode == 'off':
+        return
+    try:
+        MetadataCache.set(url, etag, body)
+    except Exception as e:
+        sprint(Styler.stylize(
+            f'Unable to save metadata to cache: {e}', color='warning'))
+
+
+def _read_body(res: Response) -> bytes:
+    """Reads the body of a metadata response requested with stream=True. Every chunk is paid for with the global rate limit as it arrives,
+    so that metadata does not burst past it. Metadata only counts towards the global rate limit."""
+    limiter = RateLimiter()
+    chunks = []
+    for chunk in count_bytes(res.iter_content(_CHUNK_SIZE), 'metadata'):
+        limiter.consume(len(chunk))
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def _touch_cached_metadata(url: str):
+    try:
+        MetadataCache.touch(url)
+    except Exception as e:
+        sprint(Styler.stylize(
+            f'Unable to update metadata cache: {e}', color='warning'))
+
+
+class MetadataLookup:
+    """Resolves the metadata of many models with a single request per _BULK_IDS_SIZE models to the models endpoint (/api/v1/models?ids=...),
+    instead of one or two requests per model. Models that are not returned by the endpoint are requested one by one as usual.
+
+    Resolved models are also saved to the metadata cache under their own url, unless the cache is off.
+    A resolved model is kept in memory until every source of the model passed to resolve() has been released with release()."""
+    __session: Session
+    __cache_mode: Literal['off', 'use', 'refresh']
+    __cache_ttl: float
+    __model_dicts: Dict[str, Dict]
+    __uses: Dict[str, int]
+    """Number of sources of every model that have not been released yet."""
+
+    def __init__(self, session: Session, cache_mode: Literal['off', 'use', 'refresh'] = 'off', cache_ttl: float = 0):
+        self.__session = session
+        self.__cache_mode = cache_mode
+        self.__cache_ttl = cache_ttl
+        self.__model_dicts = {}
+        self.__uses = {}
+        self.__lock = threading.Lock()
+
+    def __contains__(self, model_id: str):
+        with self.__lock:
+            return model_id in self.__model_dicts
+
+    def get(self, model_id: str) -> Optional[Dict]:
+        with self.__lock:
+            return self.__model_dicts.get(model_id)
+
+    def release(self, model_id: str):
+        """Called once for every source of the model passed to resolve(), once it is prepared or skipped.
+        The model is removed from the lookup when all of its sources are released, so that it is only kept in memory until it is used."""
+        with self.__lock:
+            uses = self.__uses.get(model_id, 0) - 1
+            if uses > 0:
+                self.__uses[model_id] = uses
+            else:
+                self.__uses.pop(model_id, None)
+                self.__model_dicts.pop(model_id, None)
+
+    def get_latest_version_id(self, model_id: str) -> Optional[str]:
+        """Returns the id of the version that is downloaded for the model when no version is specified, if the model is in the lookup."""
+        with self.__lock:
+            model_dict = self.__model_dicts.get(model_id)
+        try:
+            if model_dict is None:
+                # Models fresh in the metadata cache are not resolved again. A stale entry may name an older version than the one downloaded.
+                cached = self.__get_fresh_cached(model_id)
+                model_dict = loads(cached['body'])
+            return str(model_dict['modelVersions'][0]['id'])
+        except (TypeError, KeyError, IndexError, ValueError):
+            return None
+
+    def __get_fresh_cached(self, model_id: str) -> Optional[Dict]:
+        cached = _get_cached_metadata(
+            _get_model_metadata_url(model_id), self.__cache_mode)
+        return cached if cached is not None and time.time() - cached['fetched_at'] < self.__cache_ttl else None
+
+    def __is_cached(self, model_id: str):
+        return self.__get_fresh_cached(model_id) is not None
+
+    def __request_models(self, model_ids: List[str]) -> List[Dict]:
+        model_dicts = []
+        url = f'{API_URL_PREFIX}api/v1/models'
+        params = {'ids': model_ids, 'limit': _BULK_IDS_SIZE, 'nsfw': 'true'}
+        while url is not None:
+            print_verbose(f'Metadata API Request URL: {url}')
+            with span('api.metadata.bulk', count=len(model_ids)) as s:
+                res = self.__session.get(url, params=params, stream=True)
+                body = _read_body(res)
+                s.set(status=res.status_code, bytes=len(body))
+            if res.status_code != 200:
+                raise APIException(
+                    res.status_code, f'Requesting metadata of {len(model_ids)} models from CivitAI failed.')
+
+            data = loads(body)
+            model_dicts.extend(data.get('items', []))
+            # nextPage already contains every parameter of the query.
+            url = data.get('metadata', {}).get('nextPage')
+            params = None
+        return model_dicts
+
+    def resolve(self, model_ids: Iterable[str]):
+        """Requests the metadata of every model that is not in the lookup or fresh in the metadata cache. Failures are only reported,
+        as the models are then requested one by one. Every model id is counted as a source to release() later, including repeated ones."""
+        model_ids = list(model_ids)
+        with self.__lock:
+            for model_id in model_ids:
+                self.__uses[model_id] = self.__uses.get(model_id, 0) + 1
+            model_ids = list(dict.fromkeys(
+                model_id for model_id in model_ids if model_id not in self.__model_dicts))
+        model_ids = [
+            model_id for model_id in model_ids if not self.__is_cached(model_id)]
+
+        for start in range(0, len(model_ids), _BULK_IDS_SIZE):
+            chunk = model_ids[start:start + _BULK_IDS_SIZE]
+            try:
+                model_dicts = self.__request_models(chunk)
+            except Exception as e:
+                print_verbose(
+                    f'Unable to resolve metadata of {len(chunk)} models at once, requesting them one by one: {e}')
+                continue
+
+            resolved = {str(model_dict['id']): model_dict for model_dict in model_dicts
+                        if isinstance(model_dict, dict) and 'id' in model_dict}
+            print_verbose(
+                f'Resolved metadata of {len(resolved)} of {len(chunk)} models at once.')
+            for model_id, model_dict in resolved.items():
+                _set_cached_metadata(_get_model_metadata_url(
+                    model_id), None, dumps(model_dict), self.__cache_mode)
+            with self.__lock:
+                self.__model_dicts.update(resolved)
+
 
 class _MetadataFetcher:
     __original_id: str
     __session: Session
+    __cache_mode: Literal['off', 'use', 'refresh']
+    __cache_ttl: float
+    __lookup: Optional[MetadataLookup]
 
-    def __init__(self, original_id: str, session: Session):
+    def __init__(self, original_id: str, session: Session, cache_mode: Literal['off', 'use', 'refresh'] = 'off', cache_ttl: float = 0, lookup: Optional[MetadataLookup] = None):
         self.__original_id = original_id
         self.__session = session
+        self.__cache_mode = cache_mode
+        self.__cache_ttl = cache_ttl
+        self.__lookup = lookup
 
     def fetch(self, id: Id) -> Tuple[Tuple[dict, dict], Tuple[str, str]]:
-        if id.version_id is not None:
+        metadata = None
+        if id.version_id is not None and id.model_id is not None and self.__lookup is not None and id.model_id in self.__lookup:
+            # The model resolved in bulk already includes the metadata of its versions, so the version does not need to be requested.
+            try:
+                metadata = self.__get_model_version_metadata(
+                    id.model_id, version_id=id.version_id)
+            except ResourcesException as e:
+                print_verbose(e)
+
+        if metadata is not None:
+            pass
+        elif id.version_id is not None:
             try:
                 metadata = self.__get_version_model_metadata(id.version_id)
             except ResourcesException:
@@ -55,7 +244,7 @@ class _MetadataFetcher:
                 return (model_dict, model_dict[key][0])
 
             for version_dict in model_dict[key]:
-                if version_dict['id'] == version_id:
+                if str(version_dict['id']) == version_id:
                     return (model_dict, version_dict)
 
             raise ResourcesException(
@@ -72,32 +261,71 @@ class _MetadataFetcher:
 
     def __get_model_metadata(self, model_id: str):
         """Returns json object if request succeeds, else print error and returns None"""
-        metadata_url = f'https://civitai.com/api/v1/models/{model_id}'
+        if self.__lookup is not None:
+            metadata = self.__lookup.get(model_id)
+            if metadata is not None:
+                print_verbose(
+                    f'Using metadata resolved in bulk for model id, {model_id}')
+                return metadata
+        metadata_url = _get_model_metadata_url(model_id)
         metadata = self.__get_metadata(metadata_url)
         return metadata
 
     def __get_version_metadata(self, version_id: str):
-        metadata_url = f'https://civitai.com/api/v1/model-versions/{version_id}'  # nopep8
+        metadata_url = f'{API_URL_PREFIX}api/v1/model-versions/{version_id}'  # nopep8
         metadata = self.__get_metadata(metadata_url)
         return metadata
 
+    @staticmethod
+    def __count_cache_hit(cached: Dict):
+        inc('civitdl_cache_requests_total', cache='metadata', result='hit')
+        inc('civitdl_cache_saved_bytes_total',
+            len(cached['body'].encode('UTF-8')), cache='metadata')
+
     def __get_metadata(self, url: str):
+        cached = _get_cached_metadata(url, self.__cache_mode)
+        if cached is not None and time.time() - cached['fetched_at'] < self.__cache_ttl:
+            print_verbose(f'Using cached metadata for "{url}"')
+            self.__count_cache_hit(cached)
+            return loads(cached['body'])
+
+        headers = {}
+        if cached is not None and cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+
         print_verbose('Requesting model metadata.')
         print_verbose(f'Metadata API Request URL: {url}')
-        meta_res = self.__session.get(url, stream=True)
+        with span('api.metadata', url=url) as s:
+            meta_res = self.__session.get(url, stream=True, headers=headers)
+            body = _read_body(meta_res)
+            s.set(status=meta_res.status_code, bytes=len(body))
 
         print_verbose('Finished requesting model metadata.')
+        if meta_res.status_code == 304 and cached is not None:
+            print_verbose(f'Cached metadata for "{url}" is still valid.')
+            _touch_cached_metadata(url)
+            self.__count_cache_hit(cached)
+            return loads(cached['body'])
+
+        if self.__cache_mode != 'off':
+            inc('civitdl_cache_requests_total', cache='metadata', result='miss')
+
         if meta_res.status_code != 200:
             raise APIException(
                 meta_res.status_code, f'Downloading metadata from CivitAI for "{self.__original_id}" failed when trying to request metadata from "{url}"')
 
         try:
-            return meta_res.json()
+            metadata = loads(body)
         except Exception as e:
             raise UnexpectedException(
                 'Unable to parse metadata from CivitAI (incorrect format provided by Civitai).', 'CivitAI might be under maintainence.',
                 f'\nOriginal Error:\n       {e}')
 
+        _set_cached_metadata(url, meta_res.headers.get(
+            'ETag'), body.decode('UTF-8'), self.__cache_mode)
+
+        return metadata
+
 
 # extract data from metadata
 
@@ -105,7 +333,12 @@ class _MetadataFetcher:
 class Metadata:
     __options_nsfw_mode: str
     __options_max_images: int
+    __options_image_size: Optional[int]
+    __options_image_budget: int
     __options_session: Session
+    __options_cache_mode: Literal['off', 'use', 'refresh']
+    __options_cache_ttl: float
+    __options_lookup: Optional[MetadataLookup]
 
     model_dict: Dict
     version_dict: Dict
@@ -115,19 +348,61 @@ class Metadata:
 
     model_name: str = 'unknown'
     version_hashes: Dict = {}
+    version_file: Optional[Dict] = None
+    """Entry of version_dict['files'] that model_download_url downloads."""
 
     nsfwLevel: int = -1
     image_dicts: List[Dict] = []
     image_download_urls: List[str] = []
 
-    def __init__(self, nsfw_mode: str, max_images: int, session: Session):
+    def __init__(self, nsfw_mode: str, max_images: int, session: Session, cache_mode: Literal['off', 'use', 'refresh'] = 'off', cache_ttl: float = 0, lookup: Optional[MetadataLookup] = None, image_size: Optional[int] = None, image_budget: int = 0):
         self.__options_nsfw_mode = nsfw_mode
         self.__options_max_images = max_images
+        self.__options_image_size = image_size
+        self.__options_image_budget = image_budget
         self.__options_session = session
+        self.__options_cache_mode = cache_mode
+        self.__options_cache_ttl = cache_ttl
+        self.__options_lookup = lookup
+        self.image_dicts = []
+        self.image_download_urls = []
+
+    def __get_image_url(self, image_dict: Dict) -> str:
+        width = image_dict.get('width')
+        if self.__options_image_size is None or (isinstance(width, int) and 0 < width <= self.__options_image_size):
+            return image_dict['url']
+        return get_resized_image_url(image_dict['url'], self.__options_image_size)
+
+    def __estimate_image_bytes(self, image_dict: Dict) -> int:
+        width, height = image_dict.get('width'), image_dict.get('height')
+        if not isinstance(width, int) or not isinstance(height, int) or width <= 0 or height <= 0:
+            return _DEFAULT_IMAGE_BYTES
+        # Resized images keep their aspect ratio.
+        scale = 1 if self.__options_image_size is None else min(
+            1, self.__options_image_size / width)
+        return round(width * height * scale * scale * _ESTIMATED_BYTES_PER_PIXEL)
+
+    def __select_images(self, image_dicts: List[Dict]) -> List[Dict]:
+        """Returns the first max_images images, skipping the images that would not fit in the image budget, so that they are never requested."""
+        if self.__options_image_budget <= 0:
+            return image_dicts[0:self.__options_max_images]
+
+        selected = []
+        budget = self.__options_image_budget
+        for image_dict in image_dicts:
+            if len(selected) >= self.__options_max_images:
+                break
+            estimated_bytes = self.__estimate_image_bytes(image_dict)
+            if estimated_bytes <= budget:
+                selected.append(image_dict)
+                budget -= estimated_bytes
+        print_verbose(f'Images within the image budget: {len(selected)}, estimated {format_bytes(self.__options_image_budget - budget)}')  # nopep8
+        return selected
 
     def make_api_call(self, id: Id):
         ((model_metadata, version_metadata), (model_id, version_id)) = _MetadataFetcher(
-            original_id=id.original, session=self.__options_session).fetch(id)
+            original_id=id.original, session=self.__options_session,
+            cache_mode=self.__options_cache_mode, cache_ttl=self.__options_cache_ttl, lookup=self.__options_lookup).fetch(id)
 
         self.model_dict = model_metadata
         self.version_dict = version_metadata
@@ -191,14 +466,14 @@ class Metadata:
             if len_of_image_dicts != len(self.image_dicts):
                 sprint(Styler.stylize(
                     'Some or all images were removed due to being unable to parse metadata for the download url of the images!', color='warning'))
-            self.image_dicts = self.image_dicts[0:self.__options_max_images]
+            self.image_dicts = self.__select_images(self.image_dicts)
         else:
             sprint(Styler.stylize(
                 "Metadata of images do not exist in version metadata!", color='warning'))
 
         print_verbose(f'nsfwLevel of images to download: {[image_dict["nsfwLevel"] for image_dict in self.image_dicts]}')  # nopep8
 
-        self.image_download_urls = [image_dict['url']
+        self.image_download_urls = [self.__get_image_url(image_dict)
                                     for image_dict in self.image_dicts]
 
         if 'files' in self.version_dict:
@@ -210,6 +485,8 @@ class Metadata:
                     'files property in version metadata is not an iterable!', color='warning'))
 
             if files is not None:
+                self.version_file = next((file for file in files if isinstance(file, dict)
+                                          and file.get('downloadUrl') == self.model_download_url), None)
                 self.version_hashes = self.__get_version_hashes(
                     files, self.model_download_url)
         else:
@@ -1,48 +1,111 @@
 from json import dumps, loads
-import shutil
 import os
 import re
-from typing import Dict, List, Optional, Union
-from math import ceil
+import time
+import concurrent.futures
+from typing import Callable, Dict, List, Optional, Union
 
 import requests
 
-from helpers.core.utils import Styler, InputException, UnexpectedException, APIException, print_newlines, sprint, print_verbose, concurrent_request
+from helpers.core.utils import Styler, InputException, UnexpectedException, APIException, print_newlines, span, sprint, print_verbose
 from helpers.core.iohelper import IOHelper
+from helpers.core.ratelimiter import RateLimiter
 
 from helpers.sourcemanager import Id
 from helpers.options import BatchOptions
 from helpers.cache import Cache
+from helpers.store import Store
+from helpers.metrics import inc
 
-from ._metadata import Metadata
+from ._images import ImageDownloader
+from ._metadata import Metadata, MetadataLookup
+from ._transfer import Transfer
+from ._verifier import Verifier, quarantine
+
+
+# sizeKB in the metadata is rounded, so model files within this many bytes of it are considered complete.
+_SIZE_TOLERANCE = 1024
 
 
 class Model:
+    """Downloads a single model in two stages. prepare() makes the API calls, and download() writes the files.
+    prepare() can run ahead of time in another thread, so the download stage does not wait on the API."""
     __dst_root_path: str
     __batchOptions: BatchOptions
 
-    def __init__(self, dst_root_path: str, batchOptions: BatchOptions):
+    __metadata: Optional[Metadata]
+    __filenames: Optional[Dict]
+    __sorter_data = None
+    __model_url: Optional[str]
+    """Url the model download was redirected to, requested again by download() instead of the API."""
+    __on_stage: Optional[Callable[[str], None]]
+    """Called with 'metadata', 'images' and 'model' as each stage of the download is finished."""
+    __metadata_lookup: Optional[MetadataLookup]
+    __verifier: Optional[Verifier]
+    __verified_filepath: Optional[str]
+    __on_verified: Optional[Callable[[], None]]
+
+    skipped: bool
+    """True if the model file already existed at the destination path and was not downloaded."""
+    downloaded_bytes: int
+    download_seconds: float
+    materialized_bytes: int
+    """Size of the model file placed from the cache instead of being downloaded."""
+    materialize_seconds: float
+    materialize_method: Optional[str]
+    failed_images: int
+    """Number of images that could not be downloaded. Failed images do not fail the model."""
+    reused_images: int
+    """Number of images that already existed or were placed from the store, without being requested."""
+    verification: Optional[concurrent.futures.Future]
+    """Future of whether the model file matches its SHA256 hash, if the file is checked in the background (see finish_verification())."""
+
+    def __init__(self, dst_root_path: str, batchOptions: BatchOptions, on_stage: Optional[Callable[[str], None]] = None, metadata_lookup: Optional[MetadataLookup] = None):
         self.__dst_root_path = dst_root_path
         self.__batchOptions = batchOptions
+        self.__on_stage = on_stage
+        self.__metadata_lookup = metadata_lookup
+        self.skipped = False
+        self.downloaded_bytes = 0
+        self.download_seconds = 0
+        self.materialized_bytes = 0
+        self.materialize_seconds = 0
+        self.materialize_method = None
+        self.failed_images = 0
+        self.reused_images = 0
+        self.verification = None
+        self.__metadata = None
+        self.__filenames = None
+        self.__model_url = None
+        self.__verifier = None
+        self.__verified_filepath = None
+        self.__on_verified = None
+
+    def __get_store(self) -> Optional[Store]:
+        return Store.open(self.__batchOptions.store_dir) if self.__batchOptions.store_mode == '1' else None
 
     def __download_images(self, dirpath: str, urls: List[str], filenames: List[str]):
-        def make_req(url): return self.__batchOptions.session.get(
-            url, stream=True)
-
-        # TODO: Change progress bar to be based on time length of request rather than when all the images are fetched and ready to be written.
-        # TODO: what if a specific image have a hard time with getting a response?
+        if (len(urls) == 0):
+            sprint(Styler.stylize('No images to download...', color='warning'))
+            return
 
-        os.makedirs(dirpath, exist_ok=True)
-        print_verbose('Now requesting images...')
-        image_content_chunks_list = [res.iter_content(1024*1024) for res in concurrent_request(
-            req_fn=make_req, urls=urls)]
-        print_verbose('Finished requesting images...')
+        print_verbose('Now downloading images...')
+        with span('images', count=len(urls)) as s:
+            downloader = ImageDownloader(
+                session=self.__batchOptions.session,
+                limiter=RateLimiter(self.__batchOptions.limit_rate,
+                                    self.__batchOptions.limit_burst),
+                store=self.__get_store()
+            )
+            failed_urls = downloader.download(dirpath, urls, filenames)
+            s.set(failed=len(failed_urls), reused=downloader.reused)
+        print_verbose('Finished downloading images...')
 
-        if (len(image_content_chunks_list) == 0):
-            sprint(Styler.stylize('No images to download...', color='warning'))
-        else:
-            IOHelper.write_to_files(dirpath, filenames, image_content_chunks_list, mode='wb',
-                                    use_pb=True, total=len(filenames), desc='Images')
+        self.failed_images = len(failed_urls)
+        self.reused_images = downloader.reused
+        if self.failed_images > 0:
+            sprint(Styler.stylize(
+                f'{self.failed_images} of {len(urls)} images could not be downloaded.', color='warning'))
 
     def __download_prompt(self, dirpath: str, filenames: List[str], prompts: List[Dict]):
         if len(prompts) != 0:
@@ -65,31 +128,75 @@ class Model:
         IOHelper.write_to_file(
             filepath, [data.rstrip()], encoding='UTF-8')
 
-    def __download_model(self, dirpath, filename: str, model_res: requests.Response, version_id: str, version_hashes: Dict):
+    @staticmethod
+    def __matches_size(filepath: str, expected_size: Optional[int]):
+        return expected_size is None or abs(os.path.getsize(filepath) - expected_size) <= _SIZE_TOLERANCE
+
+    def __download_model(self, dirpath, filename: str, open_model_res: Callable[[], requests.Response], version_id: str, version_hashes: Dict, expected_size: Optional[int] = None):
+        """Checks the destination path, the store and the cache before calling open_model_res, so the model is only requested when it has to be downloaded."""
         # FIXME: um, refactor later on
         os.makedirs(dirpath, exist_ok=True)
         filepath = os.path.join(dirpath, filename)
         sha256_hash = version_hashes.get('SHA256', None)
+        cache = None
+        cached_filepath = None
         try:
             if self.__batchOptions.cache_mode == '1':
-                cache = Cache(
-                    version_id)
-                cached_filepath = cache.get_local_model_path()
+                with span('cache.lookup', version_id=version_id):
+                    cache = Cache(
+                        version_id)
+                    cached_filepath = cache.get_local_model_path() or Cache.get_local_model_path_by_SHA256(
+                        sha256_hash)
         except:
             sprint(Styler.stylize('Unable to access cache.', color='warning'))
+        store = self.__get_store()
 
-        def download_new_model():
-            content_chunks = model_res.iter_content(
-                ceil(self.__batchOptions.limit_rate / 8)
-                if self.__batchOptions.limit_rate is not None and self.__batchOptions.limit_rate != 0
-                else 1024*1024)
-            IOHelper.write_to_file(filepath, content_chunks, mode='wb', limit_rate=self.__batchOptions.limit_rate,
-                                   use_pb=True, total=float(model_res.headers.get('content-length', 0)), desc='Model')
-
-        def cache_model_info():
+        # In strict mode, files that would have to be read back to be hashed are checked in the background instead.
+        verify_later = self.__verifier is not None and self.__batchOptions.strict_mode == '1' and bool(
+            sha256_hash)
+
+        def cache_model_info(hashes: Dict = version_hashes):
             if self.__batchOptions.cache_mode == '1' and cache:
-                cache.set_local_model_cache(
-                    filepath, version_hashes)
+                with span('cache.write', version_id=version_id):
+                    cache.set_local_model_cache(
+                        filepath, hashes)
+
+        def add_to_store(hash: str):
+            """Adds the model file to the store and links it back, so that it only takes up disk space once across every root directory.
+            Only called once the hash of the model file has been computed or checked."""
+            if store is None:
+                return
+            try:
+                store.add(filepath, hash)
+                store.place(hash, filepath)
+            except OSError as e:
+                sprint(Styler.stylize(
+                    f'Unable to add model file to the store: {e}', color='warning'))
+
+        def on_verified():
+            add_to_store(sha256_hash)
+            cache_model_info()
+
+        def download_new_model():
+            """Downloads the model, and caches its path with the SHA256 hash computed while downloading."""
+            if self.__batchOptions.cache_mode == '1':
+                inc('civitdl_cache_requests_total', cache='model', result='miss')
+            start = time.perf_counter()
+            with span('model.download', version_id=version_id) as s:
+                digest = Transfer(session=self.__batchOptions.session,
+                                  limit_rate=self.__batchOptions.limit_rate,
+                                  segments=self.__batchOptions.segments,
+                                  limit_burst=self.__batchOptions.limit_burst).write(
+                    filepath, open_model_res(), sha256_hash=sha256_hash,
+                    verify_later=verify_later)
+                self.download_seconds = time.perf_counter() - start
+                self.downloaded_bytes = os.path.getsize(filepath)
+                s.set(bytes=self.downloaded_bytes)
+            if digest is None:
+                self.__verify_later(filepath, sha256_hash, on_verified)
+            else:
+                add_to_store(digest)
+                cache_model_info({**version_hashes, 'SHA256': digest})
 
         if (self.__batchOptions.strict_mode == '1' and not sha256_hash):
             sprint(
@@ -97,12 +204,17 @@ class Model:
                     f'(Strict Mode) Error with fetching SHA256 hash from CivitAI. Proceeding to download model from CivitAI.', color='warning')
             )
             download_new_model()
-            cache_model_info()
             return
 
         # Check if filepath already exist
         if not self.__batchOptions.model_overwrite and os.path.exists(filepath):
-            if (
+            if verify_later:
+                print_newlines(Styler.stylize(f"""Model file already existed at the destination path, its hash is checked in the background:
+                    - Path: {filepath}""", color='info'))
+                self.__verify_later(filepath, sha256_hash, on_verified)
+                self.skipped = True
+                return
+            elif (
                 self.__batchOptions.strict_mode == '1' and not IOHelper.compare_hash(
                     filepath, sha256_hash)
             ):
@@ -112,10 +224,49 @@ class Model:
                     )
                 )
                 # I want to check cache before giving up and downloading new model.
+            elif self.__batchOptions.strict_mode != '1' and not self.__matches_size(filepath, expected_size):
+                sprint(
+                    Styler.stylize(
+                        f'Model file already exist at destination file path, but its size does not match the size from CivitAI.', color='warning'
+                    )
+                )
             else:
                 print_newlines(Styler.stylize(f"""Model file already existed at the destination path:
                     - Path: {filepath}""", color='info'))
+                if self.__batchOptions.strict_mode == '1':
+                    add_to_store(sha256_hash)
                 cache_model_info()
+                self.skipped = True
+                return
+
+        # Check the store for a model file with the same hash
+        if store is not None and sha256_hash:
+            blob_path = store.get_blob_path(sha256_hash)
+            if not store.has(sha256_hash):
+                inc('civitdl_cache_requests_total', cache='store', result='miss')
+            elif self.__batchOptions.strict_mode == '1' and not verify_later and not IOHelper.compare_hash(blob_path, sha256_hash):
+                sprint(
+                    Styler.stylize(
+                        f'(Strict Mode) Model file in the store does not match the hash from CivitAI. Removing it from the store.', color='warning'
+                    ))
+                store.remove(sha256_hash)
+            else:
+                print_newlines(Styler.stylize(f"""Model file already existed in the store:
+                    - Path: {blob_path}""", color='info'))
+                start = time.perf_counter()
+                self.materialize_method = store.place(sha256_hash, filepath)
+                self.materialize_seconds = time.perf_counter() - start
+                self.materialized_bytes = os.path.getsize(filepath)
+                inc('civitdl_cache_requests_total', cache='store', result='hit')
+                inc('civitdl_cache_saved_bytes_total',
+                    self.materialized_bytes, cache='store')
+                print_verbose(
+                    f'Placed {self.materialized_bytes} bytes with {self.materialize_method} in {self.materialize_seconds:.3f} seconds.')
+                if verify_later:
+                    self.__verify_later(
+                        filepath, sha256_hash, cache_model_info)
+                else:
+                    cache_model_info()
                 return
 
         # Check cache if file exist
@@ -124,26 +275,81 @@ class Model:
                 sprint(
                     Styler.stylize(f'Model file does not exist at cached file path.', color='warning'))
                 download_new_model()
-                cache_model_info()
                 return
-            elif self.__batchOptions.strict_mode == '1' and not IOHelper.compare_hash(cached_filepath, sha256_hash):
+            elif self.__batchOptions.strict_mode == '1' and not verify_later and not IOHelper.compare_hash(cached_filepath, sha256_hash):
                 sprint(
                     Styler.stylize(
                         f'(Strict Mode) Cached file path of model does not match the hash from CivitAI. Proceeding to download model from CivitAI.', color='warning'
                     ))
                 download_new_model()
-                cache_model_info()
+                return
+            elif self.__batchOptions.strict_mode != '1' and not self.__matches_size(cached_filepath, expected_size):
+                sprint(
+                    Styler.stylize(
+                        f'Size of model file at cached file path does not match the size from CivitAI. Proceeding to download model from CivitAI.', color='warning'
+                    ))
+                download_new_model()
                 return
             else:
                 print_newlines(Styler.stylize(f"""Model file already existed at the following path:
                     - Path: {cached_filepath}""", color='info'))
-                sprint(Styler.stylize(f"Copying to new path...", color='info'))
-                shutil.copy(cached_filepath, filepath)
-                cache_model_info()
+                sprint(Styler.stylize(
+                    f"Placing model at new path ({self.__batchOptions.cache_link_mode})...", color='info'))
+                start = time.perf_counter()
+                self.materialize_method = IOHelper.materialize(
+                    cached_filepath, filepath, self.__batchOptions.cache_link_mode)
+                self.materialize_seconds = time.perf_counter() - start
+                self.materialized_bytes = os.path.getsize(filepath)
+                inc('civitdl_cache_requests_total', cache='model', result='hit')
+                inc('civitdl_cache_saved_bytes_total',
+                    self.materialized_bytes, cache='model')
+                print_verbose(
+                    f'Placed {self.materialized_bytes} bytes with {self.materialize_method} in {self.materialize_seconds:.3f} seconds.')
+
+                def on_placed_verified():
+                    if self.__batchOptions.strict_mode == '1':
+                        add_to_store(sha256_hash)
+                    # Keep the cache pointing at the original file, as a symlink is only valid while it exists.
+                    if self.materialize_method != 'symlink':
+                        cache_model_info()
+
+                if verify_later:
+                    # The placed file is checked rather than the cached file, so a bad copy is caught as well.
+                    self.__verify_later(
+                        filepath, sha256_hash, on_placed_verified)
+                else:
+                    on_placed_verified()
                 return
 
         download_new_model()
-        cache_model_info()
+
+    def __verify_later(self, filepath: str, sha256_hash: str, on_verified: Callable[[], None]):
+        """Checks filepath against sha256_hash in the background. on_verified is called by finish_verification() if it matches."""
+        self.__verified_filepath = filepath
+        self.__on_verified = on_verified
+        self.verification = self.__verifier.verify(filepath, sha256_hash)
+
+    def finish_verification(self) -> bool:
+        """Waits for the model file to be checked in the background, and returns whether it matches the hash from CivitAI.
+        A file that does not match is moved to the .quarantine directory next to it, so that downloading the model again does not skip it."""
+        if self.verification is None:
+            return True
+        filepath = self.__verified_filepath
+        try:
+            matches = self.verification.result()
+        except Exception as e:
+            sprint(Styler.stylize(
+                f'(Strict Mode) Unable to check the hash of model file "{filepath}": {e}', color='warning'))
+            matches = False
+
+        if matches:
+            self.__on_verified()
+            return True
+
+        if os.path.lexists(filepath):
+            sprint(Styler.stylize(
+                f'(Strict Mode) Model file does not match the hash from CivitAI, moved to "{quarantine(filepath)}".', color='warning'))
+        return False
 
     def __request_model(self, model_id: str, version_id: str, model_download_url: str):
         # Request model
@@ -153,8 +359,10 @@ class Model:
         headers = {
             'Authorization': f'Bearer {self.__batchOptions.api_key}',
         }
-        res = self.__batchOptions.session.get(
-            model_download_url, stream=True, headers=headers)
+        with span('api.model', version_id=version_id) as s:
+            res = self.__batchOptions.session.get(
+                model_download_url, stream=True, headers=headers)
+            s.set(status=res.status_code)
 
         print_verbose(f'Status Code: {res.status_code}')
 
@@ -178,7 +386,30 @@ class Model:
 
         return res
 
-    def __get_filenames(self, version_files: List[Dict], version_id: str, model_id: str, model_name: Optional[str] = None, image_download_urls: List = [], content_disposition: Union[str, None] = None):
+    def __open_model_response(self) -> requests.Response:
+        if self.__model_url is not None:
+            res = self.__batchOptions.session.get(
+                self.__model_url, stream=True)
+            if res.status_code == 200:
+                return res
+            print_verbose(
+                f'Redirected model url returned status code {res.status_code}, requesting model from CivitAI again.')
+            res.close()
+
+        return self.__request_model(
+            model_id=self.__metadata.model_id,
+            version_id=self.__metadata.version_id,
+            model_download_url=self.__metadata.model_download_url
+        )
+
+    @staticmethod
+    def __get_expected_size(version_file: Optional[Dict]) -> Optional[int]:
+        try:
+            return round(float(version_file['sizeKB']) * 1024)
+        except (TypeError, KeyError, ValueError):
+            return None
+
+    def __get_filenames(self, version_files: List[Dict], version_id: str, model_id: str, model_name: Optional[str] = None, image_download_urls: List = [], content_disposition: Union[str, None] = None, version_filename: Optional[str] = None):
         if model_name is None or model_name == '':
             model_name = 'Unknown'
 
@@ -191,7 +422,10 @@ class Model:
                     version_file = file
             filename = None
 
-            if content_disposition == None:
+            # CivitAI names the downloaded file after the name of the version file, so the model does not need to be requested for it.
+            if version_filename is not None:
+                filename = version_filename
+            elif content_disposition == None:
                 sprint(Styler.stylize(
                     f'Downloaded model from CivitAI has no content disposition header available.', color='warning'))
                 filename = f'{model_name}--{version_file["name"]}'
@@ -238,27 +472,42 @@ class Model:
             'hash': hash_filename
         }
 
-    def download(self, id):
-        # 1. Get metadata
-        metadata = Metadata(
-            nsfw_mode=self.__batchOptions.nsfw_mode,
-            max_images=self.__batchOptions.max_images,
-            session=self.__batchOptions.session
-        ).make_api_call(id)
+    def __finish_stage(self, stage: str):
+        if self.__on_stage is not None:
+            self.__on_stage(stage)
 
-        print_newlines(Styler.stylize(
-            f"""Now downloading \"{metadata.model_name}\"...
-                - Model ID: {metadata.model_id}
-                - Version ID: {metadata.version_id}\n""",
-            color='main'))
+    def prepare(self, id: Id):
+        """Resolves the metadata, filenames and sorter paths of the model."""
+        # 1. Get metadata
+        with span('metadata', source=id.original):
+            metadata = Metadata(
+                nsfw_mode=self.__batchOptions.nsfw_mode,
+                max_images=self.__batchOptions.max_images,
+                image_size=self.__batchOptions.image_size,
+                image_budget=self.__batchOptions.image_budget,
+                session=self.__batchOptions.session,
+                cache_mode=self.__batchOptions.metadata_cache,
+                cache_ttl=self.__batchOptions.metadata_cache_ttl,
+                lookup=self.__metadata_lookup
+            ).make_api_call(id)
 
         # 2. Get directory and file paths
 
+        version_filename = metadata.version_file.get('name') if metadata.version_file else None
+        if not isinstance(version_filename, str) or version_filename == '':
+            version_filename = None
+
+        # The model is only requested here when its filename is not in the metadata.
         model_res = self.__request_model(
             model_id=metadata.model_id,
             version_id=metadata.version_id,
             model_download_url=metadata.model_download_url
-        ) if not self.__batchOptions.without_model else None
+        ) if not self.__batchOptions.without_model and version_filename is None else None
+
+        # Only the headers are needed here. The body is requested again from the redirected url once the model is downloaded.
+        if model_res is not None:
+            model_res.close()
+            self.__model_url = model_res.url if model_res.history else None
 
         filenames = self.__get_filenames(
             version_files=metadata.version_dict['files'],
@@ -266,12 +515,37 @@ class Model:
             model_id=metadata.model_id,
             model_name=metadata.model_name,
             image_download_urls=metadata.image_download_urls,
-            content_disposition=model_res.headers.get('Content-Disposition') if model_res else None)
+            content_disposition=model_res.headers.get('Content-Disposition') if model_res else None,
+            version_filename=version_filename)
 
         sorter_data = self.__batchOptions.sorter(
             metadata.model_dict, metadata.version_dict, os.path.split(filenames['model'])[0], self.__dst_root_path)
 
-        # print(sorter_data.metadata_dir_path)
+        self.__metadata = metadata
+        self.__filenames = filenames
+        self.__sorter_data = sorter_data
+        self.__finish_stage('metadata')
+        return self
+
+    def download(self, id: Optional[Id] = None, verifier: Optional[Verifier] = None):
+        """Downloads the model, its metadata, images and prompts. Calls prepare() first if id is provided.
+        In strict mode, if verifier is provided, the model file may be checked in the background after download() returns (see verification)."""
+        if id is not None:
+            self.prepare(id)
+        self.__verifier = verifier
+        if self.__metadata is None:
+            raise UnexpectedException(
+                'Model.download() called before Model.prepare().')
+
+        metadata = self.__metadata
+        filenames = self.__filenames
+        sorter_data = self.__sorter_data
+
+        print_newlines(Styler.stylize(
+            f"""Now downloading \"{metadata.model_name}\"...
+                - Model ID: {metadata.model_id}
+                - Version ID: {metadata.version_id}\n""",
+            color='main'))
 
         # 3. Download model and etc.
 
@@ -294,15 +568,18 @@ class Model:
                 filenames=filenames['prompts'],
                 prompts=metadata.image_dicts
             )
+        self.__finish_stage('images')
 
         if not self.__batchOptions.without_model:
             self.__download_model(
                 dirpath=sorter_data.model_dir_path,
                 filename=filenames['model'],
-                model_res=model_res,
+                open_model_res=self.__open_model_response,
                 version_id=metadata.version_id,
-                version_hashes=metadata.version_hashes
+                version_hashes=metadata.version_hashes,
+                expected_size=self.__get_expected_size(metadata.version_file)
             )
+            self.__finish_stage('model')
 
         self.__download_hash(
             dirpath=sorter_data.model_dir_path,
@@ -0,0 +1,288 @@
+from json import dumps, loads
+import os
+import re
+import threading
+import concurrent.futures
+from math import ceil
+from typing import Dict, List, Optional, Tuple
+
+from requests import Response, Session
+
+from helpers.core.utils import Styler, APIException, ResourcesException, get_progress_bar, print_verbose, sprint
+from helpers.core.iohelper import IOHelper
+from helpers.core.ratelimiter import RateLimiter
+from helpers.metrics import count_bytes, get_reason, inc
+
+
+_CONTENT_RANGE_REGEX = re.compile(
+    r'bytes (?P<start>\d+)-(?P<end>\d+)/(?P<total>\d+|\*)')
+
+# Segments smaller than this are not worth the extra requests.
+_MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+_SEGMENT_RETRY_COUNT = 3
+
+
+class Transfer:
+    """Writes the body of a model download response to disk.
+
+    The partially downloaded file is kept in the .tmp directory when the transfer fails. The next attempt resumes
+    from the end of the partial file with a Range request, and falls back to a full download if the server ignores the range
+    or the file on the server changed in between.
+
+    If segments is above 1, files that are large enough are split into byte ranges that are downloaded at the same time
+    into a preallocated temp file. The assembled file is checked against the SHA256 hash before being moved to its destination,
+    unless verify_later is enabled, in which case the caller checks it in the background instead (see Verifier).
+
+    A single stream is hashed while it is written, so the file is never read back to check its hash.
+
+    Every segment of a transfer shares a single RateLimiter, so limit_rate caps the transfer as a whole."""
+    __session: Session
+    __limiter: RateLimiter
+    __segments: int
+
+    def __init__(self, session: Session, limit_rate: int, segments: int = 1, limit_burst: Optional[int] = None):
+        self.__session = session
+        self.__limiter = RateLimiter(limit_rate, limit_burst)
+        self.__segments = segments
+
+    def __get_chunk_size(self):
+        rate = self.__limiter.rate
+        return min(ceil(rate / 8), 1024*1024) if rate is not None else 1024*1024
+
+    @staticmethod
+    def __get_resume_info_path(temp_filepath: str):
+        return f'{temp_filepath}.resume.json'
+
+    def __read_resume_info(self, temp_filepath: str) -> Optional[Dict]:
+        info_path = self.__get_resume_info_path(temp_filepath)
+        if not os.path.isfile(temp_filepath) or not os.path.isfile(info_path):
+            return None
+
+        try:
+            with open(info_path, 'r', encoding='UTF-8') as file:
+                info = loads(file.read())
+        except Exception as e:
+            print_verbose(f'Unable to read resume info at "{info_path}": {e}')
+            return None
+
+        info['offset'] = os.path.getsize(temp_filepath)
+        return info
+
+    def __write_resume_info(self, temp_filepath: str, res: Response, total: Optional[int]):
+        os.makedirs(os.path.dirname(temp_filepath), exist_ok=True)
+        with open(self.__get_resume_info_path(temp_filepath), 'w', encoding='UTF-8') as file:
+            file.write(dumps({
+                'url': res.url,
+                'etag': res.headers.get('ETag'),
+                'last_modified': res.headers.get('Last-Modified'),
+                'total': total
+            }))
+
+    def __is_valid_range(self, res: Response, offset: int, info: Dict) -> bool:
+        match = _CONTENT_RANGE_REGEX.fullmatch(
+            res.headers.get('Content-Range', '').strip())
+        if match is None or int(match.group('start')) != offset:
+            return False
+
+        total = match.group('total')
+        if info.get('total') is not None and total != '*' and int(total) != info['total']:
+            return False
+
+        etag = res.headers.get('ETag')
+        if info.get('etag') is not None and etag is not None and etag != info['etag']:
+            return False
+
+        return True
+
+    def __request_full(self, url: str) -> Response:
+        res = self.__session.get(url, stream=True)
+        if res.status_code != 200:
+            raise APIException(
+                res.status_code, f'Requesting the full model file failed after being unable to resume the download from "{url}"')
+        return res
+
+    def __request_range(self, res: Response, info: Dict) -> Tuple[int, Response]:
+        """Returns the offset to resume from and the response to read the rest of the file from. The offset is 0 when the partial file can not be resumed."""
+        offset = info['offset']
+        if offset == 0:
+            return (0, res)
+
+        headers = {'Range': f'bytes={offset}-'}
+        etag = info.get('etag')
+        if etag is not None and not etag.startswith('W/'):
+            headers['If-Range'] = etag
+        elif info.get('last_modified') is not None:
+            headers['If-Range'] = info['last_modified']
+
+        # The response from the download url has been redirected to the file itself, so the range can be requested from there.
+        url = res.url
+        res.close()
+        print_verbose(f'Requesting range "{headers["Range"]}" from "{url}"')
+        range_res = self.__session.get(url, stream=True, headers=headers)
+        print_verbose(f'Range Status Code: {range_res.status_code}')
+
+        if range_res.status_code == 206 and self.__is_valid_range(range_res, offset, info):
+            sprint(Styler.stylize(
+                f'Resuming model download from {offset} bytes...', color='info'))
+            return (offset, range_res)
+        elif range_res.status_code == 200:
+            sprint(Styler.stylize(
+                'Server ignored the range request or the model file changed. Restarting model download from the beginning...', color='warning'))
+            return (0, range_res)
+        else:
+            sprint(Styler.stylize(
+                f'Unable to resume model download (status code {range_res.status_code}). Restarting model download from the beginning...', color='warning'))
+            range_res.close()
+            return (0, self.__request_full(url))
+
+    def __get_segment_ranges(self, total: int) -> List[Tuple[int, int]]:
+        count = max(1, min(self.__segments, total // _MIN_SEGMENT_SIZE))
+        size = ceil(total / count)
+        return [(start, min(start + size, total) - 1) for start in range(0, total, size)]
+
+    def __request_segment(self, url: str, start: int, end: int, total: int) -> Response:
+        res = self.__session.get(url, stream=True, headers={
+                                 'Range': f'bytes={start}-{end}'})
+        match = _CONTENT_RANGE_REGEX.fullmatch(
+            res.headers.get('Content-Range', '').strip())
+        if (
+            res.status_code != 206 or match is None
+            or int(match.group('start')) != start or int(match.group('end')) != end
+            or match.group('total') not in ('*', str(total))
+        ):
+            res.close()
+            raise ResourcesException(
+                f'Server did not return the requested range, bytes={start}-{end} (status code {res.status_code}).')
+        return res
+
+    def __write_segments(self, filepath: str, url: str, total: int, sha256_hash: Optional[str], verify_later: bool = False) -> Tuple[bool, Optional[str]]:
+        """Downloads url in segments. Returns whether the file was written, and its SHA256 hash unless verify_later is enabled.
+        Nothing is written if the server does not support range requests."""
+        ranges = self.__get_segment_ranges(total)
+        temp_filepath = IOHelper.get_temp_filepath(filepath)
+
+        # The first segment doubles as a probe for range support.
+        try:
+            first_res = self.__request_segment(url, *ranges[0], total)
+        except ResourcesException as e:
+            print_verbose(e)
+            return (False, None)
+
+        print_verbose(f'Downloading model in {len(ranges)} segments: {ranges}')
+        IOHelper.preallocate_file(temp_filepath, total)
+        progress_bar = get_progress_bar(
+            total, f'Model ({len(ranges)} segments)')
+        progress_lock = threading.Lock()
+        failed = threading.Event()
+
+        def download_segment(index: int):
+            start, end = ranges[index]
+            res = first_res if index == 0 else None
+            iter = 0
+
+            def update(bytes_downloaded):
+                nonlocal start
+                if failed.is_set():
+                    raise ResourcesException('Another segment failed.')
+                start += bytes_downloaded
+                with progress_lock:
+                    progress_bar.update(bytes_downloaded)
+
+            while start <= end:
+                try:
+                    if res is None:
+                        res = self.__request_segment(url, start, end, total)
+                    with open(temp_filepath, 'r+b') as file:
+                        file.seek(start)
+                        IOHelper.write_contents(file, count_bytes(res.iter_content(
+                            self.__get_chunk_size()), 'model'), self.__limiter, update)
+                    if start <= end:
+                        raise ResourcesException(
+                            f'Segment ended early at byte {start}, expected byte {end}.')
+                except Exception as e:
+                    res = None
+                    if failed.is_set() or iter >= _SEGMENT_RETRY_COUNT:
+                        failed.set()
+                        raise e
+                    iter += 1
+                    inc('civitdl_retries_total',
+                        scope='segment', reason=get_reason(e))
+                    print_verbose(
+                        f'Retrying segment #{index + 1} from byte {start}: {e}')
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                for future in [executor.submit(download_segment, i) for i in range(len(ranges))]:
+                    future.result()
+        except Exception as e:
+            failed.set()
+            progress_bar.close()
+            IOHelper.delete_file_if_exists(temp_filepath)
+            IOHelper.remove_dir_if_empty(os.path.dirname(temp_filepath))
+            raise e
+        progress_bar.close()
+
+        if verify_later:
+            IOHelper.move_over(temp_filepath, filepath)
+            IOHelper.remove_dir_if_empty(os.path.dirname(temp_filepath))
+            return (True, None)
+
+        # Segments arrive out of order, so the assembled file has to be read back once to be hashed.
+        digest = IOHelper.get_hash(temp_filepath)
+        print_verbose(f'Computed SHA256: "{digest}", Expected SHA256: "{sha256_hash}"')  # nopep8
+        if sha256_hash and digest != sha256_hash.upper():
+            IOHelper.delete_file_if_exists(temp_filepath)
+            IOHelper.remove_dir_if_empty(os.path.dirname(temp_filepath))
+            raise ResourcesException(
+                'Model file assembled from segments does not match the SHA256 hash from CivitAI.')
+
+        IOHelper.move_over(temp_filepath, filepath)
+        IOHelper.remove_dir_if_empty(os.path.dirname(temp_filepath))
+        return (True, digest)
+
+    def write(self, filepath: str, res: Response, sha256_hash: Optional[str] = None, verify_later: bool = False) -> Optional[str]:
+        """Writes the model file to filepath and returns its SHA256 hash. If sha256_hash is provided, the file is only moved to filepath if it matches.
+        If verify_later is enabled, a file downloaded in segments is moved to filepath without being read back, and None is returned."""
+        temp_filepath = IOHelper.get_temp_filepath(filepath)
+        info = self.__read_resume_info(temp_filepath)
+
+        content_length = res.headers.get('content-length')
+        if (
+            info is None and self.__segments > 1 and content_length is not None
+            and res.headers.get('Accept-Ranges', 'bytes') != 'none'
+            and int(content_length) >= 2 * _MIN_SEGMENT_SIZE
+        ):
+            url = res.url
+            res.close()
+            written, digest = self.__write_segments(
+                filepath, url, int(content_length), sha256_hash, verify_later)
+            if written:
+                return digest
+            sprint(Styler.stylize(
+                'Server does not support downloading the model in segments. Downloading the model in a single stream...', color='warning'))
+            res = self.__request_full(url)
+
+        offset = 0
+        if info is not None:
+            offset, res = self.__request_range(res, info)
+
+        content_length = res.headers.get('content-length')
+        total = offset + int(content_length) if content_length is not None else None
+        if offset == 0:
+            self.__write_resume_info(temp_filepath, res, total)
+
+        try:
+            digest = IOHelper.write_to_file(filepath, count_bytes(res.iter_content(self.__get_chunk_size()), 'model'), mode='ab' if offset != 0 else 'wb',
+                                            limiter=self.__limiter, use_pb=True, total=float(total or 0), initial=offset, desc='Model',
+                                            keep_partial=True, with_hash=True, expected_hash=sha256_hash)
+        except ResourcesException as e:
+            # Hash mismatch, the partial file has been deleted so the resume info is no longer valid.
+            IOHelper.delete_file_if_exists(
+                self.__get_resume_info_path(temp_filepath))
+            IOHelper.remove_dir_if_empty(os.path.dirname(temp_filepath))
+            raise e
+
+        IOHelper.delete_file_if_exists(
+            self.__get_resume_info_path(temp_filepath))
+        IOHelper.remove_dir_if_empty(os.path.dirname(temp_filepath))
+        return digest
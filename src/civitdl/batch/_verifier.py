@@ -0,0 +1,55 @@
+import os
+import shutil
+import threading
+import concurrent.futures
+
+from helpers.core.utils import getDate, span
+from helpers.core.iohelper import IOHelper
+from helpers.metrics import inc
+
+
+class Verifier:
+    """Checks the SHA256 hash of model files in background threads, so that the next model is downloaded while the previous one is hashed.
+    At most queue_size files wait to be checked at a time. verify() blocks while the queue is full, so hashing does not fall behind
+    the downloads without bound."""
+    __executor: concurrent.futures.ThreadPoolExecutor
+    __slots: threading.Semaphore
+
+    def __init__(self, workers: int, queue_size: int):
+        self.__executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='verify')
+        self.__slots = threading.BoundedSemaphore(queue_size)
+
+    def __verify(self, filepath: str, sha256_hash: str) -> bool:
+        try:
+            with span('verify', path=filepath) as s:
+                matches = IOHelper.compare_hash(filepath, sha256_hash.upper())
+                s.set(matches=matches)
+            inc('civitdl_verifications_total',
+                result='passed' if matches else 'failed')
+            return matches
+        finally:
+            self.__slots.release()
+
+    def verify(self, filepath: str, sha256_hash: str) -> concurrent.futures.Future:
+        """Returns a future of whether filepath matches sha256_hash. A file that can not be read raises in the future."""
+        self.__slots.acquire()
+        try:
+            return self.__executor.submit(self.__verify, filepath, sha256_hash)
+        except BaseException as e:
+            self.__slots.release()
+            raise e
+
+    def shutdown(self, wait: bool = True):
+        self.__executor.shutdown(wait=wait)
+
+
+def quarantine(filepath: str) -> str:
+    """Moves a model file that does not match its hash to the .quarantine directory next to it, so that it is neither used nor deleted. Returns its new path."""
+    quarantine_dirpath = os.path.join(os.path.dirname(filepath), '.quarantine')
+    os.makedirs(quarantine_dirpath, exist_ok=True)
+    stem, ext = os.path.splitext(os.path.basename(filepath))
+    quarantine_filepath = os.path.join(
+        quarantine_dirpath, f'{stem}-{getDate()}{ext}')
+    shutil.move(filepath, quarantine_filepath)
+    return quarantine_filepath
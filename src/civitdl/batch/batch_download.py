@@ -1,49 +1,390 @@
 import os
 import time
+import threading
 import traceback
-from typing import List
+import concurrent.futures
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Literal, Optional, Tuple
 
 from ._model import Model
+from ._metadata import MetadataLookup, _BULK_IDS_SIZE
+from ._journal import Journal, JournalEntry
+from ._verifier import Verifier
 
-from helpers.core.utils import Styler, APIException, get_version, print_exc, print_verbose, run_verbose, sprint
-from helpers.sourcemanager import SourceManager
+from helpers.core.utils import Styler, APIException, format_bytes, get_version, print_exc, print_newlines, print_verbose, run_verbose, set_print_prefix, span, sprint
+from helpers.sourcemanager import Id, SourceManager
 from helpers.options import BatchOptions
+from helpers.metrics import get_reason, inc
 
-__version__ = get_version()
+
+def __getattr__(name: str):
+    # __version__ is looked up on first use, as reading package metadata is slow.
+    if name == '__version__':
+        return get_version()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+_Status = Literal['succeeded', 'skipped', 'failed']
+
+
+class _BatchSummary:
+    """Counts the outcome of every model in a batch. Safe to update from multiple workers."""
+    succeeded: int
+    skipped: int
+    failed: int
+
+    downloaded_bytes: int
+    download_seconds: float
+    materialized_bytes: int
+    materialize_seconds: float
+    linked_bytes: int
+    """Bytes placed from the cache without taking up extra disk space."""
+    failed_images: int
+    reused_images: int
+    """Images that already existed or were placed from the store, without being requested."""
+    throttled_seconds: float
+    throttled_responses: int
+    verified: int
+    """Model files checked against their hash in the background."""
+    quarantined: int
+    """Model files that did not match their hash, and were downloaded again."""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.succeeded = 0
+        self.skipped = 0
+        self.failed = 0
+        self.downloaded_bytes = 0
+        self.download_seconds = 0
+        self.materialized_bytes = 0
+        self.materialize_seconds = 0
+        self.linked_bytes = 0
+        self.failed_images = 0
+        self.reused_images = 0
+        self.throttled_seconds = 0
+        self.throttled_responses = 0
+        self.verified = 0
+        self.quarantined = 0
+
+    def add(self, status: _Status, model: Optional[Model] = None):
+        inc('civitdl_models_total', status=status)
+        with self.__lock:
+            setattr(self, status, getattr(self, status) + 1)
+            if model is not None:
+                self.downloaded_bytes += model.downloaded_bytes
+                self.download_seconds += model.download_seconds
+                self.materialized_bytes += model.materialized_bytes
+                self.materialize_seconds += model.materialize_seconds
+                if model.materialize_method in ('hardlink', 'reflink', 'symlink'):
+                    self.linked_bytes += model.materialized_bytes
+                self.failed_images += model.failed_images
+                self.reused_images += model.reused_images
+
+    def add_verification(self, matches: bool):
+        with self.__lock:
+            self.verified += 1
+            if not matches:
+                self.quarantined += 1
+
+    def print(self):
+        color = 'warning' if self.failed > 0 else 'success'
+        print_newlines(Styler.stylize(f"""Batch download summary:
+                - Succeeded: {self.succeeded}
+                - Skipped (already downloaded): {self.skipped}
+                - Failed: {self.failed}""", color=color))
+
+        if self.reused_images > 0:
+            print_newlines(Styler.stylize(
+                f'                - Images reused without being requested: {self.reused_images}', color=color))
+        if self.failed_images > 0:
+            print_newlines(Styler.stylize(
+                f'                - Images that could not be downloaded: {self.failed_images}', color='warning'))
+
+        if self.verified > 0:
+            print_newlines(Styler.stylize(f'                - Verified in the background (strict mode): {self.verified - self.quarantined} of {self.verified} model files matched',
+                                          color='warning' if self.quarantined > 0 else color))
+        if self.quarantined > 0:
+            print_newlines(Styler.stylize(
+                f'                - Quarantined and downloaded again: {self.quarantined}', color='warning'))
+
+        if self.throttled_responses > 0:
+            print_newlines(Styler.stylize(
+                f'                - Throttled by CivitAI: {self.throttled_responses} responses, {self.throttled_seconds:.1f} seconds spent waiting', color='warning'))
+
+        if self.materialized_bytes > 0:
+            saved = f'{format_bytes(self.materialized_bytes)} placed from cache in {self.materialize_seconds:.1f} seconds instead of being downloaded'
+            if self.downloaded_bytes > 0 and self.download_seconds > 0:
+                download_rate = self.downloaded_bytes / self.download_seconds
+                saved += f' (about {max(0, self.materialized_bytes / download_rate - self.materialize_seconds):.1f} seconds saved at this batch\'s download rate)'
+            print_newlines(Styler.stylize(f"""                - Cache: {saved}
+                - Disk space saved by links: {format_bytes(self.linked_bytes)}""", color=color))
 
 
 def _pause(sec):
-    print_verbose('Pausing for 3 seconds...')
+    if sec <= 0:
+        return
+    print_verbose(f'Pausing for {sec} seconds...')
     time.sleep(sec)
     print_verbose('Waking up!')
 
 
-def batch_download(source_strings: List[str], rootdir: str, batchOptions: BatchOptions):
-    """Batch downloads model from CivitAI one by one."""
-
-    source_manager = SourceManager()
-
-    for id in source_manager.parse_src(source_strings):
-        iter = 0
-        while True:
-            try:
-                model = Model(dst_root_path=rootdir,
-                              batchOptions=batchOptions).download(id=id)
-                _pause(batchOptions.pause_time)
-                break
-            except Exception as e:
-                sprint('---------')
-                run_verbose(traceback.print_exc)
-                print_exc(e, '\n')
-                sprint('---------')
-                _pause(batchOptions.pause_time)
-                # if not isinstance(e, APIException):
-                #     break
-                if iter < batchOptions.retry_count:
-                    sprint(Styler.stylize(
-                        'Retrying to download the current model...', color='info'))
-                    iter += 1
-                else:
-                    sprint(Styler.stylize(
-                        f'Max retry of {batchOptions.retry_count} reached. Skipping the current model...', color='info'))
-                    break
+_Source = Tuple[Id, Optional[JournalEntry]]
+"""An id to download, and its entry in the journal if the batch is journaled."""
+
+
+def _prepare_model(id: Id, rootdir: str, batchOptions: BatchOptions, entry: Optional[JournalEntry] = None, lookup: Optional[MetadataLookup] = None, release: bool = False) -> Model:
+    """If release is enabled, the source is released from lookup once prepared. Only the first preparation of every source may release it."""
+    try:
+        return Model(dst_root_path=rootdir, batchOptions=batchOptions,
+                     on_stage=entry.set_state if entry is not None else None, metadata_lookup=lookup).prepare(id)
+    finally:
+        if release and lookup is not None and id.model_id is not None:
+            lookup.release(id.model_id)
+
+
+def _resolve_in_bulk(sources: Iterable[_Source], lookup: MetadataLookup) -> Iterator[_Source]:
+    """Yields every source, after resolving the metadata of each chunk of sources with model ids in bulk before it is yielded.
+    Sources with only a model id are resolved to the version they download, so that they are skipped if another source already downloads that version."""
+    chunk: List[_Source] = []
+    seen_version_ids = set()
+
+    def flush():
+        lookup.resolve([id.model_id for id, _ in chunk if id.model_id is not None])
+        for id, entry in chunk:
+            version_id = id.version_id or lookup.get_latest_version_id(
+                id.model_id)
+            if version_id is None:
+                yield (id, entry)
+            elif version_id in seen_version_ids:
+                print_verbose(
+                    f'Skipping source that downloads the same version (version id, {version_id}) as an earlier source: {id.original}')
+                if entry is not None:
+                    entry.set_state('done')
+                if id.model_id is not None:
+                    lookup.release(id.model_id)
+            else:
+                seen_version_ids.add(version_id)
+                yield (id, entry)
+        chunk.clear()
+
+    for source in sources:
+        chunk.append(source)
+        if len(chunk) >= _BULK_IDS_SIZE:
+            yield from flush()
+    yield from flush()
+
+
+def _prefetch(sources: Iterable[_Source], rootdir: str, batchOptions: BatchOptions, executor: Optional[concurrent.futures.Executor], lookup: Optional[MetadataLookup] = None) -> Iterator[Tuple[Id, Optional[JournalEntry], Optional[concurrent.futures.Future]]]:
+    """Yields every source with a future of its prepared model. The next prefetch_count models are prepared in the background while the current ones download."""
+    if executor is None:
+        for id, entry in sources:
+            yield (id, entry, None)
+        return
+
+    queue = deque()
+    try:
+        for id, entry in sources:
+            queue.append((id, entry, executor.submit(
+                _prepare_model, id, rootdir, batchOptions, entry, lookup, True)))
+            if len(queue) > batchOptions.prefetch_count:
+                yield queue.popleft()
+        while len(queue) > 0:
+            yield queue.popleft()
+    finally:
+        for _, _, future in queue:
+            future.cancel()
+
+
+def _download_model(id: Id, rootdir: str, batchOptions: BatchOptions, entry: Optional[JournalEntry] = None, prepared: Optional[concurrent.futures.Future] = None, lookup: Optional[MetadataLookup] = None, verifier: Optional[Verifier] = None) -> Tuple[_Status, Optional[Model]]:
+    """Downloads a single model, retrying up to retry_count times. Only the first attempt uses the prefetched model if one is provided.
+    If the model file is checked in the background by verifier, the entry is only done once _Verifications finishes it."""
+    iter = 0
+    while True:
+        try:
+            future, prepared = prepared, None
+            model = future.result() if future is not None else _prepare_model(
+                id, rootdir, batchOptions, entry, lookup, release=iter == 0)
+            with span('model', source=id.original) as s:
+                model.download(verifier=verifier)
+                s.set(skipped=model.skipped, bytes=model.downloaded_bytes)
+            if entry is not None and model.verification is None:
+                entry.set_state('done')
+            _pause(batchOptions.pause_time)
+            return ('skipped' if model.skipped else 'succeeded', model)
+        except Exception as e:
+            sprint('---------')
+            run_verbose(traceback.print_exc)
+            print_exc(e, '\n')
+            sprint('---------')
+            _pause(batchOptions.pause_time)
+            # if not isinstance(e, APIException):
+            #     break
+            if iter < batchOptions.retry_count:
+                sprint(Styler.stylize(
+                    'Retrying to download the current model...', color='info'))
+                iter += 1
+                inc('civitdl_retries_total', scope='model',
+                    reason=get_reason(e))
+            else:
+                sprint(Styler.stylize(
+                    f'Max retry of {batchOptions.retry_count} reached. Skipping the current model...', color='info'))
+                if entry is not None:
+                    entry.set_state('failed', f'{type(e).__name__}: {e}')
+                return ('failed', None)
+
+
+def _download_model_in_worker(index: int, id: Id, rootdir: str, batchOptions: BatchOptions, entry: Optional[JournalEntry] = None, prepared: Optional[concurrent.futures.Future] = None, lookup: Optional[MetadataLookup] = None, verifier: Optional[Verifier] = None) -> Tuple[_Status, Optional[Model]]:
+    set_print_prefix(Styler.stylize(f'[#{index}]', styles=['bold']))
+    batchOptions.scheduler.acquire()
+    try:
+        return _download_model(id, rootdir, batchOptions, entry, prepared, lookup, verifier)
+    finally:
+        batchOptions.scheduler.release()
+        set_print_prefix(None)
+
+
+class _Verifications:
+    """Models whose files are checked in the background by a Verifier. A model is only added to the summary, and done in the journal,
+    once its file matches. The models whose files do not match are returned by collect() to be downloaded again."""
+    __summary: _BatchSummary
+    __pending: List[Tuple[int, Id, Optional[JournalEntry], _Status, Model]]
+
+    def __init__(self, summary: _BatchSummary):
+        self.__summary = summary
+        self.__pending = []
+
+    def __len__(self):
+        return len(self.__pending)
+
+    def add(self, index: int, id: Id, entry: Optional[JournalEntry], status: _Status, model: Optional[Model]):
+        if model is None or model.verification is None:
+            self.__summary.add(status, model)
+        else:
+            self.__pending.append((index, id, entry, status, model))
+
+    def collect(self, wait: bool = False) -> List[Tuple[int, Id, Optional[JournalEntry]]]:
+        """Finishes the models whose files have been checked, or every model if wait is enabled. Returns the sources to download again, with their index in the batch."""
+        pending = []
+        redownloads = []
+        for index, id, entry, status, model in self.__pending:
+            if not wait and not model.verification.done():
+                pending.append((index, id, entry, status, model))
+                continue
+            matches = model.finish_verification()
+            self.__summary.add_verification(matches)
+            if matches:
+                if entry is not None:
+                    entry.set_state('done')
+                self.__summary.add(status, model)
+            else:
+                sprint(Styler.stylize(
+                    f'Downloading the model again: {id.original}', color='info'))
+                redownloads.append((index, id, entry))
+        self.__pending = pending
+        return redownloads
+
+
+def _get_sources(source_strings: List[str], journal: Optional[Journal], resume: bool) -> Iterator[_Source]:
+    """Yields every source. The sources are all parsed before the first one is yielded, so that a bad source
+    is reported before any model is downloaded. Parsing is cheap next to downloading."""
+    if journal is None:
+        for id in SourceManager().parse_src_all(source_strings):
+            yield (id, None)
+    else:
+        entries = journal.resume() if resume else journal.track(
+            SourceManager().parse_src_all(source_strings))
+        for entry in entries:
+            yield (entry.id, entry)
+
+
+def batch_download(source_strings: List[str], rootdir: str, batchOptions: BatchOptions, journal: Optional[Journal] = None, resume: bool = False):
+    """Batch downloads model from CivitAI. Up to max_concurrent_models models are downloaded at the same time,
+    while the metadata of the next prefetch_count models is fetched in the background.
+    Fewer models are downloaded at the same time while CivitAI is throttling requests (see AdaptiveScheduler).
+    The metadata of models is resolved in bulk, a chunk of sources at a time (see MetadataLookup).
+    In strict mode, model files that would have to be read back to be hashed are checked in the background while the next models download,
+    and models whose files do not match are downloaded again (see Verifier).
+
+    If journal is provided, the state of every source is recorded in it. If resume is enabled, only the entries of the journal
+    that are not done are downloaded, and source_strings is ignored."""
+
+    summary = _BatchSummary()
+    max_workers = batchOptions.max_concurrent_models
+    verifications = _Verifications(summary)
+    verifier = None
+    if batchOptions.strict_mode == '1':
+        verifier_workers = max(1, min(max_workers, os.cpu_count() or 1))
+        verifier = Verifier(verifier_workers, queue_size=2 * verifier_workers)
+
+    prefetcher = concurrent.futures.ThreadPoolExecutor(
+        max_workers=batchOptions.prefetch_count, thread_name_prefix='prefetch') if batchOptions.prefetch_count > 0 else None
+    lookup = MetadataLookup(session=batchOptions.session, cache_mode=batchOptions.metadata_cache,
+                            cache_ttl=batchOptions.metadata_cache_ttl)
+    sources = _prefetch(_resolve_in_bulk(_get_sources(source_strings, journal, resume), lookup),
+                        rootdir, batchOptions, prefetcher, lookup)
+
+    try:
+        if max_workers <= 1:
+            def redownload(redownloads: List[Tuple[int, Id, Optional[JournalEntry]]]):
+                # Downloaded again without the verifier, so a cached file that does not match is caught before it is placed.
+                # The source was already released from the lookup.
+                for index, id, entry in redownloads:
+                    verifications.add(index, id, entry, *_download_model(id, rootdir,
+                                      batchOptions, entry))
+
+            for index, (id, entry, prepared) in enumerate(sources, start=1):
+                verifications.add(index, id, entry, *_download_model(id, rootdir,
+                                  batchOptions, entry, prepared, lookup, verifier))
+                redownload(verifications.collect())
+            redownload(verifications.collect(wait=True))
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                pending: Dict[concurrent.futures.Future,
+                              Tuple[int, Id, Optional[JournalEntry]]] = {}
+
+                def submit(index: int, id: Id, entry: Optional[JournalEntry], prepared: Optional[concurrent.futures.Future] = None, verifier: Optional[Verifier] = None, lookup: Optional[MetadataLookup] = None):
+                    # Keep the position in the batch stable across resumes.
+                    if entry is not None:
+                        index = entry.position + 1
+                    pending[executor.submit(_download_model_in_worker, index, id, rootdir,
+                                            batchOptions, entry, prepared, lookup, verifier)] = (index, id, entry)
+
+                def redownload(redownloads: List[Tuple[int, Id, Optional[JournalEntry]]]):
+                    # Without the verifier and the lookup, as in the sequential loop.
+                    for index, id, entry in redownloads:
+                        submit(index, id, entry)
+
+                def wait_for_download():
+                    done, _ = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        index, id, entry = pending.pop(future)
+                        verifications.add(index, id, entry, *future.result())
+                    redownload(verifications.collect())
+
+                # Only submit as many models as there are workers so that sources are not queued up front.
+                try:
+                    for index, (id, entry, prepared) in enumerate(sources, start=1):
+                        if len(pending) >= max_workers:
+                            wait_for_download()
+                        submit(index, id, entry, prepared, verifier, lookup)
+                    while len(pending) > 0 or len(verifications) > 0:
+                        if len(pending) > 0:
+                            wait_for_download()
+                        else:
+                            redownload(verifications.collect(wait=True))
+                except BaseException as e:
+                    for future in pending:
+                        future.cancel()
+                    raise e
+    finally:
+        sources.close()
+        if prefetcher is not None:
+            prefetcher.shutdown(wait=False)
+        if verifier is not None:
+            verifier.shutdown(wait=False)
+
+    summary.throttled_seconds = batchOptions.scheduler.throttled_seconds
+    summary.throttled_responses = batchOptions.scheduler.throttled_responses
+    summary.print()
+    return summary
@@ -2,8 +2,7 @@
 
 import traceback
 
-from helpers.core.utils import disable_style, UnexpectedException, NotImplementedException, InputException, set_verbose, run_verbose, print_verbose, print_exc, sprint
-from helpers.cache import CacheHelper
+from helpers.core.utils import Validation, disable_style, UnexpectedException, NotImplementedException, InputException, set_verbose, run_verbose, print_verbose, print_exc, sprint
 from civitmisc.args.argparser import get_args
 
 # TODO: Make verbose and no_style similar to each other
@@ -24,10 +23,25 @@ def main():
         print_verbose(args)
 
         if subcommand == 'cache':
+            # Imported here so that --help does not wait on the cache and its database.
+            from helpers.cache import CacheHelper
+            if args['jobs'] is not None:
+                Validation.validate_integer(args['jobs'], 'jobs', min_value=1)
             if args['scan_model']:
-                CacheHelper.scan_models(args['scan_model'])
+                CacheHelper.scan_models(
+                    args['scan_model'], max_workers=args['jobs'])
             else:
                 raise InputException('Cache option not provided.')
+        elif subcommand == 'store':
+            # Imported here so that --help does not wait on the store and its database.
+            from helpers.store import Store
+            from civitconfig.data.configmanager import ConfigManager
+            store_dir = args['store_dir'] or ConfigManager().getDefault().get('store_dir', None)
+            if args['store_subcommand'] == 'gc':
+                Store.open(store_dir).gc(dry_run=args['dry_run'] == True)
+            else:
+                raise UnexpectedException(
+                    'Unknown store subcommand not caught by argparse')
         else:
             raise UnexpectedException(
                 'Unknown subcommand not caught by argparse')
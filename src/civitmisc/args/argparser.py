@@ -4,8 +4,7 @@ from typing import Dict, List, Union
 
 import argparse
 
-from helpers.core.utils import get_version
-from helpers.argparse import PwdAction, ConfirmAction, ColoredArgParser, BooleanOptionalAction
+from helpers.argparse import PwdAction, ConfirmAction, ColoredArgParser, BooleanOptionalAction, VersionAction
 
 __all__ = ['get_args']
 
@@ -17,7 +16,7 @@ def add_shared_option(par):
     par.add_argument(
         '--verbose', action=BooleanOptionalAction, help='Prints out traceback and other useful information.')
     par.add_argument(
-        '-v', '--version', action='version', version=f'civitdl v{get_version()}', help='Prints out the version of the program.'
+        '-v', '--version', action=VersionAction, help='Prints out the version of the program.'
     )
 
 
@@ -31,15 +30,32 @@ parser = ColoredArgParser(
 subparsers = parser.add_subparsers(
     dest='subcommand',
     required=True,
-    help='Choose one of the following subcommands: cache.')
+    help='Choose one of the following subcommands: cache, store.')
 
 cache_parser = subparsers.add_parser(
     'cache', help='Cache-related tasks. Currently cache stores file path to models and hashes. The purpose of cache is to ensure the same model is not repeatly downloaded if it already exists locally.')
 
 cache_parser.add_argument('-s', '--scan-model', metavar='DIRPATH', type=str,
                           help='Scans a directory recursively to add path to model files with matching filename to cache.')
+cache_parser.add_argument('-j', '--jobs', metavar='INT', type=int,
+                          help='Number of model files hashed at the same time by --scan-model. Defaults to the number of CPUs. Use 1 for hard drives, where parallel reads are slower.')
 add_shared_option(cache_parser)
 
+store_parser = subparsers.add_parser(
+    'store', help='Store-related tasks. The store keeps a single copy of every model file downloaded with --store-mode 1, linked from every root directory it is downloaded to.')
+store_subparsers = store_parser.add_subparsers(
+    dest='store_subcommand',
+    required=True,
+    help='Choose one of the following subcommands: gc.')
+
+store_gc_parser = store_subparsers.add_parser(
+    'gc', help='Removes model files from the store that are no longer linked from any root directory.')
+store_gc_parser.add_argument('--store-dir', metavar='DIRPATH', type=str,
+                             help='Directory of the store. Defaults to the default store directory set with civitconfig, or the store directory in the user cache directory.')
+store_gc_parser.add_argument('--dry-run', action=BooleanOptionalAction,
+                             help='Prints what would be removed without removing anything.')
+add_shared_option(store_gc_parser)
+
 
 def get_args():
     parser_result = parser.parse_args()
@@ -10,7 +10,7 @@ try:
 except:
     None
 
-from helpers.core.utils import Styler
+from helpers.core.utils import Styler, get_version
 
 
 def windows_getpass(prompt=""):
@@ -144,3 +144,16 @@ class ConfirmAction(BooleanOptionalAction):
             parser.error(f"Reset declined. Exiting.")
 
         super().__call__(parser, namespace, value, option_string)
+
+
+class VersionAction(argparse.Action):
+    """Prints the version of civitdl and exits. The version is only looked up when the option is used, as reading the metadata of
+    installed packages slows down the start of every command."""
+
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, default=argparse.SUPPRESS, help=None):
+        super().__init__(option_strings=option_strings,
+                         dest=dest, default=default, nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        parser._print_message(f'civitdl v{get_version()}\n', sys.stdout)
+        parser.exit()
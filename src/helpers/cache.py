@@ -1,80 +1,153 @@
 
 import os
-import math
 import csv
 import re
-from typing import Dict, Union
+import time
+import hashlib
+import threading
+import concurrent.futures
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 
-from helpers.core.utils import Styler, print_newlines, print_verbose, sprint
+from helpers.core.utils import Styler, get_progress_bar, getDate, print_newlines, print_verbose, sprint
 from helpers.core.constants import app_dirs
+from helpers.core.database import Database
 from helpers.core.iohelper import IOHelper
 
 # TODO: Watch out for edge cases where one of the hash is empty.
 # { '123456': { 'model_filepath': 'path', 'SHA256': 'hash1', 'BLAKE3': 'hash2' } }
 
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS models (
+        version_id TEXT PRIMARY KEY,
+        model_filepath TEXT NOT NULL,
+        SHA256 TEXT NOT NULL DEFAULT '',
+        BLAKE3 TEXT NOT NULL DEFAULT ''
+    )""",
+    'CREATE INDEX IF NOT EXISTS models_SHA256 ON models (SHA256)',
+    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)',
+    # Size, modification time and inode of every model file hashed by CacheHelper.scan_models, so that unchanged files are not hashed again.
+    """CREATE TABLE IF NOT EXISTS fingerprints (
+        model_filepath TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        inode INTEGER NOT NULL,
+        SHA256 TEXT NOT NULL
+    )"""
+]
+
+_UPSERT_SQL = 'INSERT OR REPLACE INTO models (version_id, model_filepath, SHA256, BLAKE3) VALUES (?, ?, ?, ?)'
+_UPSERT_FINGERPRINT_SQL = 'INSERT OR REPLACE INTO fingerprints (model_filepath, size, mtime_ns, inode, SHA256) VALUES (?, ?, ?, ?, ?)'
+
+_db = None
+_db_lock = threading.Lock()
+
+
+def _migrate_from_csv(db: Database):
+    """Imports the csv files used by older versions of civitdl (one file per 100 version ids) into the database. Only runs once."""
+    if db.fetchone("SELECT value FROM meta WHERE key = 'csv_migrated'") is not None:
+        return
+
+    csv_dirpath = os.path.join(app_dirs.user_cache_dir, 'hashes')
+    rows = []
+    if os.path.isdir(csv_dirpath):
+        for root, _, filenames in os.walk(csv_dirpath):
+            for filename in filenames:
+                if not filename.endswith('.csv'):
+                    continue
+                filepath = os.path.join(root, filename)
+                try:
+                    with open(filepath, 'r', encoding='UTF-8') as f:
+                        csv_reader = csv.reader(f)
+                        next(csv_reader, None)
+                        for row in csv_reader:
+                            if len(row) < 2 or row[1] == '':
+                                continue
+                            row = (row + ['', ''])[0:4]
+                            rows.append(tuple(row))
+                except Exception as e:
+                    sprint(Styler.stylize(
+                        f'Unable to migrate cache file "{filepath}": {e}', color='warning'))
+
+    with db.transaction() as conn:
+        # Entries already in the database are newer than the ones in the csv files.
+        conn.executemany(_UPSERT_SQL.replace(
+            'INSERT OR REPLACE', 'INSERT OR IGNORE'), rows)
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('csv_migrated', ?)", (getDate(),))
+
+    if len(rows) > 0:
+        sprint(Styler.stylize(
+            f'Migrated {len(rows)} cached models from "{csv_dirpath}" to "{db.filepath}".', color='info'))
+
+
+def _get_db() -> Database:
+    global _db
+    with _db_lock:
+        if _db is None:
+            db = Database(os.path.join(
+                app_dirs.user_cache_dir, 'hashes.db'), _SCHEMA)
+            _migrate_from_csv(db)
+            _db = db
+    return _db
+
+
+def _row_to_hash_dict(row: tuple) -> Dict:
+    return {
+        'model_filepath': row[0],
+        'SHA256': row[1],
+        'BLAKE3': row[2]
+    }
+
 
 class Cache:
-    __CACHE_COLUMNS = ['volume_id', 'model_filepath', 'SHA256', 'BLAKE3']
+    """Stores the local file path and hashes of downloaded models by version id in a SQLite database under the user cache directory."""
     __version_id: str
-    __filepath: str
-    __hashes_dict: Dict
+    __hash_dict: Union[None, Dict]
 
     def __init__(self, version_id: str):
-        self.__version_id = version_id
-        version_id_num = int(version_id)
-
-        dirpath = os.path.join(app_dirs.user_cache_dir,
-                               'hashes', str(math.floor(version_id_num / 10000)))
-        print_verbose(dirpath)
-        filenum = math.floor(version_id_num / 100)
-        filename = f'{filenum}.csv'
-        self.__filepath = os.path.join(dirpath, filename)
-        if not os.path.isfile(self.__filepath):
-            os.makedirs(os.path.dirname(self.__filepath), exist_ok=True)
-            with open(self.__filepath, 'w', encoding='UTF-8') as file:
-                csv_writer = csv.writer(file)
-                csv_writer.writerow(self.__CACHE_COLUMNS)
-
-        self.__hashes_dict = self.__read_from_csv()
-
-    def __read_from_csv(self):
-        hashes_dict = {}
-        with open(self.__filepath, 'r', encoding='UTF-8') as f:
-            csv_reader = csv.reader(f)
-            next(csv_reader)
-            for row in csv_reader:
-                if row == []:
-                    continue
-                hashes_dict[row[0]] = {
-                    'model_filepath': row[1],
-                    'SHA256': row[2],
-                    'BLAKE3': row[3]
-                }
-        return hashes_dict
-
-    def __write_to_csv(self):
-        with open(self.__filepath, 'w', encoding='UTF-8') as f:
-            csv_writer = csv.writer(f)
-            csv_writer.writerow(
-                self.__CACHE_COLUMNS)
-            for key, value in self.__hashes_dict.items():
-                csv_writer.writerow([
-                    key,
-                    value.get('model_filepath', ''),
-                    value.get('SHA256', ''),
-                    value.get('BLAKE3', '')
-                ])
+        self.__version_id = str(int(version_id))
+        row = _get_db().fetchone(
+            'SELECT model_filepath, SHA256, BLAKE3 FROM models WHERE version_id = ?', (self.__version_id,))
+        self.__hash_dict = _row_to_hash_dict(row) if row else None
+
+    @staticmethod
+    def __to_row(version_id: str, model_filepath: str, hashes: Dict[str, str]) -> Tuple:
+        return (
+            str(version_id),
+            os.path.abspath(model_filepath),
+            hashes.get('SHA256', '') or '',
+            hashes.get('BLAKE3', '') or ''
+        )
 
     def __get_hash_dict(self) -> Union[None, Dict]:
-        return self.__hashes_dict.get(self.__version_id)
+        return self.__hash_dict
 
     def set_local_model_cache(self, model_filepath: str, hashes: Dict[str, str]) -> None:
-        self.__hashes_dict[self.__version_id] = {
-            'model_filepath': os.path.abspath(model_filepath),
-            'SHA256': hashes.get('SHA256', ''),
-            'BLAKE3': hashes.get('BLAKE3', '')
-        }
-        self.__write_to_csv()
+        row = self.__to_row(self.__version_id, model_filepath, hashes)
+        _get_db().execute(_UPSERT_SQL, row)
+        self.__hash_dict = _row_to_hash_dict(row[1:])
+
+    @classmethod
+    def set_local_model_caches(cls, entries: Iterable[Tuple[str, str, Dict[str, str]]], fingerprints: Iterable[Tuple[str, int, int, int, str]] = ()) -> None:
+        """Caches many models in a single transaction. Each entry is a tuple of (version_id, model_filepath, hashes).
+        Each fingerprint is a tuple of (model_filepath, size, mtime_ns, inode, SHA256) of a model file that was hashed."""
+        with _get_db().transaction() as conn:
+            conn.executemany(_UPSERT_SQL, [cls.__to_row(*entry)
+                                           for entry in entries])
+            conn.executemany(_UPSERT_FINGERPRINT_SQL, [(os.path.abspath(filepath), *fingerprint)
+                                                       for filepath, *fingerprint in fingerprints])
+
+    @staticmethod
+    def get_all_hash_dicts() -> Dict[str, Dict]:
+        """Returns the hash dict of every cached model by version id, in a single query."""
+        return {version_id: _row_to_hash_dict(row) for version_id, *row in _get_db().fetchall(
+            'SELECT version_id, model_filepath, SHA256, BLAKE3 FROM models')}
+
+    @staticmethod
+    def get_fingerprints() -> Dict[str, Tuple[int, int, int, str]]:
+        """Returns the (size, mtime_ns, inode, SHA256) of every model file hashed by a scan, by file path."""
+        return {filepath: tuple(fingerprint) for filepath, *fingerprint in _get_db().fetchall(
+            'SELECT model_filepath, size, mtime_ns, inode, SHA256 FROM fingerprints')}
 
     def get_local_model_path(self) -> Union[None, str]:
         hash_dict = self.__get_hash_dict()
@@ -97,51 +170,205 @@ class Cache:
             if hash != '':
                 return hash
 
+    @staticmethod
+    def get_local_model_path_by_SHA256(sha256_hash: str) -> Union[None, str]:
+        """Returns the path of any cached model file with the given SHA256 hash that still exists, regardless of version id."""
+        if not sha256_hash:
+            return None
+        for (filepath,) in _get_db().fetchall('SELECT model_filepath FROM models WHERE SHA256 = ?', (sha256_hash.upper(),)):
+            if os.path.isfile(filepath):
+                return filepath
+        return None
 
-class CacheHelper:
-    @classmethod
-    def scan_models(cls, dir_path: str):
-        data = {}
-        regex = re.compile(
-            r'mid_\d+-vid_(?P<vid>\d+)(?![\w.-]*(csv|txt|png|jpeg|jpg|json))')
 
-        for root, _, filenames in os.walk(dir_path, followlinks=True):
+_METADATA_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS responses (
+        url TEXT PRIMARY KEY,
+        etag TEXT,
+        fetched_at REAL NOT NULL,
+        body TEXT NOT NULL
+    )"""
+]
+
+_metadata_db = None
+
+
+def _get_metadata_db() -> Database:
+    global _metadata_db
+    with _db_lock:
+        if _metadata_db is None:
+            _metadata_db = Database(os.path.join(
+                app_dirs.user_cache_dir, 'metadata.db'), _METADATA_SCHEMA)
+    return _metadata_db
+
+
+class MetadataCache:
+    """Stores the body and ETag of CivitAI API responses by url in a SQLite database under the user cache directory."""
+
+    @staticmethod
+    def get(url: str) -> Union[None, Dict]:
+        """Returns a dict with the etag, fetched_at (unix time) and body of the cached response, or None if url is not cached."""
+        row = _get_metadata_db().fetchone(
+            'SELECT etag, fetched_at, body FROM responses WHERE url = ?', (url,))
+        if row is None:
+            return None
+        return {'etag': row[0], 'fetched_at': row[1], 'body': row[2]}
+
+    @staticmethod
+    def set(url: str, etag: Union[None, str], body: str) -> None:
+        _get_metadata_db().execute(
+            'INSERT OR REPLACE INTO responses (url, etag, fetched_at, body) VALUES (?, ?, ?, ?)', (url, etag, time.time(), body))
+
+    @staticmethod
+    def touch(url: str) -> None:
+        """Marks the cached response as fresh, after the server confirmed it has not changed."""
+        _get_metadata_db().execute(
+            'UPDATE responses SET fetched_at = ? WHERE url = ?', (time.time(), url))
+
+
+_MODEL_FILENAME_REGEX = re.compile(
+    r'mid_\d+-vid_(?P<vid>\d+)(?![\w.-]*(csv|txt|png|jpeg|jpg|json))')
+# Written next to every model by civitdl, with the hashes of the model.
+_HASH_FILENAME_REGEX = re.compile(r'-mid_\d+-vid_(?P<vid>\d+)\.csv$')
+
+
+def _get_fingerprint(stat: os.stat_result) -> Tuple[int, int, int]:
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+class CacheHelper:
+    @staticmethod
+    def __find_files(dir_path: str) -> Tuple[Dict[str, List[str]], Dict[str, str]]:
+        """Returns the paths of model files by version id, in the order they were found, and the path of a hash file by version id."""
+        model_filepaths: Dict[str, List[str]] = {}
+        hash_filepaths: Dict[str, str] = {}
+        for root, dirnames, filenames in os.walk(dir_path, followlinks=True):
+            # Partially downloaded models, and models that did not match their hash.
+            dirnames[:] = [dirname for dirname in dirnames
+                           if dirname not in ('.tmp', '.quarantine')]
             for filename in filenames:
                 filepath = os.path.join(root, filename)
-                reg_res = regex.search(filepath)
+                hash_res = _HASH_FILENAME_REGEX.search(filename)
+                if hash_res:
+                    hash_filepaths.setdefault(
+                        str(int(hash_res.group('vid'))), filepath)
+                    continue
+                reg_res = _MODEL_FILENAME_REGEX.search(filepath)
                 if reg_res:
-                    vid = str(reg_res.group('vid'))
-                    if vid in data:
-                        continue  # already added vid to cache
-                    cache = Cache(version_id=vid)
-                    hash = cache.get_SHA256_hash()
-                    hash_dict = None
-
-                    if hash is None:
-                        csv_filename = os.path.splitext[0] + '.csv'
-                        csv_filepath = os.path.join(
-                            os.path.dirname(filepath), csv_filename)
-
-                        if os.path.exists(csv_filepath):
-                            hash_dict = IOHelper.read_dict_from_csv(
-                                csv_filepath)
-                            hash = hash_dict.get('SHA256', None)
-
-                    if hash is None:
-                        print_newlines(Styler.stylize(
-                            f"""SHA256 hash for the file path below was not found. Proceeding to skip file to protect against corruption.
-                                - File Path: {filepath}
-                            """, color='warning'))
-                    elif IOHelper.compare_hash(filepath, hash):
-                        if hash_dict is None:
-                            hash_dict = cache.get_hash_dict()
-                        cache.set_local_model_cache(
-                            filepath, hash_dict if hash_dict else {})
+                    model_filepaths.setdefault(
+                        str(int(reg_res.group('vid'))), []).append(filepath)
+        return model_filepaths, hash_filepaths
+
+    @staticmethod
+    def __read_hash_file(filepath: str) -> Dict[str, str]:
+        try:
+            return IOHelper.read_dict_from_csv(filepath)
+        except Exception as e:
+            print_verbose(f'Unable to read hash file "{filepath}": {e}')
+            return {}
+
+    @classmethod
+    def scan_models(cls, dir_path: str, max_workers: Optional[int] = None):
+        """Adds the model files under dir_path to the cache, by the version id in their file name, if their SHA256 hash matches the hash
+        in the cache or in the hash file downloaded with the model.
+
+        Files are hashed max_workers at a time (the number of CPUs by default), as hashing releases the GIL.
+        The size, modification time and inode of every hashed file are recorded, so that files that did not change since the last scan
+        are not hashed again. The cache is updated in a single transaction once every file is hashed."""
+        max_workers = max_workers or os.cpu_count() or 1
+        model_filepaths, hash_filepaths = cls.__find_files(dir_path)
+        hash_dicts = Cache.get_all_hash_dicts()
+        fingerprints = Cache.get_fingerprints()
+
+        entries = []
+        new_fingerprints = []
+        unchanged = 0
+        failed: List[str] = []
+        # Version id: (file path, expected hash, hashes, stat) of the candidates to hash, in order. The next one is only hashed if the previous one does not match.
+        pending: Dict[str, List[Tuple[str, str, Dict, os.stat_result]]] = {}
+
+        for vid, filepaths in model_filepaths.items():
+            hash_dict = hash_dicts.get(vid)
+            hash = hash_dict.get('SHA256') if hash_dict else None
+            if not hash and vid in hash_filepaths:
+                hash_dict = cls.__read_hash_file(hash_filepaths[vid])
+                hash = hash_dict.get('SHA256')
+            if not hash:
+                for filepath in filepaths:
+                    print_newlines(Styler.stylize(
+                        f"""SHA256 hash for the file path below was not found. Proceeding to skip file to protect against corruption.
+                            - File Path: {filepath}
+                        """, color='warning'))
+                continue
+            hash = hash.upper()
+
+            candidates = []
+            for filepath in filepaths:
+                try:
+                    stat = os.stat(filepath)
+                except OSError as e:
+                    print_verbose(f'Unable to read "{filepath}": {e}')
+                    continue
+                if fingerprints.get(os.path.abspath(filepath)) == (*_get_fingerprint(stat), hash):
+                    candidates = []
+                    unchanged += 1
+                    if hash_dicts.get(vid, {}).get('model_filepath') != os.path.abspath(filepath):
+                        entries.append((vid, filepath, hash_dict))
+                    break
+                candidates.append((filepath, hash, hash_dict, stat))
+            if len(candidates) > 0:
+                pending[vid] = candidates
+
+        progress_bar = get_progress_bar(
+            sum(candidates[0][3].st_size for candidates in pending.values()), 'Hashing')
+        progress_lock = threading.Lock()
+
+        def update_progress_bar(bytes_read: int):
+            with progress_lock:
+                progress_bar.update(bytes_read)
+
+        def hash_file(filepath: str):
+            return IOHelper.update_hasher(hashlib.sha256(), filepath, update_progress_bar).hexdigest().upper()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='scan') as executor:
+            futures = {executor.submit(hash_file, candidates[0][0]): vid
+                       for vid, candidates in pending.items()}
+            while len(futures) > 0:
+                done, _ = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    vid = futures.pop(future)
+                    filepath, hash, hash_dict, stat = pending[vid].pop(0)
+                    try:
+                        digest = future.result()
+                    except OSError as e:
+                        print_verbose(f'Unable to hash "{filepath}": {e}')
+                        digest = None
+
+                    if digest == hash:
+                        entries.append((vid, filepath, hash_dict))
+                        new_fingerprints.append(
+                            (filepath, *_get_fingerprint(stat), digest))
                         print_verbose(Styler.stylize(
                             f'File path added to cache: {filepath}', color='info'))
-                        data[vid] = filepath
-                    else:
-                        print_newlines(Styler.stylize(
-                            f"""SHA256 hash for the file path below is incorrect. Proceeding to skip file to protect against corruption.
-                                - File Path: {filepath}
-                            """, color='warning'))
+                        continue
+
+                    failed.append(filepath)
+                    print_newlines(Styler.stylize(
+                        f"""SHA256 hash for the file path below is incorrect. Proceeding to skip file to protect against corruption.
+                            - File Path: {filepath}
+                        """, color='warning'))
+                    # Try the next file with the same version id.
+                    if len(pending[vid]) > 0:
+                        with progress_lock:
+                            progress_bar.total += pending[vid][0][3].st_size
+                        futures[executor.submit(
+                            hash_file, pending[vid][0][0])] = vid
+        progress_bar.close()
+
+        Cache.set_local_model_caches(entries, new_fingerprints)
+        color = 'warning' if len(failed) > 0 else 'success'
+        print_newlines(Styler.stylize(f"""Scan summary:
+                - Models added to cache: {len(new_fingerprints)}
+                - Unchanged since the last scan: {unchanged}
+                - Corrupted or unreadable: {len(failed)}""", color=color))
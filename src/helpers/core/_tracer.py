@@ -0,0 +1,110 @@
+from json import dumps
+import threading
+import time
+from typing import Dict, List, Optional, TextIO
+
+
+class Span:
+    """Timing of a single phase. Fields set on it while it is open, such as bytes, are written with it."""
+    phase: str
+    fields: Dict
+
+    def __init__(self, phase: str, fields: Dict):
+        self.phase = phase
+        self.fields = fields
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self):
+        self.__start_time = time.time()
+        self.__start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.__start
+        if exc_value is not None:
+            self.fields['error'] = type(exc_value).__name__
+        _record(self, self.__start_time, seconds)
+        return False
+
+
+class _NoopSpan:
+    def set(self, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+_trace_file: Optional[TextIO] = None
+_durations: Dict[str, List[float]] = {}
+_bytes: Dict[str, int] = {}
+_lock = threading.Lock()
+
+
+def set_trace_file(filepath: Optional[str]):
+    """Starts writing every span to filepath as a line of JSON, and collecting their durations for get_trace_summary(). Stops tracing if filepath is None."""
+    global _trace_file
+    with _lock:
+        if _trace_file is not None:
+            _trace_file.close()
+        _trace_file = open(filepath, 'a', encoding='UTF-8',
+                           buffering=1) if filepath is not None else None
+        _durations.clear()
+        _bytes.clear()
+
+
+def is_tracing():
+    return _trace_file is not None
+
+
+def span(phase: str, **fields):
+    """Times the phase in a with block. Does nothing unless tracing with set_trace_file().
+
+    Example:
+        with span('model.download', version_id=version_id) as s:
+            ...
+            s.set(bytes=size)
+    """
+    if _trace_file is None:
+        return _NOOP_SPAN
+    return Span(phase, fields)
+
+
+def _record(span: Span, start_time: float, seconds: float):
+    with _lock:
+        if _trace_file is None:
+            return
+        _durations.setdefault(span.phase, []).append(seconds)
+        _bytes[span.phase] = _bytes.get(span.phase, 0) + \
+            span.fields.get('bytes', 0)
+        _trace_file.write(dumps({'phase': span.phase, 'start': round(start_time, 6), 'seconds': round(seconds, 6),
+                                 'thread': threading.current_thread().name, **span.fields}, default=str) + '\n')
+
+
+def _percentile(sorted_values: List[float], percentile: float):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percentile))]
+
+
+def get_trace_summary() -> Optional[str]:
+    """Returns a table of the count, total, p50 and p95 of the durations of each phase traced so far, or None if nothing was traced."""
+    with _lock:
+        durations = {phase: sorted(values)
+                     for phase, values in _durations.items()}
+        total_bytes = dict(_bytes)
+    if len(durations) == 0:
+        return None
+
+    lines = [
+        f'{"Phase":<20} {"Count":>7} {"Total s":>9} {"p50 s":>9} {"p95 s":>9} {"MB":>10}']
+    for phase in sorted(durations, key=lambda phase: -sum(durations[phase])):
+        values = durations[phase]
+        lines.append(f'{phase:<20} {len(values):>7} {sum(values):>9.3f} {_percentile(values, 0.5):>9.3f} '
+                     f'{_percentile(values, 0.95):>9.3f} {total_bytes.get(phase, 0) / 10**6:>10.1f}')
+    return '\n'.join(lines)
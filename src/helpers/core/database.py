@@ -0,0 +1,96 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Iterable, List, Optional, Sequence, Set
+
+from .utils import print_verbose
+
+
+class Database:
+    """SQLite database in WAL mode that may be shared between threads. Each thread gets its own connection, and the schema is created on first use."""
+    __filepath: str
+    __schema: List[str]
+    __conns: Set[sqlite3.Connection]
+    """Open connections of every thread, so that close_all() can close them."""
+
+    def __init__(self, filepath: str, schema: List[str]):
+        self.__filepath = filepath
+        self.__schema = schema
+        self.__local = threading.local()
+        self.__init_lock = threading.Lock()
+        self.__initialized = False
+        self.__conns = set()
+        self.__conns_lock = threading.Lock()
+
+    @property
+    def filepath(self):
+        return self.__filepath
+
+    def connect(self) -> sqlite3.Connection:
+        conn = getattr(self.__local, 'conn', None)
+        if conn is not None:
+            with self.__conns_lock:
+                # Unless close_all() closed it since.
+                if conn in self.__conns:
+                    return conn
+
+        os.makedirs(os.path.dirname(self.__filepath), exist_ok=True)
+        # Each connection is only used by its own thread, but may be closed by another one in close_all().
+        conn = sqlite3.connect(
+            self.__filepath, timeout=30, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+
+        with self.__init_lock:
+            if not self.__initialized:
+                print_verbose(f'Opening database at "{self.__filepath}"')
+                with conn:
+                    for statement in self.__schema:
+                        conn.execute(statement)
+                self.__initialized = True
+
+        self.__local.conn = conn
+        with self.__conns_lock:
+            self.__conns.add(conn)
+        return conn
+
+    def close(self):
+        """Closes the connection of the current thread."""
+        conn = getattr(self.__local, 'conn', None)
+        if conn is not None:
+            with self.__conns_lock:
+                self.__conns.discard(conn)
+            conn.close()
+            self.__local.conn = None
+
+    def close_all(self):
+        """Closes the connections of every thread, e.g. before deleting the database. Threads that use the database afterwards open a new connection.
+        Must not be called while another thread is using its connection."""
+        with self.__conns_lock:
+            conns = list(self.__conns)
+            self.__conns.clear()
+        for conn in conns:
+            conn.close()
+        self.__local.conn = None
+
+    @contextmanager
+    def transaction(self):
+        """Commits every statement executed on the yielded connection at once, or none of them if an exception is raised."""
+        conn = self.connect()
+        with conn:
+            yield conn
+
+    def fetchone(self, sql: str, params: Sequence = ()) -> Optional[tuple]:
+        return self.connect().execute(sql, params).fetchone()
+
+    def fetchall(self, sql: str, params: Sequence = ()) -> List[tuple]:
+        return self.connect().execute(sql, params).fetchall()
+
+    def execute(self, sql: str, params: Sequence = ()):
+        with self.transaction() as conn:
+            conn.execute(sql, params)
+
+    def executemany(self, sql: str, params_list: Iterable[Sequence]):
+        with self.transaction() as conn:
+            conn.executemany(sql, params_list)
@@ -1,13 +1,15 @@
 import os
 import shutil
 import sys
-import time
 import csv
+import errno
 import hashlib
-from typing import IO, Callable, Iterable, List, Union
+from typing import IO, Callable, Iterable, List, TypeVar, Union
 
-from ._ui.styler import Styler, InputException, UnexpectedException
-from .utils import get_progress_bar, print_verbose, sprint
+from ._ui.styler import Styler, InputException, ResourcesException, UnexpectedException
+from .utils import get_progress_bar, print_verbose, span, sprint
+
+T = TypeVar('T')
 
 
 class IOHelper:
@@ -29,38 +31,83 @@ class IOHelper:
                     f"Error deleting file {file_path}: {e}")
 
     @staticmethod
-    def write_contents(file: IO, content_chunks: Iterable, limit_rate: Union[int, None] = None, update_pb: Union[Callable[[int], None], None] = None):
-        last_chunk_time = time.perf_counter()
+    def get_temp_filepath(filepath):
+        """Returns the path that write_to_file writes to before moving the file to filepath."""
+        return os.path.join(os.path.dirname(filepath), '.tmp', os.path.basename(filepath))
+
+    @staticmethod
+    def move_over(src: str, dst: str):
+        """Moves src to dst. If dst is a link (e.g. a model placed from the store), it is unlinked first,
+        so that moving never writes through it into the file it links to."""
+        if os.path.islink(dst) or (os.path.isfile(dst) and os.stat(dst).st_nlink > 1):
+            os.remove(dst)
+        shutil.move(src, dst)
+
+    @staticmethod
+    def preallocate_file(filepath, size: int):
+        """Creates filepath with size bytes so that it can be written to at any offset. Disk space is reserved up front where the OS supports it."""
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'wb') as file:
+            file.truncate(size)
+            if hasattr(os, 'posix_fallocate') and size > 0:
+                try:
+                    os.posix_fallocate(file.fileno(), 0, size)
+                except OSError as e:
+                    print_verbose(f'Unable to preallocate "{filepath}": {e}')
+
+    @staticmethod
+    def remove_dir_if_empty(dirpath):
+        """Removes dirpath only if it is empty, as other downloads may still be writing to it."""
+        try:
+            os.rmdir(dirpath)
+        except OSError:
+            None
+
+    @staticmethod
+    def create_in_dir(create: Callable[[], T], dirpath: str) -> T:
+        """Creates dirpath and returns create(), which creates a file in it. dirpath is created again if another thread removed it
+        with remove_dir_if_empty() in between, as temp directories are shared by every file written to the same directory."""
+        for _ in range(3):
+            os.makedirs(dirpath, exist_ok=True)
+            try:
+                return create()
+            except FileNotFoundError as e:
+                if os.path.isdir(dirpath):
+                    raise e
+        os.makedirs(dirpath, exist_ok=True)
+        return create()
+
+    @staticmethod
+    def write_contents(file: IO, content_chunks: Iterable, limiter=None, update_pb: Union[Callable[[int], None], None] = None, hasher=None):
+        """Writes each chunk to file. If limiter (e.g. helpers.core.ratelimiter.RateLimiter) is provided, each chunk is paid for with limiter.consume() before being written.
+        If hasher (e.g. hashlib.sha256()) is provided, it is updated with each chunk as it is written."""
         for content in content_chunks:
-            file.write(content)
             bytes_downloaded = len(content)
+            if limiter is not None:
+                limiter.consume(bytes_downloaded)
 
-            download_time = time.perf_counter() - last_chunk_time
-            speed = bytes_downloaded / \
-                download_time if download_time != 0 else float('inf')
-            if limit_rate is not None and limit_rate != 0 and speed > limit_rate:
-                time_to_sleep = (bytes_downloaded / limit_rate) - download_time
-                if time_to_sleep > 0:
-                    time.sleep(time_to_sleep)
+            file.write(content)
+            if hasher is not None:
+                hasher.update(content)
 
             if update_pb:
                 update_pb(bytes_downloaded)
-            last_chunk_time = time.perf_counter()
 
     @staticmethod
     def read_dict_from_csv(filepath: str):
         csv_dict = {}
 
         with open(filepath, 'r', encoding='UTF-8') as f:
-            csv_iterator = csv.reader(f)
+            # Hash files are written with a space after each comma.
+            csv_iterator = csv.reader(f, skipinitialspace=True)
             next(csv_iterator)
             for row in csv_iterator:
-                try:
-                    row[2]
+                if len(row) == 0:
+                    continue
+                if len(row) != 2:
                     raise InputException(
-                        f'CSV file is invalid. File contains rows with more than two columns.\nThe filepath for the invalid csv is "{filepath}"')
-                except:
-                    csv_dict[row[0]] = row[1]
+                        f'CSV file is invalid. File contains rows that do not have two columns.\nThe filepath for the invalid csv is "{filepath}"')
+                csv_dict[row[0].strip()] = row[1].strip()
 
         return csv_dict
 
@@ -69,29 +116,147 @@ class IOHelper:
     #     return {}
 
     @staticmethod
-    def compare_hash(filepath: str, hash: str):
-        hasher = hashlib.sha256()
-        chunk_size = 2**20
+    def update_hasher(hasher, filepath: str, update_pb: Union[Callable[[int], None], None] = None):
+        """Updates hasher with the content of filepath, read in large chunks into a single reused buffer. update_pb is called with the size of each chunk."""
+        buffer = bytearray(8 * 2**20)
+        view = memoryview(buffer)
 
-        with open(filepath, 'rb') as file:
+        with open(filepath, 'rb', buffering=0) as file:
             while True:
-                chunk = file.read(chunk_size)
-                if not chunk:
+                size = file.readinto(buffer)
+                if not size:
                     break
-                hasher.update(chunk)
+                hasher.update(view[:size])
+                if update_pb:
+                    update_pb(size)
+
+        return hasher
 
-        digest = hasher.hexdigest().upper()
+    @classmethod
+    def get_hash(cls, filepath: str) -> str:
+        """Returns the uppercase SHA256 hex digest of filepath."""
+        with span('io.hash', path=filepath) as s:
+            s.set(bytes=os.path.getsize(filepath))
+            return cls.update_hasher(hashlib.sha256(), filepath).hexdigest().upper()
+
+    @classmethod
+    def compare_hash(cls, filepath: str, hash: str):
+        digest = cls.get_hash(filepath)
         print_verbose(f'Computed SHA256: "{digest}", Expected SHA256: "{hash}"')  # nopep8
         return digest == hash
 
+    @staticmethod
+    def reflink(src: str, dst: str):
+        """Creates dst as a copy-on-write clone of src (btrfs, XFS, APFS). Raises OSError if the filesystem does not support it."""
+        if sys.platform.startswith('linux'):
+            import fcntl
+            FICLONE = 0x40049409
+            with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        elif sys.platform == 'darwin':
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            if libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) != 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+        else:
+            raise OSError(errno.ENOTSUP, 'Reflink is not supported on this platform')
+
+    @staticmethod
+    def copy_in_kernel(src: str, dst: str) -> str:
+        """Copies src to dst without passing the bytes through user space where possible. Returns the method that was used."""
+        method = None
+        if hasattr(os, 'copy_file_range'):
+            try:
+                with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+                    remaining = os.fstat(src_file.fileno()).st_size
+                    while remaining > 0:
+                        copied = os.copy_file_range(
+                            src_file.fileno(), dst_file.fileno(), remaining)
+                        if copied == 0:
+                            break
+                        remaining -= copied
+                if remaining == 0:
+                    method = 'copy_file_range'
+            except OSError as e:
+                print_verbose(f'copy_file_range failed: {e}')
+
+        if method is None:
+            # shutil uses sendfile on Linux and fcopyfile on macOS
+            shutil.copyfile(src, dst)
+            method = 'copy'
+        shutil.copymode(src, dst)
+        return method
+
     # Level 1 #
 
     @classmethod
-    def write_to_file(cls, filepath: str, content_chunks: Iterable, mode: str = None, limit_rate: Union[int, None] = 0, encoding: Union[str, None] = None, overwrite: bool = True, use_pb: bool = False, total: float = 0, desc: str = None):
-        """Uses content_chunks to write to filepath bit by bit. If use_pb is enabled, it is recommended to set total kwarg to the length of the file to be written."""
-        progress_bar = get_progress_bar(total, desc) if use_pb else None
+    def materialize(cls, src: str, dst: str, mode: str = 'reflink') -> str:
+        """Places the file at src at dst, replacing dst if it exists. Returns the method that was used.
+
+        Modes fall back to the next method if the filesystem does not support them (e.g. hardlinks across filesystems):
+        - hardlink: hardlink -> reflink -> copy
+        - reflink: reflink -> copy
+        - symlink: symlink -> copy
+        - link: hardlink -> symlink -> copy
+        - copy: copy"""
+        def hardlink(src, tmp):
+            os.link(src, tmp)
+            return 'hardlink'
+
+        def reflink(src, tmp):
+            cls.reflink(src, tmp)
+            return 'reflink'
+
+        def symlink(src, tmp):
+            os.symlink(os.path.abspath(src), tmp)
+            return 'symlink'
+
+        fallbacks = {
+            'hardlink': [hardlink, reflink, cls.copy_in_kernel],
+            'reflink': [reflink, cls.copy_in_kernel],
+            'symlink': [symlink, cls.copy_in_kernel],
+            'link': [hardlink, symlink, cls.copy_in_kernel],
+            'copy': [cls.copy_in_kernel]
+        }
+        if mode not in fallbacks:
+            raise UnexpectedException(f'Unknown materialize mode: {mode}')
+
+        temp_filepath = cls.get_temp_filepath(dst)
+        try:
+            with span('io.materialize', path=dst, mode=mode) as s:
+                for i, fn in enumerate(fallbacks[mode]):
+                    if os.path.lexists(temp_filepath):
+                        os.remove(temp_filepath)
+                    try:
+                        method = cls.create_in_dir(lambda: fn(
+                            src, temp_filepath), os.path.dirname(temp_filepath))
+                        break
+                    except OSError as e:
+                        if i == len(fallbacks[mode]) - 1:
+                            raise e
+                        print_verbose(f'Unable to {fn.__name__} "{src}" to "{dst}": {e}')  # nopep8
+                s.set(method=method, bytes=os.path.getsize(src))
+            os.replace(temp_filepath, dst)
+        finally:
+            if os.path.lexists(temp_filepath):
+                os.remove(temp_filepath)
+            cls.remove_dir_if_empty(os.path.dirname(temp_filepath))
+
+        return method
+
+    @classmethod
+    def write_to_file(cls, filepath: str, content_chunks: Iterable, mode: str = None, limiter=None, encoding: Union[str, None] = None, overwrite: bool = True, use_pb: bool = False, total: float = 0, desc: str = None, initial: float = 0, keep_partial: bool = False, with_hash: bool = False, expected_hash: Union[str, None] = None) -> Union[str, None]:
+        """Uses content_chunks to write to filepath bit by bit, throttled by limiter if provided. If use_pb is enabled, it is recommended to set total kwarg to the length of the file to be written.
+        If keep_partial is enabled, the partially written temp file is kept when writing fails, so that it can be appended to later with mode 'ab'. Set initial to the size of the temp file when appending.
+        If with_hash or expected_hash is set, the SHA256 hash of the file is computed while writing and returned. The file is only moved to filepath if it matches expected_hash."""
+        digest = None
+        progress_bar = get_progress_bar(total, desc, initial) if use_pb else None
+        written = 0
 
         def update_progress_bar(bytes_downloaded):
+            nonlocal written
+            written += bytes_downloaded
             if progress_bar:
                 progress_bar.update(bytes_downloaded)
 
@@ -101,34 +266,52 @@ class IOHelper:
             sprint(Styler.stylize(
                 f'File already exists at "{filepath}"', color='info'))
         else:
-            temp_dirpath = os.path.join(os.path.dirname(
-                filepath), '.tmp')
-            temp_filepath = os.path.join(
-                temp_dirpath, os.path.basename(filepath))
-            os.makedirs(temp_dirpath, exist_ok=True)
+            temp_filepath = cls.get_temp_filepath(filepath)
+            temp_dirpath = os.path.dirname(temp_filepath)
             try:
-                with open(temp_filepath, mode if mode != None else 'w', encoding=encoding) as file:
+                hasher = hashlib.sha256() if with_hash or expected_hash else None
+                if hasher is not None and mode is not None and 'a' in mode and os.path.exists(temp_filepath):
+                    cls.update_hasher(hasher, temp_filepath)
+
+                # Includes the time spent waiting on content_chunks, e.g. reading a download from the network.
+                with span('io.write', path=filepath) as s, cls.create_in_dir(lambda: open(temp_filepath, mode if mode != None else 'w', encoding=encoding), temp_dirpath) as file:
                     cls.write_contents(file, content_chunks,
-                                       limit_rate, update_progress_bar)
-                shutil.move(temp_filepath, filepath)
-                shutil.rmtree(temp_dirpath)
+                                       limiter, update_progress_bar, hasher)
+                    s.set(bytes=written)
+
+                if hasher is not None:
+                    digest = hasher.hexdigest().upper()
+                    print_verbose(f'Computed SHA256: "{digest}", Expected SHA256: "{expected_hash}"')  # nopep8
+                    if expected_hash and digest != expected_hash.upper():
+                        # A corrupted file must not be resumed from
+                        cls.delete_file_if_exists(temp_filepath)
+                        raise ResourcesException(
+                            'SHA256 hash of the downloaded file does not match the expected hash.', f'File Path: {filepath}')
+
+                cls.move_over(temp_filepath, filepath)
+                cls.remove_dir_if_empty(temp_dirpath)
             except Exception as e:
                 sprint('Existance: ', temp_dirpath, temp_filepath,
                        os.path.exists(temp_filepath), file=sys.stderr)
-                if os.path.exists(temp_dirpath):
-                    shutil.rmtree(temp_dirpath)
+                if progress_bar:
+                    progress_bar.close()
+                if not keep_partial:
+                    cls.delete_file_if_exists(temp_filepath)
+                    cls.remove_dir_if_empty(temp_dirpath)
                 raise e
             if (progress_bar):
                 progress_bar.close()
 
+        return digest
+
     @classmethod
-    def write_to_files(cls, dirpath: str, basenames: Iterable, content_chunks_list: Iterable[Iterable], mode: str = None, encoding: Union[str, None] = None, use_pb: bool = False, total: float = 0, desc: str = None):
-        """Write content to multiple files in dirpath. If use_pb is enabled, it is recommended to set total kwarg to the number of files being written."""
+    def write_to_files(cls, dirpath: str, basenames: Iterable, content_chunks_list: Iterable[Iterable], mode: str = None, encoding: Union[str, None] = None, use_pb: bool = False, total: float = 0, desc: str = None, limiter=None):
+        """Write content to multiple files in dirpath, throttled by limiter if provided. If use_pb is enabled, it is recommended to set total kwarg to the number of files being written."""
         progress_bar = get_progress_bar(total, desc) if use_pb else None
         for basename, content_chunks in zip(basenames, content_chunks_list):
             filepath = os.path.join(dirpath, basename)
             with open(filepath, mode if mode != None else 'w', encoding=encoding) as file:
-                cls.write_contents(file, content_chunks)
+                cls.write_contents(file, content_chunks, limiter)
                 if (progress_bar):
                     progress_bar.update(1)
         if (progress_bar):
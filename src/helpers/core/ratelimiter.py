@@ -0,0 +1,63 @@
+import threading
+import time
+from typing import List, Optional
+
+
+class TokenBucket:
+    """Thread-safe token bucket where each token is a byte. It holds up to burst tokens and refills at rate tokens per second."""
+    rate: float
+    burst: float
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst else rate
+        self.__tokens = self.burst
+        self.__last_refill = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def reserve(self, amount: int) -> float:
+        """Takes amount tokens from the bucket and returns the number of seconds to wait before using them.
+        Tokens can be borrowed from the future, so an amount larger than burst is delayed rather than refused."""
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.burst, self.__tokens +
+                                (now - self.__last_refill) * self.rate)
+            self.__last_refill = now
+            self.__tokens -= amount
+            return -self.__tokens / self.rate if self.__tokens < 0 else 0
+
+
+_global_bucket: Optional[TokenBucket] = None
+
+
+def set_global_rate_limit(rate: Optional[float], burst: Optional[float] = None):
+    """Limits the combined rate of every transfer in the process. A rate of 0 or None removes the limit."""
+    global _global_bucket
+    _global_bucket = TokenBucket(rate, burst) if rate else None
+
+
+def get_global_rate_limit() -> Optional[float]:
+    return _global_bucket.rate if _global_bucket is not None else None
+
+
+class RateLimiter:
+    """Limits a single transfer to rate bytes per second, and draws from the process-wide limit set with set_global_rate_limit().
+    A rate of 0 or None only applies the process-wide limit."""
+    __buckets: List[TokenBucket]
+
+    def __init__(self, rate: Optional[float] = None, burst: Optional[float] = None):
+        self.__buckets = [bucket for bucket in (
+            TokenBucket(rate, burst) if rate else None, _global_bucket) if bucket is not None]
+
+    @property
+    def rate(self) -> Optional[float]:
+        """The lowest rate this transfer is limited to, or None if it is not limited."""
+        return min(bucket.rate for bucket in self.__buckets) if len(self.__buckets) > 0 else None
+
+    def consume(self, amount: int):
+        """Blocks until amount bytes may be transferred."""
+        if amount <= 0 or len(self.__buckets) == 0:
+            return
+        wait = max(bucket.reserve(amount) for bucket in self.__buckets)
+        if wait > 0:
+            time.sleep(wait)
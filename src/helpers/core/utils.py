@@ -1,17 +1,19 @@
 from datetime import datetime
 import sys
-import importlib.metadata
-from typing import Callable
-import concurrent.futures
-from tqdm import tqdm
+import threading
+from typing import Callable, Optional
 
 from ._ui.styler import Styler, disable_style, CustomException, InputException, ResourcesException, UnexpectedException, APIException, NotImplementedException
 from ._validation import Validation
+from ._tracer import span, set_trace_file, is_tracing, get_trace_summary
 
 # Level 0
 
 _verbose = False
 
+_print_lock = threading.RLock()
+_thread_local = threading.local()
+
 
 def get_verbose():
     return _verbose
@@ -28,17 +30,40 @@ def getDate():
     return now.strftime("%Y_%m_%d-%Hm_%Mm_%Ss_%f")
 
 
+def format_bytes(size: float):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(size) < 1000:
+            return f'{size:.1f} {unit}'
+        size /= 1000
+    return f'{size:.1f} TB'
+
+
 def get_version():
+    # Imported here, like the other slow imports of this module, so that commands like --help start quickly.
+    import importlib.metadata
     return importlib.metadata.version('civitdl')
 
 
+def get_print_prefix() -> Optional[str]:
+    return getattr(_thread_local, 'print_prefix', None)
+
+
+def set_print_prefix(prefix: Optional[str]):
+    """Sets a prefix for every line printed by the current thread. Used to tell apart the output of models downloaded concurrently."""
+    _thread_local.print_prefix = prefix
+
+
 def sprint(*args, **kwargs):
-    try:
-        print(*args, **kwargs)
-    except:
-        encoded_args = [str(arg).encode(
-            'utf-8', 'replace') for arg in args]
-        print(*encoded_args, **kwargs)
+    prefix = get_print_prefix()
+    if prefix is not None:
+        args = (prefix, *args)
+    with _print_lock:
+        try:
+            print(*args, **kwargs)
+        except:
+            encoded_args = [str(arg).encode(
+                'utf-8', 'replace') for arg in args]
+            print(*encoded_args, **kwargs)
 
 
 # Level 1 - Currently or in the future might depends on level 0
@@ -68,6 +93,13 @@ def print_newlines(string: str, **kwargs):
         sprint(el, **kwargs)
 
 
+def print_trace_summary():
+    summary = get_trace_summary()
+    if summary is not None:
+        print_newlines(Styler.stylize(
+            f'Trace summary:\n{summary}', color='info'))
+
+
 def print_error(*args, **kwargs):
     args = [Styler.stylize(str(arg), bg_color='error') for arg in args]
     sprint(*args, **kwargs, file=sys.stderr)
@@ -81,6 +113,7 @@ def safe_run(callback: Callable[..., any], *values: any) -> dict:
 
 
 def concurrent_request(req_fn, urls, max_workers=16):
+    import concurrent.futures
     res_list = None
 
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
@@ -90,8 +123,12 @@ def concurrent_request(req_fn, urls, max_workers=16):
     return res_list
 
 
-def get_progress_bar(total: float, desc: str):
-    return tqdm(total=total, desc=desc,
+def get_progress_bar(total: float, desc: str, initial: float = 0):
+    from tqdm import tqdm
+    prefix = get_print_prefix()
+    if prefix is not None:
+        desc = f'{prefix} {desc}'
+    return tqdm(total=total, desc=desc, initial=initial,
                 unit='iB', unit_scale=True, file=sys.stdout)
 
 
@@ -0,0 +1,189 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+from helpers.core.utils import Styler, print_verbose, sprint
+
+
+# Seconds between two writes of the textfile, and between two updates of the throughput gauge.
+_INTERVAL = 10
+
+# Name: (type, help)
+_METRICS: Dict[str, Tuple[str, str]] = {
+    'civitdl_downloaded_bytes_total': ('counter', 'Bytes downloaded, by type of resource (model, image, metadata).'),
+    'civitdl_models_total': ('counter', 'Models done, by status (succeeded, skipped, failed).'),
+    'civitdl_retries_total': ('counter', 'Retries, by scope (request, model, segment, image) and reason (HTTP status code or exception).'),
+    'civitdl_cache_requests_total': ('counter', 'Cache lookups, by cache (model, metadata, store, image) and result (hit, miss).'),
+    'civitdl_cache_saved_bytes_total': ('counter', 'Bytes placed from the cache instead of being downloaded, by cache (model, metadata, store, image).'),
+    'civitdl_verifications_total': ('counter', 'Model files checked against their SHA256 hash in the background, by result (passed, failed).'),
+    'civitdl_download_throughput_bytes': ('gauge', f'Bytes downloaded per second over the last {_INTERVAL} seconds.'),
+    'civitdl_concurrent_models': ('gauge', 'Number of models that may currently be downloaded at the same time.'),
+    'civitdl_batch_start_time_seconds': ('gauge', 'Unix time the batch started at.'),
+    'civitdl_last_update_time_seconds': ('gauge', 'Unix time the metrics were last updated at.'),
+}
+
+_values: Dict[str, Dict[Tuple[Tuple[str, str], ...], float]] = {}
+_enabled = False
+_lock = threading.Lock()
+
+
+def inc(name: str, amount: float = 1, **labels):
+    """Increments the counter name with labels. Does nothing unless metrics are exported with MetricsExporter."""
+    if not _enabled:
+        return
+    key = tuple(sorted((label, str(label_value))
+                      for label, label_value in labels.items()))
+    with _lock:
+        series = _values.setdefault(name, {})
+        series[key] = series.get(key, 0) + amount
+
+
+def set_gauge(name: str, value: float, **labels):
+    if not _enabled:
+        return
+    key = tuple(sorted((label, str(label_value))
+                      for label, label_value in labels.items()))
+    with _lock:
+        _values.setdefault(name, {})[key] = value
+
+
+def get_reason(error: BaseException) -> str:
+    """Returns the HTTP status code of error if it has one, for the reason label of retries, or the name of its type otherwise."""
+    status_code = getattr(error, 'status_code', None)
+    return str(status_code) if status_code is not None else type(error).__name__
+
+
+def count_bytes(chunks: Iterable[bytes], type: str) -> Iterator[bytes]:
+    """Yields every chunk, adding its size to the downloaded bytes of type as it arrives, so that the throughput of long downloads is up to date."""
+    for chunk in chunks:
+        inc('civitdl_downloaded_bytes_total', len(chunk), type=type)
+        yield chunk
+
+
+def get_total(name: str) -> float:
+    """Returns the sum of every series of name."""
+    with _lock:
+        return sum(_values.get(name, {}).values())
+
+
+def _escape(value: str):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render() -> str:
+    """Returns every metric in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        for name, (type, help) in _METRICS.items():
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {type}')
+            for key, value in sorted(_values.get(name, {}).items()):
+                labels = ','.join(
+                    f'{label}="{_escape(label_value)}"' for label, label_value in key)
+                lines.append(f'{name}{{{labels}}} {_format_value(value)}' if labels
+                             else f'{name} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('UTF-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsExporter:
+    """Collects counters and gauges during a batch, and writes them every few seconds to textfile_path, for the textfile collector
+    of the Prometheus node exporter, and/or serves them on http://127.0.0.1:port/metrics.
+    The textfile is replaced atomically, so the collector never reads a partial file."""
+    __textfile_path: Optional[str]
+    __server: Optional[ThreadingHTTPServer]
+    __get_concurrency: Optional[Callable[[], int]]
+
+    def __init__(self, textfile_path: Optional[str] = None, port: Optional[int] = None, get_concurrency: Optional[Callable[[], int]] = None):
+        global _enabled
+        self.__textfile_path = textfile_path
+        self.__get_concurrency = get_concurrency
+        self.__stop = threading.Event()
+        self.__last_bytes = 0
+        self.__last_time = time.monotonic()
+
+        with _lock:
+            _values.clear()
+            _enabled = True
+        set_gauge('civitdl_batch_start_time_seconds', time.time())
+        self.__update()
+
+        self.__server = None
+        if port is not None:
+            self.__server = ThreadingHTTPServer(
+                ('127.0.0.1', port), _MetricsHandler)
+            self.__server.daemon_threads = True
+            threading.Thread(target=self.__server.serve_forever,
+                             name='metrics-server', daemon=True).start()
+            print_verbose(
+                f'Serving metrics on http://127.0.0.1:{self.__server.server_port}/metrics')
+
+        self.__thread = threading.Thread(
+            target=self.__run, name='metrics', daemon=True)
+        self.__thread.start()
+
+    def __update(self):
+        now = time.monotonic()
+        downloaded_bytes = get_total('civitdl_downloaded_bytes_total')
+        if now > self.__last_time:
+            set_gauge('civitdl_download_throughput_bytes',
+                      (downloaded_bytes - self.__last_bytes) / (now - self.__last_time))
+        self.__last_bytes = downloaded_bytes
+        self.__last_time = now
+        if self.__get_concurrency is not None:
+            set_gauge('civitdl_concurrent_models', self.__get_concurrency())
+        set_gauge('civitdl_last_update_time_seconds', time.time())
+
+    def __write_textfile(self):
+        if self.__textfile_path is None:
+            return
+        temp_filepath = f'{self.__textfile_path}.{os.getpid()}.tmp'
+        try:
+            with open(temp_filepath, 'w', encoding='UTF-8') as file:
+                file.write(render())
+            os.replace(temp_filepath, self.__textfile_path)
+        except OSError as e:
+            sprint(Styler.stylize(
+                f'Unable to write metrics to "{self.__textfile_path}": {e}', color='warning'))
+
+    def __run(self):
+        self.__write_textfile()
+        while not self.__stop.wait(_INTERVAL):
+            self.__update()
+            self.__write_textfile()
+
+    def close(self):
+        """Writes the final values of the metrics and stops serving them."""
+        global _enabled
+        self.__stop.set()
+        self.__thread.join()
+        self.__update()
+        # The throughput of a finished batch is 0, rather than the rate of its last seconds.
+        set_gauge('civitdl_download_throughput_bytes', 0)
+        self.__write_textfile()
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+        with _lock:
+            _enabled = False
@@ -1,9 +1,13 @@
-from typing import Callable, Dict, List, Literal, Union, Optional
-import requests
+from typing import TYPE_CHECKING, Callable, Dict, List, Literal, Union, Optional
 
 from helpers.sorter.utils import SorterData, import_sort_model
 from helpers.sorter import basic, tags
 from helpers.core.utils import disable_style, InputException, NotImplementedException, UnexpectedException, Validation, print_verbose, safe_run, set_verbose
+from helpers.core.ratelimiter import set_global_rate_limit
+
+if TYPE_CHECKING:
+    import requests
+    from helpers.scheduler import AdaptiveScheduler
 
 
 def parse_bytes(size: Union[str, int, float], name: str):
@@ -32,21 +36,49 @@ def parse_bytes(size: Union[str, int, float], name: str):
             return number * units[unit]
 
 
+def parse_image_size(size: Union[str, int], name: str) -> Optional[int]:
+    """Returns the max width of images in pixels, or None for 'original'."""
+    if size == 'original':
+        return None
+    res = safe_run(int, size)
+    if res["success"] == False:
+        raise InputException(
+            f'Invalid image size for {name}: {size}. Use a width in pixels or original.')
+    return Validation.validate_integer(res["data"], name, min_value=1)
+
+
 class BatchOptions:
+    session: 'requests.Session'
+    scheduler: 'AdaptiveScheduler'
     sorter_name: str
     sorter: Callable[[Dict, Dict, str, str],
                      SorterData] = basic.sort_model
     max_images: int = 3
+    image_size: Optional[int] = None
+    """Max width of the images in pixels. None for the images as listed by CivitAI."""
+    image_budget: int = 0
+    """Max bytes of images to download for each model, estimated from their dimensions. 0 for no budget."""
     nsfw_mode: Literal['0', '1', '2'] = '1'
     api_key: Optional[str] = None
 
     with_prompt: bool = True
     without_model: bool = False
     limit_rate: int = 0
+    global_limit_rate: int = 0
+    limit_burst: int = 0
     retry_count: int = 3
-    pause_time: int = 3
+    pause_time: float = 0
+    max_concurrent_models: int = 1
+    prefetch_count: int = 2
+    segments: int = 1
 
     cache_mode: Literal['0', '1'] = '1'
+    cache_link_mode: Literal['reflink', 'hardlink', 'symlink', 'copy'] = 'reflink'
+    store_mode: Literal['0', '1'] = '0'
+    store_dir: Optional[str] = None
+    """Directory of the model store (see Store). None for the default directory in the user cache directory."""
+    metadata_cache: Literal['off', 'use', 'refresh'] = 'use'
+    metadata_cache_ttl: float = 86400.0
     strict_mode: Literal['0', '1'] = '1'
 
     model_overwrite: bool = False
@@ -68,9 +100,7 @@ class BatchOptions:
         print_verbose("Chosen Sorter Description: ", self._sorter.__doc__)
         return self._sorter
 
-    def __init__(self, retry_count, pause_time, max_images, nsfw_mode, with_prompt, without_model, api_key, verbose, sorter, limit_rate, cache_mode, strict_mode, model_overwrite, with_color):
-        self.session = requests.Session()
-
+    def __init__(self, retry_count, pause_time, max_images, nsfw_mode, with_prompt, without_model, api_key, verbose, sorter, limit_rate, cache_mode, strict_mode, model_overwrite, with_color, max_concurrent_models=None, segments=None, cache_link_mode=None, metadata_cache=None, metadata_cache_ttl=None, prefetch_count=None, global_limit_rate=None, limit_burst=None, store_mode=None, store_dir=None, image_size=None, image_budget=None):
         # FIXME: Move usage of with_color and verbose outside of options
         if with_color is not None:
             Validation.validate_bool(with_color, 'with_color')
@@ -93,6 +123,15 @@ class BatchOptions:
             Validation.validate_integer(max_images, 'max_images', min_value=0)
             self.max_images = max_images
 
+        if image_size is not None:
+            Validation.validate_types(image_size, [str, int], 'image_size')
+            self.image_size = parse_image_size(image_size, 'image_size')
+
+        if image_budget is not None:
+            Validation.validate_types(
+                image_budget, [str, int, float], 'image_budget')
+            self.image_budget = parse_bytes(image_budget, 'image_budget')
+
         if nsfw_mode is not None:
             Validation.validate_string(
                 nsfw_mode, 'nsfw_mode', whitelist=['0', '1', '2'])
@@ -115,6 +154,19 @@ class BatchOptions:
                 limit_rate, [str, int, float], 'limit_rate')
             self.limit_rate = parse_bytes(limit_rate, "limit_rate")
 
+        if global_limit_rate is not None:
+            Validation.validate_types(
+                global_limit_rate, [str, int, float], 'global_limit_rate')
+            self.global_limit_rate = parse_bytes(
+                global_limit_rate, "global_limit_rate")
+
+        if limit_burst is not None:
+            Validation.validate_types(
+                limit_burst, [str, int, float], 'limit_burst')
+            self.limit_burst = parse_bytes(limit_burst, "limit_burst")
+
+        set_global_rate_limit(self.global_limit_rate, self.limit_burst)
+
         if retry_count is not None:
             Validation.validate_integer(
                 retry_count, 'retry_count', min_value=0)
@@ -124,11 +176,50 @@ class BatchOptions:
             Validation.validate_float(pause_time, 'pause_time', min_value=0)
             self.pause_time = pause_time
 
+        if max_concurrent_models is not None:
+            Validation.validate_integer(
+                max_concurrent_models, 'max_concurrent_models', min_value=1)
+            self.max_concurrent_models = max_concurrent_models
+
+        if prefetch_count is not None:
+            Validation.validate_integer(
+                prefetch_count, 'prefetch_count', min_value=0)
+            self.prefetch_count = prefetch_count
+
+        if segments is not None:
+            Validation.validate_integer(
+                segments, 'segments', min_value=1, max_value=16)
+            self.segments = segments
+
         if cache_mode is not None:
             Validation.validate_string(
                 cache_mode, 'cache_mode', whitelist=['0', '1'])
             self.cache_mode = cache_mode
 
+        if cache_link_mode is not None:
+            Validation.validate_string(
+                cache_link_mode, 'cache_link_mode', whitelist=['reflink', 'hardlink', 'symlink', 'copy'])
+            self.cache_link_mode = cache_link_mode
+
+        if store_mode is not None:
+            Validation.validate_string(
+                store_mode, 'store_mode', whitelist=['0', '1'])
+            self.store_mode = store_mode
+
+        if store_dir is not None and store_dir != '':
+            Validation.validate_string(store_dir, 'store_dir')
+            self.store_dir = store_dir
+
+        if metadata_cache is not None:
+            Validation.validate_string(
+                metadata_cache, 'metadata_cache', whitelist=['off', 'use', 'refresh'])
+            self.metadata_cache = metadata_cache
+
+        if metadata_cache_ttl is not None:
+            Validation.validate_float(
+                metadata_cache_ttl, 'metadata_cache_ttl', min_value=0)
+            self.metadata_cache_ttl = metadata_cache_ttl
+
         if strict_mode is not None:
             Validation.validate_string(
                 strict_mode, 'strict_mode', whitelist=['0', '1']
@@ -139,26 +230,49 @@ class BatchOptions:
             Validation.validate_bool(model_overwrite, 'model_overwrite')
             self.model_overwrite = model_overwrite
 
+        # Imported here so that commands that only read or set defaults with DefaultOptions do not import requests.
+        from helpers.scheduler import AdaptiveScheduler
+        from helpers.session import create_session
+
+        self.scheduler = AdaptiveScheduler(self.max_concurrent_models)
+        # Each model downloads up to 4 images or its segments at the same time.
+        self.session = create_session(
+            api_pool_size=self.max_concurrent_models + self.prefetch_count,
+            download_pool_size=self.max_concurrent_models * max(self.segments, 4),
+            scheduler=self.scheduler)
+
 
 class DefaultOptions:
     sorter: Optional[str] = None
     max_images: Optional[int] = None
+    image_size: Optional[str] = None
+    image_budget: Optional[str] = None
     nsfw_mode: Optional[int] = None
     api_key: Optional[str] = None
 
     with_prompt: Optional[bool] = None
     without_model: Optional[bool] = None
     limit_rate: Optional[str] = None
+    global_limit_rate: Optional[str] = None
+    limit_burst: Optional[str] = None
     retry_count: Optional[int] = None
     pause_time: Optional[int] = None
+    max_concurrent_models: Optional[int] = None
+    prefetch_count: Optional[int] = None
+    segments: Optional[int] = None
 
     cache_mode: Optional[str] = None
+    cache_link_mode: Optional[str] = None
+    store_mode: Optional[str] = None
+    store_dir: Optional[str] = None
+    metadata_cache: Optional[str] = None
+    metadata_cache_ttl: Optional[float] = None
     strict_mode: Optional[str] = None
     model_overwrite: Optional[bool] = None
 
     with_color: Optional[bool] = None
 
-    def __init__(self, sorter=None, max_images=None, nsfw_mode=None, api_key=None, with_prompt=None, without_model=None, limit_rate=None, retry_count=None, pause_time=None, cache_mode=None, strict_mode=None, model_overwrite=None, with_color=None):
+    def __init__(self, sorter=None, max_images=None, nsfw_mode=None, api_key=None, with_prompt=None, without_model=None, limit_rate=None, retry_count=None, pause_time=None, cache_mode=None, strict_mode=None, model_overwrite=None, with_color=None, max_concurrent_models=None, segments=None, cache_link_mode=None, metadata_cache=None, metadata_cache_ttl=None, prefetch_count=None, global_limit_rate=None, limit_burst=None, store_mode=None, store_dir=None, image_size=None, image_budget=None):
         if sorter is not None:
             Validation.validate_string(
                 sorter, 'sorter')
@@ -171,6 +285,16 @@ class DefaultOptions:
             )
             self.max_images = max_images
 
+        if image_size is not None:
+            Validation.validate_string(image_size, 'image_size')
+            parse_image_size(image_size, 'image_size')
+            self.image_size = image_size
+
+        if image_budget is not None:
+            Validation.validate_string(image_budget, 'image_budget')
+            parse_bytes(image_budget, 'image_budget')
+            self.image_budget = image_budget
+
         if nsfw_mode is not None:
             Validation.validate_string(
                 nsfw_mode, 'nsfw_mode', whitelist=['0', '1', '2']
@@ -194,6 +318,16 @@ class DefaultOptions:
             parse_bytes(limit_rate, 'limit_rate')
             self.limit_rate = limit_rate
 
+        if global_limit_rate is not None:
+            Validation.validate_string(global_limit_rate, 'global_limit_rate')
+            parse_bytes(global_limit_rate, 'global_limit_rate')
+            self.global_limit_rate = global_limit_rate
+
+        if limit_burst is not None:
+            Validation.validate_string(limit_burst, 'limit_burst')
+            parse_bytes(limit_burst, 'limit_burst')
+            self.limit_burst = limit_burst
+
         if retry_count is not None:
             Validation.validate_integer(
                 retry_count, 'retry_count', min_value=0
@@ -206,12 +340,60 @@ class DefaultOptions:
             )
             self.pause_time = pause_time
 
+        if max_concurrent_models is not None:
+            Validation.validate_integer(
+                max_concurrent_models, 'max_concurrent_models', min_value=1
+            )
+            self.max_concurrent_models = max_concurrent_models
+
+        if prefetch_count is not None:
+            Validation.validate_integer(
+                prefetch_count, 'prefetch_count', min_value=0
+            )
+            self.prefetch_count = prefetch_count
+
+        if segments is not None:
+            Validation.validate_integer(
+                segments, 'segments', min_value=1, max_value=16
+            )
+            self.segments = segments
+
         if cache_mode is not None:
             Validation.validate_string(
                 cache_mode, 'cache_mode', whitelist=['0', '1']
             )
             self.cache_mode = cache_mode
 
+        if cache_link_mode is not None:
+            Validation.validate_string(
+                cache_link_mode, 'cache_link_mode', whitelist=['reflink', 'hardlink', 'symlink', 'copy']
+            )
+            self.cache_link_mode = cache_link_mode
+
+        if store_mode is not None:
+            Validation.validate_string(
+                store_mode, 'store_mode', whitelist=['0', '1']
+            )
+            self.store_mode = store_mode
+
+        if store_dir is not None:
+            # An empty string resets the store to the default directory.
+            if store_dir != '':
+                Validation.validate_string(store_dir, 'store_dir')
+            self.store_dir = store_dir
+
+        if metadata_cache is not None:
+            Validation.validate_string(
+                metadata_cache, 'metadata_cache', whitelist=['off', 'use', 'refresh']
+            )
+            self.metadata_cache = metadata_cache
+
+        if metadata_cache_ttl is not None:
+            Validation.validate_float(
+                metadata_cache_ttl, 'metadata_cache_ttl', min_value=0
+            )
+            self.metadata_cache_ttl = metadata_cache_ttl
+
         if strict_mode is not None:
             Validation.validate_string(
                 strict_mode, 'strict_mode', whitelist=['0', '1']
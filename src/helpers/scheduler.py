@@ -0,0 +1,122 @@
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+from helpers.core.utils import Styler, print_verbose, sprint
+
+
+# Backoff in seconds when a throttled response has no Retry-After header. Doubles with each throttle in a row.
+_BASE_BACKOFF = 2
+_MAX_BACKOFF = 120
+_BACKOFF_JITTER = 1
+# Retry-After values above this are not trusted.
+_MAX_RETRY_AFTER = 600
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parses a Retry-After header, either in seconds or as an HTTP date, into seconds from now."""
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+        return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveScheduler:
+    """Runs requests and models flat out until CivitAI responds with 429 or 503, then holds back every request until Retry-After
+    (or an exponential backoff) has passed. The number of models downloaded at the same time is tuned with AIMD:
+    halved on each throttle, and increased by about one for every concurrency-worth of successful responses, up to max_concurrency."""
+    throttled_seconds: float
+    """Wall time during which requests were held back."""
+    throttled_responses: int
+
+    def __init__(self, max_concurrency: int):
+        self.__max_concurrency = max_concurrency
+        self.__limit = float(max_concurrency)
+        self.__active = 0
+        self.__resume_at = 0.0
+        self.__throttles_in_a_row = 0
+        self.__cond = threading.Condition()
+        self.throttled_seconds = 0
+        self.throttled_responses = 0
+
+    @property
+    def concurrency(self) -> int:
+        """Number of models that may currently be downloaded at the same time."""
+        return max(1, int(self.__limit))
+
+    def acquire(self):
+        """Blocks until another model may start downloading."""
+        with self.__cond:
+            while self.__active >= self.concurrency:
+                self.__cond.wait()
+            self.__active += 1
+
+    def release(self):
+        with self.__cond:
+            self.__active -= 1
+            self.__cond.notify_all()
+
+    def wait(self):
+        """Blocks while requests are being held back."""
+        while True:
+            with self.__cond:
+                delay = self.__resume_at - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def on_success(self):
+        with self.__cond:
+            self.__throttles_in_a_row = 0
+            if self.__limit < self.__max_concurrency:
+                self.__limit = min(self.__max_concurrency,
+                                   self.__limit + 1 / self.__limit)
+                self.__cond.notify_all()
+
+    def on_throttled(self, status_code: int, retry_after: Optional[float]) -> float:
+        """Holds back every request for retry_after seconds, or an exponential backoff if it is None. Returns the delay."""
+        with self.__cond:
+            now = time.monotonic()
+            self.throttled_responses += 1
+
+            # Responses to requests sent before the backoff started are part of the same throttle.
+            is_new_throttle = now >= self.__resume_at
+            if is_new_throttle:
+                self.__throttles_in_a_row += 1
+                previous_concurrency = self.concurrency
+                self.__limit = max(1.0, self.__limit / 2)
+                if self.concurrency < previous_concurrency:
+                    print_verbose(
+                        f'Reducing concurrent models from {previous_concurrency} to {self.concurrency}.')
+
+            if retry_after is not None:
+                delay = min(retry_after, _MAX_RETRY_AFTER)
+            else:
+                delay = min(_MAX_BACKOFF, _BASE_BACKOFF * 2 ** (self.__throttles_in_a_row - 1)) + \
+                    random.uniform(0, _BACKOFF_JITTER)
+
+            resume_at = now + delay
+            if resume_at > self.__resume_at:
+                self.throttled_seconds += resume_at - \
+                    max(now, self.__resume_at)
+                self.__resume_at = resume_at
+
+        message = f'CivitAI is throttling requests (status code {status_code}). Waiting {delay:.1f} seconds...'
+        if is_new_throttle:
+            sprint(Styler.stylize(message, color='warning'))
+        else:
+            print_verbose(message)
+        return delay
@@ -0,0 +1,112 @@
+import os
+import random
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from helpers.core.utils import print_verbose
+from helpers.metrics import inc
+from helpers.scheduler import AdaptiveScheduler, parse_retry_after
+
+
+# CIVITDL_API_URL points civitdl at another server with the same API, such as the fake server used by the benchmarks in test/benchmark.
+API_URL_PREFIX = os.environ.get(
+    'CIVITDL_API_URL', 'https://civitai.com/').rstrip('/') + '/'
+
+# (connect, read) timeouts in seconds, used when a request does not set its own.
+_API_TIMEOUT = (10, 30)
+_DOWNLOAD_TIMEOUT = (10, 60)
+
+_RETRY_COUNT = 3
+_BACKOFF_FACTOR = 0.5
+_BACKOFF_JITTER = 0.5
+_RETRY_STATUS_CODES = (500, 502, 504)
+
+# Throttled responses are retried after the AdaptiveScheduler's backoff instead of by urllib3.
+_THROTTLE_STATUS_CODES = (429, 503)
+_THROTTLE_RETRY_COUNT = 5
+
+# Default pool size of urllib3.
+_MIN_POOL_SIZE = 10
+
+
+class _JitteredRetry(Retry):
+    """Retry with a random jitter added to the exponential backoff, so that parallel requests that failed together do not retry together.
+    Implemented here as backoff_jitter is only available from urllib3 2.0."""
+
+    def get_backoff_time(self) -> float:
+        backoff = super().get_backoff_time()
+        return backoff + random.uniform(0, _BACKOFF_JITTER) if backoff > 0 else 0
+
+    def increment(self, method=None, url=None, response=None, error=None, *args, **kwargs):
+        # Raises once the retries run out, so only requests that are retried are counted.
+        retry = super().increment(method, url, response, error, *args, **kwargs)
+        inc('civitdl_retries_total', scope='request',
+            reason=response.status if response is not None else type(error).__name__)
+        return retry
+
+
+class _TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that applies a default timeout to every request without one.
+    If a scheduler is provided, requests wait while it holds them back, and throttled responses are reported to it and retried."""
+
+    def __init__(self, timeout, *args, scheduler: Optional[AdaptiveScheduler] = None, **kwargs):
+        self.__timeout = timeout
+        self.__scheduler = scheduler
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.__timeout
+        if self.__scheduler is None:
+            return super().send(request, **kwargs)
+
+        iter = 0
+        while True:
+            self.__scheduler.wait()
+            res = super().send(request, **kwargs)
+            if res.status_code not in _THROTTLE_STATUS_CODES:
+                if res.status_code < 400:
+                    self.__scheduler.on_success()
+                return res
+
+            self.__scheduler.on_throttled(
+                res.status_code, parse_retry_after(res.headers.get('Retry-After')))
+            if iter >= _THROTTLE_RETRY_COUNT:
+                return res
+            iter += 1
+            inc('civitdl_retries_total', scope='request',
+                reason=res.status_code)
+            print_verbose(
+                f'Retrying throttled request ({iter}/{_THROTTLE_RETRY_COUNT}): {request.url}')
+            res.close()
+
+
+def _create_retry() -> Retry:
+    # Only idempotent methods (GET, HEAD, ...) are retried by default. Once the retries run out, the last response is returned
+    # so that its status code is handled by the caller.
+    # urllib3 would otherwise retry 429 and 503 responses with a Retry-After header on its own, without the scheduler knowing.
+    return _JitteredRetry(total=_RETRY_COUNT, connect=_RETRY_COUNT, read=_RETRY_COUNT, status=_RETRY_COUNT,
+                          backoff_factor=_BACKOFF_FACTOR, status_forcelist=_RETRY_STATUS_CODES,
+                          respect_retry_after_header=False, raise_on_status=False)
+
+
+def create_session(api_pool_size: int, download_pool_size: int, scheduler: Optional[AdaptiveScheduler] = None) -> requests.Session:
+    """Creates a session where requests to the CivitAI API and to the hosts models and images are downloaded from use separate connection pools.
+    Pool sizes should match the number of requests that may run at the same time, so that connections are reused instead of being dropped.
+    Every request gets a default timeout and transport-level retries with backoff on connection errors and 5xx responses.
+    429 and 503 responses are handled by scheduler if provided."""
+    session = requests.Session()
+
+    download_adapter = _TimeoutHTTPAdapter(_DOWNLOAD_TIMEOUT, pool_maxsize=max(
+        _MIN_POOL_SIZE, download_pool_size), max_retries=_create_retry(), scheduler=scheduler)
+    session.mount('https://', download_adapter)
+    session.mount('http://', download_adapter)
+
+    # The longest matching prefix is used, so API requests get their own adapter.
+    session.mount(API_URL_PREFIX, _TimeoutHTTPAdapter(_API_TIMEOUT, pool_maxsize=max(
+        _MIN_POOL_SIZE, api_pool_size), max_retries=_create_retry(), scheduler=scheduler))
+
+    return session
@@ -1,9 +1,9 @@
 from dataclasses import dataclass
 import os
 import re
-from typing import List, Literal, Union, Optional
+from typing import Iterable, Iterator, List, Literal, Set, Union, Optional
 
-from helpers.core.utils import print_verbose, InputException, UnexpectedException
+from helpers.core.utils import Styler, print_verbose, sprint, InputException, UnexpectedException
 
 # modify id class to use getters and setters so that I can control how the data is being accessed
 # modify id class to not use type.
@@ -40,8 +40,19 @@ class _Id(Id):
 
 
 class SourceManager:
+    """Parses sources into ids. Batchfiles are streamed instead of being read into memory,
+    every batchfile is only read once however many times it is included,
+    and sources that point to the same model and version as an earlier source are skipped."""
+    __seen_keys: Set[str]
+    __open_batchfiles: List[str]
+    """Real paths of the batchfiles being read, outermost first."""
+    __read_batchfiles: Set[str]
+    """Real paths of every batchfile read so far, including the ones being read."""
+
     def __init__(self) -> None:
-        pass
+        self.__seen_keys = set()
+        self.__open_batchfiles = []
+        self.__read_batchfiles = set()
 
     def __get_comma_list(self, string: str) -> List[str]:
         return [input_str for input_str in string.replace(
@@ -50,17 +61,43 @@ class SourceManager:
     def __use_parent_dir_if_exist(self, src: str, parent: Union[str, None]) -> str:
         return os.path.normpath(os.path.join(os.path.dirname(parent), src)) if parent else src
 
-    def parse_src(self, str_li: List[str], parent: Union[str, None] = None) -> List[_Id]:
-        res: List[_Id] = []
+    def __read_batchfile(self, filepath: str) -> Iterator[str]:
+        """Yields the comma separated sources of a batchfile one by one, reading it line by line."""
+        rest = ''
+        with open(filepath, 'r', encoding='UTF-8') as file:
+            for line in file:
+                rest += line.replace('\n', '')
+                *sources, rest = rest.split(',')
+                yield from (src for src in sources if src.strip() != '')
+        if rest.strip() != '':
+            yield rest
+
+    def __is_new(self, id: _Id) -> bool:
+        # Version ids are unique across models, so they are enough to tell if two sources point to the same model file.
+        key = f'version:{id.version_id}' if id.version_id else f'model:{id.model_id}'
+        if key in self.__seen_keys:
+            print_verbose(f'Skipping duplicate source: {id.original}')
+            return False
+        self.__seen_keys.add(key)
+        return True
+
+    def parse_src_all(self, str_li: Iterable[str]) -> List[_Id]:
+        """Returns the ids of every source, so that a bad source raises InputException before any of them is used."""
+        return list(self.parse_src(str_li))
+
+    def parse_src(self, str_li: Iterable[str], parent: Union[str, None] = None) -> Iterator[_Id]:
+        """Yields the id of each source as it is parsed. A bad source raises InputException once it is reached."""
         for string in str_li:
             string = string.strip()
 
             if string.isdigit() and abs(int(string)) == int(string):
                 model_id = string
-                res.append(_Id(original=string, model_id=model_id))
+                id = _Id(original=string, model_id=model_id)
+                if self.__is_new(id):
+                    yield id
             elif len(self.__get_comma_list(string)) > 1:
                 arg_str_li = self.__get_comma_list(string)
-                res.extend(self.parse_src(arg_str_li))
+                yield from self.parse_src(arg_str_li)
             elif 'civitai.com/api' in string:
                 version_id_regex = r'(?<=models\/)\d+'
                 version_id = re.search(version_id_regex, string)
@@ -69,7 +106,9 @@ class SourceManager:
                         (f' in {parent}: ' if parent else ': ') + string
                     raise InputException(err)
                 version_id = version_id.group(0)
-                res.append(_Id(original=string, version_id=version_id))
+                id = _Id(original=string, version_id=version_id)
+                if self.__is_new(id):
+                    yield id
             elif 'civitai.com/models' in string:
                 model_id = re.search(r'(?<=models\/)\d+', string)
                 version_id = re.search(r'(?<=modelVersionId=)\d+', string)
@@ -82,24 +121,33 @@ class SourceManager:
 
                 if version_id:
                     version_id = version_id.group(0)
-                    res.append(
-                        _Id(original=string, model_id=model_id, version_id=version_id))
+                    id = _Id(original=string, model_id=model_id,
+                             version_id=version_id)
                 else:
-                    res.append(_Id(original=string, model_id=model_id))
+                    id = _Id(original=string, model_id=model_id)
+                if self.__is_new(id):
+                    yield id
             elif os.path.exists(self.__use_parent_dir_if_exist(string, parent)):
                 string = self.__use_parent_dir_if_exist(string, parent)
-                file_str = None
-
-                with open(string, 'r', encoding='UTF-8') as file:
-                    file_str = file.read().strip()
-                if file_str == None:
-                    raise UnexpectedException(
-                        'Unknown exception while reading batchfile path.')
-                str_li_res = self.__get_comma_list(file_str)
-                print_verbose(str_li_res)
-                res.extend(self.parse_src(str_li_res, parent=string))
+                realpath = os.path.realpath(string)
+                if realpath in self.__open_batchfiles:
+                    cycle = self.__open_batchfiles[self.__open_batchfiles.index(
+                        realpath):] + [realpath]
+                    sprint(Styler.stylize(
+                        f'Skipping batchfile that includes itself: {" -> ".join(cycle)}', color='warning'))
+                    continue
+                if realpath in self.__read_batchfiles:
+                    # Its sources were all yielded already, so they would only be skipped as duplicates.
+                    print_verbose(f'Skipping batchfile that was already read: {string}')
+                    continue
+
+                print_verbose(f'Reading batchfile: {string}')
+                self.__read_batchfiles.add(realpath)
+                self.__open_batchfiles.append(realpath)
+                try:
+                    yield from self.parse_src(self.__read_batchfile(string), parent=string)
+                finally:
+                    self.__open_batchfiles.pop()
             else:
                 raise InputException(
                     f'Bad source provided: {string}', f'   Parent Batchfile Path: {parent}' if parent else None)
-
-        return res
@@ -0,0 +1,201 @@
+import os
+import stat
+import time
+import threading
+from typing import Dict, List, Optional
+
+from helpers.core.utils import Styler, format_bytes, print_newlines, print_verbose, span
+from helpers.core.constants import app_dirs
+from helpers.core.database import Database
+from helpers.core.iohelper import IOHelper
+
+_SCHEMA = [
+    # Every path a blob was placed at. A blob is only collected once none of its paths still point to it.
+    """CREATE TABLE IF NOT EXISTS refs (
+        path TEXT PRIMARY KEY,
+        SHA256 TEXT NOT NULL
+    )""",
+    'CREATE INDEX IF NOT EXISTS refs_SHA256 ON refs (SHA256)',
+    # Hash of the content of every url downloaded to the store, so that it is not requested again (see get_url_hash()).
+    """CREATE TABLE IF NOT EXISTS urls (
+        key TEXT PRIMARY KEY,
+        SHA256 TEXT NOT NULL
+    )"""
+]
+
+_UPSERT_REF_SQL = 'INSERT OR REPLACE INTO refs (path, SHA256) VALUES (?, ?)'
+
+# Blobs and temp files changed within this many seconds are never collected, as a running batch may not have placed them yet.
+_GC_GRACE_SECONDS = 3600
+
+_stores: Dict[str, 'Store'] = {}
+_stores_lock = threading.Lock()
+
+
+def get_default_store_dirpath():
+    return os.path.join(app_dirs.user_cache_dir, 'store')
+
+
+def _remove_blob(filepath: str):
+    # Read-only files can not be removed on Windows, e.g. a blob of a model the user made read-only.
+    os.chmod(filepath, stat.S_IMODE(os.stat(filepath).st_mode) | stat.S_IWUSR)
+    os.remove(filepath)
+    IOHelper.remove_dir_if_empty(os.path.dirname(filepath))
+
+
+class Store:
+    """Content-addressed store of model files and images, keyed by SHA256 hash. Every file is kept once in the store (a blob),
+    and placed at each of its destination paths as a link to the blob, so that disk use grows with the number of unique files
+    rather than with the number of root directories they are downloaded to.
+
+    Placements are never written through: a file written over a placement replaces the link instead (see IOHelper.move_over()).
+    The paths every blob is placed at are recorded in refs.db in the store, so that gc() only deletes blobs that are not placed anywhere."""
+    __dirpath: str
+    __db: Database
+    __add_locks: Dict[str, threading.Lock]
+
+    def __init__(self, dirpath: str):
+        self.__dirpath = dirpath
+        self.__db = Database(os.path.join(dirpath, 'refs.db'), _SCHEMA)
+        self.__add_locks = {}
+        self.__add_locks_lock = threading.Lock()
+
+    @classmethod
+    def open(cls, dirpath: Optional[str] = None) -> 'Store':
+        """Returns the store at dirpath, or at the default path in the user cache directory. Safe to share between threads."""
+        dirpath = os.path.abspath(os.path.expanduser(
+            dirpath or get_default_store_dirpath()))
+        with _stores_lock:
+            if dirpath not in _stores:
+                _stores[dirpath] = cls(dirpath)
+            return _stores[dirpath]
+
+    @property
+    def dirpath(self):
+        return self.__dirpath
+
+    def get_blob_path(self, sha256_hash: str) -> str:
+        sha256_hash = sha256_hash.upper()
+        return os.path.join(self.__dirpath, 'blobs', sha256_hash[:2], sha256_hash)
+
+    def has(self, sha256_hash: str) -> bool:
+        return os.path.isfile(self.get_blob_path(sha256_hash))
+
+    def add(self, filepath: str, sha256_hash: str) -> bool:
+        """Adds the file at filepath to the store as the blob of sha256_hash, unless the blob already exists. filepath is left as is, and stays writable.
+        The file is hardlinked into the store where possible, so that it is not copied. Returns whether a blob was added."""
+        blob_path = self.get_blob_path(sha256_hash)
+        # The same image may be added by several models at the same time, which would share the temp file of the blob.
+        with self.__add_locks_lock:
+            lock = self.__add_locks.setdefault(
+                sha256_hash.upper(), threading.Lock())
+        with lock:
+            if os.path.isfile(blob_path):
+                return False
+            with span('store.add', path=filepath):
+                method = IOHelper.materialize(filepath, blob_path, 'hardlink')
+        print_verbose(
+            f'Added "{filepath}" to the store with {method}: {blob_path}')
+        return True
+
+    def place(self, sha256_hash: str, filepath: str) -> str:
+        """Places the blob of sha256_hash at filepath as a hardlink, or as a symlink if the store is on another filesystem, replacing filepath.
+        Returns the method that was used."""
+        blob_path = self.get_blob_path(sha256_hash)
+        # Recorded before linking, so that gc() never sees the link without its reference.
+        self.__db.execute(_UPSERT_REF_SQL, (os.path.abspath(
+            filepath), sha256_hash.upper()))
+        if os.path.exists(filepath) and os.path.samefile(filepath, blob_path):
+            return 'symlink' if os.path.islink(filepath) else 'hardlink'
+        with span('store.place', path=filepath):
+            return IOHelper.materialize(blob_path, filepath, 'link')
+
+    def get_url_hash(self, key: str) -> Optional[str]:
+        """Returns the SHA256 hash of the content downloaded from the url with key, if its blob is still in the store."""
+        row = self.__db.fetchone(
+            'SELECT SHA256 FROM urls WHERE key = ?', (key,))
+        return row[0] if row is not None and self.has(row[0]) else None
+
+    def set_url_hash(self, key: str, sha256_hash: str):
+        self.__db.execute('INSERT OR REPLACE INTO urls (key, SHA256) VALUES (?, ?)',
+                          (key, sha256_hash.upper()))
+
+    def remove(self, sha256_hash: str):
+        """Removes the blob of sha256_hash, e.g. if it does not match its hash. Its placements keep their data."""
+        blob_path = self.get_blob_path(sha256_hash)
+        if os.path.isfile(blob_path):
+            _remove_blob(blob_path)
+
+    @staticmethod
+    def __get_placements(paths: List[str], blob_path: str) -> List[str]:
+        placements = []
+        for path in paths:
+            try:
+                if os.path.samefile(path, blob_path):
+                    placements.append(path)
+            except OSError:
+                pass
+        return placements
+
+    def gc(self, dry_run: bool = False):
+        """Removes the blobs that are no longer placed anywhere, and the references to paths that no longer point to their blob.
+        A blob is kept if one of its recorded paths still points to it, or if it changed in the last hour. The hardlinks of a blob are not counted,
+        as every placement shares them, and a hardlinked placement that was moved keeps its data when its blob is removed.
+        If dry_run is enabled, only prints what would be removed."""
+        refs: Dict[str, List[str]] = {}
+        for path, sha256_hash in self.__db.fetchall('SELECT path, SHA256 FROM refs'):
+            refs.setdefault(sha256_hash, []).append(path)
+        get_refs_sql = 'SELECT path FROM refs WHERE SHA256 = ?'
+
+        now = time.time()
+        stale_paths = []
+        kept = kept_bytes = removed = removed_bytes = 0
+        removed_hashes = []
+        blobs_dirpath = os.path.join(self.__dirpath, 'blobs')
+        for root, _, filenames in os.walk(blobs_dirpath):
+            for filename in filenames:
+                filepath = os.path.join(root, filename)
+                try:
+                    stat_result = os.stat(filepath)
+                except OSError:
+                    continue
+                # Temp files of blobs that were being added when a batch was interrupted.
+                if os.path.basename(root) == '.tmp':
+                    if now - stat_result.st_mtime > _GC_GRACE_SECONDS:
+                        if not dry_run:
+                            _remove_blob(filepath)
+                    continue
+
+                sha256_hash = filename.upper()
+                paths = refs.pop(sha256_hash, [])
+                placements = self.__get_placements(paths, filepath)
+                stale_paths.extend((path, sha256_hash)
+                                   for path in paths if path not in placements)
+                # The references are read again, in case a running batch placed the blob since they were first read.
+                if (len(placements) > 0 or now - stat_result.st_ctime < _GC_GRACE_SECONDS
+                        or len(self.__get_placements([path for (path,) in self.__db.fetchall(get_refs_sql, (sha256_hash,))], filepath)) > 0):
+                    kept += 1
+                    kept_bytes += stat_result.st_size
+                    continue
+
+                print_verbose(f'Orphaned blob: {filepath}')
+                removed += 1
+                removed_bytes += stat_result.st_size
+                removed_hashes.append((sha256_hash,))
+                if not dry_run:
+                    _remove_blob(filepath)
+
+        # References to blobs that no longer exist.
+        for sha256_hash, paths in refs.items():
+            stale_paths.extend((path, sha256_hash) for path in paths)
+        if not dry_run:
+            self.__db.executemany(
+                'DELETE FROM refs WHERE path = ? AND SHA256 = ?', stale_paths)
+            self.__db.executemany(
+                'DELETE FROM urls WHERE SHA256 = ?', removed_hashes)
+
+        removed_label = 'Orphaned blobs that would be removed' if dry_run else 'Orphaned blobs removed'
+        print_newlines(Styler.stylize(f"""Store garbage collection summary ({self.__dirpath}):
+                - Blobs kept: {kept} ({format_bytes(kept_bytes)})
+                - {removed_label}: {removed} ({format_bytes(removed_bytes)})
+                - Stale references {'to drop' if dry_run else 'dropped'}: {len(stale_paths)}""", color='success'))
@@ -0,0 +1,158 @@
+"""Measures the throughput of civitdl against a local fake CivitAI server (see fakecivitai.py), without network access or an api key.
+
+Every scenario runs civitdl in its own process, with its own config, cache and data directories, and reports
+models/s, MB/s of model files and images served, CPU time and peak RSS of that process.
+
+Scenarios:
+- small-loras        many small models with images
+- huge-checkpoints   a few large models
+- cache-hit-rerun    small-loras again into the same directory, where every model is already downloaded
+
+Linux and macOS only, as CPU time and peak RSS are read with os.wait4.
+
+Usage: python test/benchmark/batch.py [--scenario small-loras] [--latency 0.02] [--bandwidth 50M] [--error-rate 0.01] [-- <civitdl options>]
+"""
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from fakecivitai import FakeCivitAI, FakeCivitAIConfig, _MODEL_ID_OFFSET
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'src'))
+
+from helpers.options import parse_bytes  # nopep8
+
+_SRC_DIRPATH = os.path.join(os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'src')
+
+
+class _Scenario:
+    def __init__(self, name: str, models: int, model_size: int, images: int, image_size: int, rerun_of: str = None):
+        self.name = name
+        self.models = models
+        self.model_size = model_size
+        self.images = images
+        self.image_size = image_size
+        self.rerun_of = rerun_of
+        """Name of the scenario whose fake server, root directory and cache are reused."""
+
+
+def _get_scenarios(scale: float) -> List[_Scenario]:
+    small_loras = _Scenario('small-loras', models=max(1, int(200 * scale)), model_size=2 * 1024 * 1024,
+                            images=2, image_size=64 * 1024)
+    return [
+        small_loras,
+        _Scenario('huge-checkpoints', models=max(1, int(3 * scale)), model_size=512 * 1024 * 1024,
+                  images=1, image_size=256 * 1024),
+        _Scenario('cache-hit-rerun', models=small_loras.models, model_size=small_loras.model_size,
+                  images=small_loras.images, image_size=small_loras.image_size, rerun_of=small_loras.name)
+    ]
+
+
+def _get_failed_count(log_filepath: str) -> int:
+    with open(log_filepath, 'r', encoding='UTF-8') as log:
+        match = re.search(r'- Failed: (\d+)', log.read())
+    return int(match.group(1)) if match is not None else -1
+
+
+def _run_civitdl(args: List[str], env: Dict[str, str], log_filepath: str):
+    """Runs civitdl in a new process. Returns its exit code, wall time, CPU time and peak RSS in bytes."""
+    with open(log_filepath, 'w', encoding='UTF-8') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, '-c', 'from civitdl.__main__ import main; main()', *args],
+                                   env=env, stdout=log, stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak_rss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+    exit_code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    return exit_code, elapsed, rusage.ru_utime + rusage.ru_stime, peak_rss
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', type=str, action='append',
+                        help='Scenario to run, may be given more than once. Runs every scenario by default.')
+    parser.add_argument('--scale', type=float, default=1,
+                        help='Multiplies the number of models of every scenario.')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds the fake server waits before answering each request.')
+    parser.add_argument('--bandwidth', type=str, default='0',
+                        help='Bytes per second of each response from the fake server, 0 for unlimited.')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Fraction of requests answered with status code 500.')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the downloaded files and logs.')
+    parser.add_argument('civitdl_args', nargs='*',
+                        help='Extra options passed to civitdl, after "--". Defaults to "--max-concurrent-models 4".')
+    args = parser.parse_args()
+
+    scenarios = [scenario for scenario in _get_scenarios(args.scale)
+                 if args.scenario is None or scenario.name in args.scenario]
+    civitdl_args = args.civitdl_args or ['--max-concurrent-models', '4']
+    workdir = tempfile.mkdtemp(prefix='civitdl-benchmark-')
+    print(f'Working directory: {workdir}')
+
+    print(f'{"scenario":<20} {"models":>7} {"failed":>7} {"wall s":>8} {"models/s":>9} {"MB/s":>9} {"cpu s":>8} {"peak RSS MB":>12}  requests')
+    failed = False
+    fakes: Dict[str, FakeCivitAI] = {}
+    for scenario in scenarios:
+        # A rerun shares the fake server, root directory, config, cache and data directories of the scenario it reruns,
+        # so that the cached metadata points to the same urls.
+        if scenario.rerun_of in fakes:
+            fake = fakes[scenario.rerun_of]
+            fake.reset_stats()
+        else:
+            fake = FakeCivitAI(FakeCivitAIConfig(
+                models=scenario.models, model_size=scenario.model_size, images=scenario.images, image_size=scenario.image_size,
+                latency=args.latency, bandwidth=parse_bytes(args.bandwidth, 'bandwidth'), error_rate=args.error_rate)).start()
+        fakes[scenario.name] = fake
+
+        dirpath = os.path.join(workdir, scenario.rerun_of or scenario.name)
+        env = {**os.environ,
+               'PYTHONPATH': os.pathsep.join([_SRC_DIRPATH, os.environ.get('PYTHONPATH', '')]),
+               'CIVITDL_API_URL': fake.url,
+               'XDG_CONFIG_HOME': os.path.join(dirpath, 'config'),
+               'XDG_CACHE_HOME': os.path.join(dirpath, 'cache'),
+               'XDG_DATA_HOME': os.path.join(dirpath, 'data')}
+        sources = ','.join(str(_MODEL_ID_OFFSET + number)
+                           for number in range(1, scenario.models + 1))
+
+        # Hash the model files before starting the clock, as CivitAI has them precomputed.
+        for number in range(1, scenario.models + 1):
+            fake.get_version_dict(number)
+
+        log_filepath = os.path.join(workdir, f'{scenario.name}.log')
+        exit_code, elapsed, cpu_seconds, peak_rss = _run_civitdl(
+            [sources, os.path.join(dirpath, 'models'), '-k', 'benchmark', '--no-with-color', *civitdl_args],
+            env, log_filepath)
+        failed_count = _get_failed_count(log_filepath)
+
+        requests = ' '.join(f'{endpoint}={count}' for endpoint,
+                            count in sorted(fake.requests.items()))
+        print(f'{scenario.name:<20} {scenario.models:>7} {failed_count:>7} {elapsed:>8.2f} {scenario.models / elapsed:>9.2f} '
+              f'{fake.served_bytes / elapsed / 10**6:>9.2f} {cpu_seconds:>8.2f} {peak_rss / 10**6:>12.1f}  {requests}')
+        if exit_code != 0 or failed_count != 0:
+            failed = True
+            print(f'civitdl exited with code {exit_code}, see {log_filepath}')
+
+    for fake in set(fakes.values()):
+        fake.stop()
+
+    if args.keep or failed:
+        print(f'Files and logs kept in {workdir}')
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,373 @@
+"""Local stand-in for the parts of the CivitAI API used by civitdl, for benchmarks that must not depend on civitai.com.
+
+Serves:
+- /api/v1/models?ids=...   models in bulk, with pagination
+- /api/v1/models/<id>      a single model
+- /api/v1/model-versions/<id>
+- /api/download/models/<version id>   redirects to the model file, like the CivitAI download api
+- /files/<version id>/<name>          model files, with Content-Disposition and range requests
+- /images/<uuid>/width=<width>/<n>.jpeg   images, like the CivitAI image urls. Images are 512 pixels wide, and are served
+                                         smaller when requested at a smaller width
+
+Model <n> (1-based) has model id 100000 + n and version id 200000 + n. Every model file is unique, so the
+cache never matches one model with another, and its SHA256 hash is in the metadata as with CivitAI.
+
+Run on its own to try civitdl by hand:
+    python test/benchmark/fakecivitai.py --models 10 --model-size 4M
+    CIVITDL_API_URL=http://127.0.0.1:<port>/ civitdl 100001 100002 ./models -k fake
+"""
+import argparse
+import hashlib
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps
+from typing import Dict, Optional
+from urllib.parse import parse_qs, urlencode, urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'src'))
+
+from helpers.options import parse_bytes  # nopep8
+
+_MODEL_ID_OFFSET = 100000
+_VERSION_ID_OFFSET = 200000
+_MAX_PAGE_SIZE = 100
+_CHUNK_SIZE = 64 * 1024
+_RANGE_REGEX = re.compile(r'bytes=(?P<start>\d+)-(?P<end>\d*)')
+_IMAGE_WIDTH = 512
+
+# Model files are a header with the version id followed by this block repeated, so that they can be served
+# at any size without being kept in memory.
+_BLOCK = random.Random(0).getrandbits(8 * 1024 * 1024).to_bytes(1024 * 1024, 'little')
+
+
+def _get_image_uuid(version_id: int, image: int) -> str:
+    digest = hashlib.md5(f'{version_id}-{image}'.encode()).hexdigest()
+    return f'{digest[:8]}-{digest[8:12]}-{digest[12:16]}-{digest[16:20]}-{digest[20:]}'
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # civitdl closes connections early, e.g. when it already has the headers it needs.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeCivitAIConfig:
+    """Tunables of the fake server. Sizes are in bytes, latency in seconds and bandwidth in bytes per second per response (0 for unlimited)."""
+
+    def __init__(self, models: int = 100, model_size: int = 2 * 1024 * 1024, images: int = 2, image_size: int = 64 * 1024,
+                 latency: float = 0, bandwidth: int = 0, error_rate: float = 0):
+        self.models = models
+        self.model_size = model_size
+        self.images = images
+        self.image_size = image_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+
+
+class _ModelFile:
+    def __init__(self, version_id: int, size: int):
+        self.header = f'civitdl-benchmark-{version_id}\n'.encode()[:size]
+        self.size = size
+        self.__sha256 = None
+        self.__lock = threading.Lock()
+
+    def read(self, start: int, end: int):
+        """Yields the bytes from start to end (inclusive) in chunks."""
+        pos = start
+        while pos <= end:
+            if pos < len(self.header):
+                chunk = self.header[pos:min(end + 1, len(self.header))]
+            else:
+                offset = (pos - len(self.header)) % len(_BLOCK)
+                chunk = _BLOCK[offset:offset +
+                               min(_CHUNK_SIZE, end + 1 - pos, len(_BLOCK) - offset)]
+            yield chunk
+            pos += len(chunk)
+
+    @property
+    def sha256(self):
+        with self.__lock:
+            if self.__sha256 is None:
+                hasher = hashlib.sha256()
+                for chunk in self.read(0, self.size - 1):
+                    hasher.update(chunk)
+                self.__sha256 = hasher.hexdigest().upper()
+            return self.__sha256
+
+
+class FakeCivitAI:
+    """Runs the fake server in a background thread. Counts the requests and the bytes of model files and images it served."""
+    config: FakeCivitAIConfig
+    requests: Dict[str, int]
+    """Number of requests per endpoint."""
+    served_bytes: int
+
+    def __init__(self, config: FakeCivitAIConfig):
+        self.config = config
+        self.requests = {}
+        self.served_bytes = 0
+        self.__files: Dict[int, _ModelFile] = {}
+        self.__lock = threading.Lock()
+        self.__server = _Server(('127.0.0.1', 0), self.__create_handler())
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.__server.server_port}/'
+
+    def start(self):
+        threading.Thread(target=self.__server.serve_forever,
+                         daemon=True).start()
+        return self
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def reset_stats(self):
+        with self.__lock:
+            self.requests = {}
+            self.served_bytes = 0
+
+    def count(self, endpoint: str, served_bytes: int = 0):
+        with self.__lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.served_bytes += served_bytes
+
+    def get_file(self, version_id: int) -> _ModelFile:
+        with self.__lock:
+            if version_id not in self.__files:
+                self.__files[version_id] = _ModelFile(
+                    version_id, self.config.model_size)
+            return self.__files[version_id]
+
+    def get_number(self, id: str, offset: int) -> Optional[int]:
+        number = int(id) - offset if id.isdigit() else 0
+        return number if 1 <= number <= self.config.models else None
+
+    def get_version_dict(self, number: int, with_model: bool = False) -> Dict:
+        model_id, version_id = _MODEL_ID_OFFSET + number, _VERSION_ID_OFFSET + number
+        name = f'benchmark_model_{number}.safetensors'
+        download_url = f'{self.url}api/download/models/{version_id}'
+        version_dict = {
+            'id': version_id,
+            'modelId': model_id,
+            'name': f'v{number}',
+            'downloadUrl': download_url,
+            'files': [{
+                'name': name,
+                'sizeKB': self.config.model_size / 1024,
+                'type': 'Model',
+                'primary': True,
+                'downloadUrl': download_url,
+                'hashes': {'SHA256': self.get_file(version_id).sha256}
+            }],
+            'images': [{
+                'url': f'{self.url}images/{_get_image_uuid(version_id, image)}/width={_IMAGE_WIDTH}/{image}.jpeg',
+                'nsfwLevel': 1,
+                'width': _IMAGE_WIDTH,
+                'height': _IMAGE_WIDTH,
+                'meta': {'prompt': f'benchmark image {image}'}
+            } for image in range(self.config.images)]
+        }
+        if with_model:
+            version_dict['model'] = {'name': f'Benchmark Model {number}', 'type': 'LORA', 'nsfw': False}
+        return version_dict
+
+    def get_model_dict(self, number: int) -> Dict:
+        return {
+            'id': _MODEL_ID_OFFSET + number,
+            'name': f'Benchmark Model {number}',
+            'type': 'LORA',
+            'nsfw': False,
+            'nsfwLevel': 1,
+            'tags': ['benchmark'],
+            'creator': {'username': 'civitdl'},
+            'modelVersions': [self.get_version_dict(number)]
+        }
+
+    def __create_handler(self):
+        fake = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Small responses would otherwise wait on delayed ACKs of the client, which real servers do not.
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, data, status: int = 200):
+                body = dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_chunks(self, chunks):
+                """Writes chunks at the configured bandwidth. Returns the number of bytes written."""
+                written = 0
+                start = time.perf_counter()
+                for chunk in chunks:
+                    self.wfile.write(chunk)
+                    written += len(chunk)
+                    if fake.config.bandwidth > 0:
+                        delay = written / fake.config.bandwidth - \
+                            (time.perf_counter() - start)
+                        if delay > 0:
+                            time.sleep(delay)
+                return written
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                parts = [part for part in url.path.split('/') if part != '']
+
+                if fake.config.latency > 0:
+                    time.sleep(fake.config.latency)
+                if fake.config.error_rate > 0 and random.random() < fake.config.error_rate:
+                    fake.count('errors')
+                    return self.send_json({'error': 'Internal Server Error'}, 500)
+
+                try:
+                    if parts[:3] == ['api', 'v1', 'models'] and len(parts) == 3:
+                        self.get_models(query)
+                    elif parts[:3] == ['api', 'v1', 'models'] and len(parts) == 4:
+                        self.get_model(parts[3])
+                    elif parts[:3] == ['api', 'v1', 'model-versions'] and len(parts) == 4:
+                        self.get_version(parts[3])
+                    elif parts[:3] == ['api', 'download', 'models'] and len(parts) == 4:
+                        self.get_download(parts[3])
+                    elif parts[:1] == ['files'] and len(parts) == 3:
+                        self.get_file(parts[1])
+                    elif parts[:1] == ['images'] and len(parts) == 4:
+                        self.get_image(parts[2])
+                    else:
+                        self.send_json({'error': 'Not Found'}, 404)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def get_models(self, query):
+                fake.count('models')
+                ids = [id for value in query.get('ids', []) for id in value.split(',')]
+                numbers = [number for number in (fake.get_number(id, _MODEL_ID_OFFSET) for id in ids) if number is not None] \
+                    if len(ids) > 0 else list(range(1, fake.config.models + 1))
+                limit = min(int(query.get('limit', ['100'])[0]), _MAX_PAGE_SIZE)
+                page = int(query.get('page', ['1'])[0])
+
+                items = numbers[(page - 1) * limit:page * limit]
+                metadata = {'totalItems': len(numbers), 'currentPage': page,
+                            'pageSize': limit, 'totalPages': -(-len(numbers) // limit)}
+                if page * limit < len(numbers):
+                    metadata['nextPage'] = f'{fake.url}api/v1/models?' + urlencode(
+                        {**query, 'page': [str(page + 1)]}, doseq=True)
+                self.send_json({'items': [fake.get_model_dict(number) for number in items],
+                                'metadata': metadata})
+
+            def get_model(self, id: str):
+                fake.count('model')
+                number = fake.get_number(id, _MODEL_ID_OFFSET)
+                if number is None:
+                    return self.send_json({'error': 'No model with id'}, 404)
+                self.send_json(fake.get_model_dict(number))
+
+            def get_version(self, id: str):
+                fake.count('model-version')
+                number = fake.get_number(id, _VERSION_ID_OFFSET)
+                if number is None:
+                    return self.send_json({'error': 'No version with id'}, 404)
+                self.send_json(fake.get_version_dict(number, with_model=True))
+
+            def get_download(self, id: str):
+                fake.count('download')
+                number = fake.get_number(id, _VERSION_ID_OFFSET)
+                if number is None:
+                    return self.send_json({'error': 'No version with id'}, 404)
+                self.send_response(307)
+                self.send_header(
+                    'Location', f'{fake.url}files/{id}/benchmark_model_{number}.safetensors')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def get_file(self, id: str):
+                number = fake.get_number(id, _VERSION_ID_OFFSET)
+                if number is None:
+                    fake.count('file')
+                    return self.send_json({'error': 'Not Found'}, 404)
+                file = fake.get_file(int(id))
+                start, end = 0, file.size - 1
+
+                match = _RANGE_REGEX.fullmatch(self.headers.get('Range', ''))
+                if match is not None:
+                    start = int(match.group('start'))
+                    end = min(int(match.group('end')),
+                              end) if match.group('end') else end
+                    self.send_response(206)
+                    self.send_header(
+                        'Content-Range', f'bytes {start}-{end}/{file.size}')
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Length', str(end - start + 1))
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header(
+                    'Content-Disposition', f'attachment; filename="benchmark_model_{number}.safetensors"')
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('ETag', f'"{id}"')
+                self.end_headers()
+                fake.count('file', self.send_chunks(file.read(start, end)))
+
+            def get_image(self, transformations: str):
+                width = _IMAGE_WIDTH
+                for transformation in transformations.split(','):
+                    name, _, value = transformation.partition('=')
+                    if name == 'width' and value.isdigit():
+                        width = min(width, int(value))
+                # Images are served at image_size when full width, and scaled down with their area.
+                size = max(1, fake.config.image_size * width * width // _IMAGE_WIDTH ** 2)
+                self.send_response(200)
+                self.send_header('Content-Length', str(size))
+                self.send_header('Content-Type', 'image/jpeg')
+                self.end_headers()
+                fake.count('image', self.send_chunks(
+                    _BLOCK[i:i + min(_CHUNK_SIZE, size - i)] for i in range(0, size, _CHUNK_SIZE)))
+
+        return _Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--models', type=int, default=100)
+    parser.add_argument('--model-size', type=str, default='2M')
+    parser.add_argument('--images', type=int, default=2)
+    parser.add_argument('--image-size', type=str, default='64K')
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--bandwidth', type=str, default='0')
+    parser.add_argument('--error-rate', type=float, default=0)
+    args = parser.parse_args()
+
+    fake = FakeCivitAI(FakeCivitAIConfig(
+        models=args.models, model_size=parse_bytes(args.model_size, 'model_size'), images=args.images,
+        image_size=parse_bytes(args.image_size, 'image_size'), latency=args.latency,
+        bandwidth=parse_bytes(args.bandwidth, 'bandwidth'), error_rate=args.error_rate)).start()
+    print(f'Fake CivitAI server running at {fake.url}')
+    print(f'Models: {_MODEL_ID_OFFSET + 1} to {_MODEL_ID_OFFSET + args.models}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Measures the start up time of the civitdl, civitconfig and civitmisc commands that do not download anything, with python -X importtime.
+
+Every command runs in its own process, with its own config directory, and reports its wall time, the wall time of a bare
+python interpreter for comparison, and the total time spent importing modules that a bare interpreter does not import.
+A command fails the benchmark if it imports a module that is only needed to download models (see _SLOW_MODULES),
+or if its imports take longer than --budget.
+
+Usage: python test/benchmark/importtime.py [--runs 5] [--budget 100] [--show 10]
+"""
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Set, Tuple
+
+_SRC_DIRPATH = os.path.join(os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'src')
+
+_COMMANDS = [
+    ['civitdl', '--help'],
+    ['civitdl', '--version'],
+    ['civitconfig', '--help'],
+    ['civitconfig', 'default'],
+    ['civitconfig', 'sorter'],
+    ['civitmisc', '--help'],
+]
+
+# Modules that are only imported once a batch starts downloading, or when the version is printed.
+_SLOW_MODULES = ['requests', 'urllib3', 'tqdm', 'sqlite3', 'http.server',
+                 'civitdl.batch.batch_download', 'helpers.session', 'helpers.cache', 'helpers.store']
+_VERSION_MODULES = ['importlib.metadata']
+
+_IMPORT_TIME_REGEX = re.compile(
+    r'^import time:\s+(?P<self>\d+) \|\s+(?P<cumulative>\d+) \|(?P<indent>\s+)(?P<name>\S+)$')
+
+
+def _parse_importtime(stderr: str, ignored: Set[str] = set()) -> Tuple[float, Dict[str, float]]:
+    """Returns the total seconds spent importing modules that are not in ignored, and the cumulative seconds of every module by name."""
+    total = 0
+    modules = {}
+    for line in stderr.splitlines():
+        match = _IMPORT_TIME_REGEX.match(line)
+        if match is None:
+            continue
+        cumulative = int(match.group('cumulative')) / 10**6
+        modules[match.group('name')] = cumulative
+        # Modules imported at the top level include the time of the modules they import.
+        if len(match.group('indent')) == 1 and match.group('name') not in ignored:
+            total += cumulative
+    return total, modules
+
+
+def _run(args: List[str], env: Dict[str, str], with_importtime: bool = False) -> Tuple[float, str]:
+    """Runs python with args. Returns its wall time and stderr."""
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, *(['-X', 'importtime'] if with_importtime else []), *args],
+                             env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    return time.perf_counter() - start, process.stderr
+
+
+def _get_command_args(command: List[str]) -> List[str]:
+    return ['-c', f'import sys; sys.argv = {command!r}; from {command[0]}.__main__ import main; main()']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5,
+                        help='Runs of every command. The fastest run is reported.')
+    parser.add_argument('--budget', type=float, default=100,
+                        help='Milliseconds the imports of a command may take at most.')
+    parser.add_argument('--show', type=int, default=0,
+                        help='Also print the slowest N modules imported by each command.')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='civitdl-importtime-')
+    env = {**os.environ,
+           'PYTHONPATH': os.pathsep.join([_SRC_DIRPATH, os.environ.get('PYTHONPATH', '')]),
+           'XDG_CONFIG_HOME': os.path.join(workdir, 'config'),
+           'XDG_CACHE_HOME': os.path.join(workdir, 'cache'),
+           'XDG_DATA_HOME': os.path.join(workdir, 'data')}
+
+    bare = min(_run(['-c', 'pass'], env)[0] for _ in range(args.runs))
+    # Modules imported by the interpreter itself, such as site and what .pth files of installed packages import, are not counted.
+    _, bare_modules = _parse_importtime(
+        _run(['-c', 'pass'], env, with_importtime=True)[1])
+    print(f'Bare interpreter: {bare * 1000:.0f} ms, {len(bare_modules)} modules imported')
+    print(f'{"command":<22} {"wall ms":>8} {"imports ms":>11}  slow modules imported')
+
+    failed = False
+    for command in _COMMANDS:
+        command_args = _get_command_args(command)
+        # The first run creates the config, like the first run on a new machine.
+        _run(command_args, env)
+        wall = min(_run(command_args, env)[0] for _ in range(args.runs))
+        imports_total = None
+        for _ in range(args.runs):
+            total, modules = _parse_importtime(
+                _run(command_args, env, with_importtime=True)[1], set(bare_modules))
+            if imports_total is None or total < imports_total:
+                imports_total, imported = total, modules
+
+        imported = {name: seconds for name, seconds in imported.items()
+                    if name not in bare_modules}
+        slow_modules = [name for name in _SLOW_MODULES +
+                        (_VERSION_MODULES if '--version' not in command else []) if name in imported]
+        print(f'{" ".join(command):<22} {wall * 1000:>8.0f} {imports_total * 1000:>11.1f}  {", ".join(slow_modules) or "-"}')
+        for name, seconds in sorted(imported.items(), key=lambda item: -item[1])[:args.show]:
+            print(f'    {name:<40} {seconds * 1000:>8.1f} ms')
+
+        if len(slow_modules) > 0 or imports_total * 1000 > args.budget:
+            failed = True
+
+    shutil.rmtree(workdir, ignore_errors=True)
+    if failed:
+        print(f'Some commands import slow modules or take longer than {args.budget:.0f} ms to import.')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Measures how closely downloads throttled by helpers.core.ratelimiter follow the configured rates.
+
+Every scenario streams bytes from a local HTTP server through IOHelper.write_contents, the same path used for models and images,
+and compares the measured throughput with the expected one.
+
+Usage: python test/benchmark/ratelimiter.py [--seconds 10] [--rate 4M] [--tolerance 0.03]
+"""
+import argparse
+import concurrent.futures
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'src'))
+
+from helpers.core.iohelper import IOHelper  # nopep8
+from helpers.core.ratelimiter import RateLimiter, set_global_rate_limit  # nopep8
+from helpers.options import parse_bytes  # nopep8
+
+_CHUNK = b'\0' * (64 * 1024)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+        try:
+            while True:
+                self.wfile.write(_CHUNK)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class _CountingFile:
+    def __init__(self):
+        self.size = 0
+
+    def write(self, content):
+        self.size += len(content)
+
+
+def _stream(url: str, limiter: RateLimiter, seconds: float) -> int:
+    file = _CountingFile()
+    deadline = time.perf_counter() + seconds
+
+    def chunks(res):
+        for content in res.iter_content(16 * 1024):
+            yield content
+            if time.perf_counter() >= deadline:
+                return
+
+    with requests.get(url, stream=True) as res:
+        IOHelper.write_contents(file, chunks(res), limiter)
+    return file.size
+
+
+def _run(url: str, name: str, transfers: int, rate: int, global_rate: int, burst: int, expected: float, seconds: float, tolerance: float) -> bool:
+    set_global_rate_limit(global_rate, burst)
+    limiters = [RateLimiter(rate, burst) for _ in range(transfers)]
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=transfers) as executor:
+        total = sum(executor.map(
+            lambda limiter: _stream(url, limiter, seconds), limiters))
+    elapsed = time.perf_counter() - start
+
+    # The first burst of each bucket is free, so it is not part of the sustained rate.
+    free_bytes = min(
+        transfers * (burst or rate) if rate else float('inf'),
+        (burst or global_rate) if global_rate else float('inf'))
+    measured = (total - free_bytes) / elapsed
+    error = measured / expected - 1
+    passed = abs(error) <= tolerance
+    print(f'{name:<45} expected {expected / 10**6:8.3f} MB/s  measured {measured / 10**6:8.3f} MB/s  error {error * 100:+6.2f}%  {"ok" if passed else "FAIL"}')
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=10,
+                        help='Duration of each scenario.')
+    parser.add_argument('--rate', type=str, default='4M',
+                        help='Base rate used by the scenarios.')
+    parser.add_argument('--tolerance', type=float, default=0.03,
+                        help='Max relative error of the measured rate.')
+    args = parser.parse_args()
+    rate = parse_bytes(args.rate, 'rate')
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/'
+
+    scenarios = [
+        # name, transfers, per-transfer rate, global rate, burst, expected combined rate
+        ('1 transfer, per-transfer cap', 1, rate, 0, 0, rate),
+        ('4 transfers, per-transfer cap', 4, rate, 0, 0, 4 * rate),
+        ('4 transfers, global cap', 4, 0, rate, 0, rate),
+        ('8 transfers, global cap, burst', 8, 0, rate, rate * 2, rate),
+        ('4 transfers, both caps (global binds)', 4, rate // 2, rate, 0, rate),
+        ('4 transfers, both caps (per-transfer binds)',
+         4, rate // 8, rate, 0, rate // 2),
+    ]
+
+    results = [_run(url, *scenario, seconds=args.seconds, tolerance=args.tolerance)
+               for scenario in scenarios]
+    server.shutdown()
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Tests of the batch journal that do not need CivitAI.
+
+Usage: python test/journal.py
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from civitdl.batch._journal import Journal  # nopep8
+from helpers.sourcemanager import _Id  # nopep8
+
+
+def _get_open_filepaths():
+    """Returns the paths of the files this process has open, or None where /proc is not available."""
+    if not os.path.isdir('/proc/self/fd'):
+        return None
+    filepaths = set()
+    for fd in os.listdir('/proc/self/fd'):
+        try:
+            filepaths.add(os.readlink(os.path.join('/proc/self/fd', fd)))
+        except OSError:
+            pass
+    return filepaths
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp(prefix='civitdl-journal-')
+        self.filepath = os.path.join(self.dirpath, 'journal.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath, ignore_errors=True)
+
+    def test_discard_after_worker_threads(self):
+        journal = Journal.create(self.filepath, {'rootdir': self.dirpath})
+        entries = list(journal.track(
+            _Id(str(100000 + i), model_id=str(100000 + i)) for i in range(8)))
+
+        # Like the worker and prefetch threads of a batch, which keep their connection open once done.
+        done = threading.Barrier(len(entries) + 1)
+
+        def work(entry):
+            entry.set_state('metadata')
+            entry.set_state('done')
+            done.wait()
+
+        threads = [threading.Thread(target=work, args=(entry,))
+                   for entry in entries]
+        for thread in threads:
+            thread.start()
+        done.wait()
+        self.assertEqual(journal.count_states(), {'done': len(entries)})
+
+        journal.discard()
+        for thread in threads:
+            thread.join()
+
+        for filepath in (self.filepath, f'{self.filepath}-wal', f'{self.filepath}-shm'):
+            self.assertFalse(os.path.exists(filepath), filepath)
+        open_filepaths = _get_open_filepaths()
+        if open_filepaths is not None:
+            self.assertEqual([filepath for filepath in open_filepaths
+                              if filepath.startswith(self.filepath)], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+"""Tests of parsing sources and batchfiles.
+
+Usage: python test/sourcemanager.py
+"""
+import builtins
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from helpers.core.utils import InputException  # nopep8
+from helpers.sourcemanager import SourceManager  # nopep8
+
+
+class TestSourceManager(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp(prefix='civitdl-sources-')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath, ignore_errors=True)
+
+    def write_batchfile(self, filename: str, content: str) -> str:
+        filepath = os.path.join(self.dirpath, filename)
+        with open(filepath, 'w', encoding='UTF-8') as file:
+            file.write(content)
+        return filepath
+
+    def parse(self, sources):
+        return [(id.model_id, id.version_id) for id in SourceManager().parse_src_all(sources)]
+
+    def test_skips_duplicate_sources(self):
+        self.assertEqual(self.parse([
+            '123456',
+            'https://civitai.com/models/123456',
+            'https://civitai.com/models/123456?modelVersionId=789',
+            'https://civitai.com/api/download/models/789',
+            '654321'
+        ]), [('123456', None), ('123456', '789'), ('654321', None)])
+
+    def test_skips_duplicate_sources_across_batchfiles(self):
+        nested = self.write_batchfile('nested.txt', '1, 2,\n3')
+        batchfile = self.write_batchfile('batchfile.txt', f'2, {nested}, 4')
+
+        self.assertEqual(self.parse([batchfile, '1']), [
+            ('2', None), ('1', None), ('3', None), ('4', None)])
+
+    def test_skips_batchfile_that_includes_itself(self):
+        first = os.path.join(self.dirpath, 'first.txt')
+        second = self.write_batchfile('second.txt', f'2, {first}')
+        self.write_batchfile('first.txt', f'1, {second}, 3')
+
+        self.assertEqual(self.parse([first]), [
+            ('1', None), ('2', None), ('3', None)])
+
+    def test_reads_batchfile_included_twice_once(self):
+        shared = self.write_batchfile('shared.txt', '1, 2')
+        first = self.write_batchfile('first.txt', f'{shared}, 3')
+        second = self.write_batchfile('second.txt', f'{shared}, 4')
+
+        with mock.patch('builtins.open', wraps=builtins.open) as opened:
+            ids = self.parse([first, second])
+
+        self.assertEqual(ids, [('1', None), ('2', None),
+                         ('3', None), ('4', None)])
+        self.assertEqual([call.args[0] for call in opened.call_args_list].count(shared), 1)
+
+    def test_bad_source_in_batchfile(self):
+        batchfile = self.write_batchfile('batchfile.txt', '1, 2,\nnot-a-source')
+
+        with self.assertRaises(InputException):
+            SourceManager().parse_src_all([batchfile])
+
+
+if __name__ == '__main__':
+    unittest.main()
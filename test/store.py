@@ -0,0 +1,120 @@
+"""Tests of the content-addressed store of model files and images.
+
+Usage: python test/store.py
+"""
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import helpers.store  # nopep8
+from helpers.core.iohelper import IOHelper  # nopep8
+from helpers.store import Store  # nopep8
+
+_CONTENT = b'civitdl-store-test\n' * 1024
+_SHA256 = hashlib.sha256(_CONTENT).hexdigest().upper()
+
+
+class TestStore(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp(prefix='civitdl-store-')
+        self.store = Store(os.path.join(self.dirpath, 'store'))
+        self.filepath = self.write_model('a')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath, ignore_errors=True)
+
+    def write_model(self, rootdir: str) -> str:
+        filepath = os.path.join(self.dirpath, rootdir, 'model.safetensors')
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'wb') as file:
+            file.write(_CONTENT)
+        return filepath
+
+    def gc(self, dry_run=False):
+        # Blobs changed within the grace period are always kept, and every blob in these tests was just added.
+        with mock.patch.object(helpers.store, '_GC_GRACE_SECONDS', 0):
+            self.store.gc(dry_run=dry_run)
+
+    def read(self, filepath: str) -> bytes:
+        with open(filepath, 'rb') as file:
+            return file.read()
+
+    def test_add_and_place(self):
+        self.assertTrue(self.store.add(self.filepath, _SHA256))
+        self.assertFalse(self.store.add(self.filepath, _SHA256))
+        self.store.place(_SHA256, self.filepath)
+        placed_filepath = os.path.join(
+            self.dirpath, 'b', 'model.safetensors')
+        os.makedirs(os.path.dirname(placed_filepath))
+        self.store.place(_SHA256, placed_filepath)
+
+        blob_path = self.store.get_blob_path(_SHA256)
+        self.assertTrue(self.store.has(_SHA256))
+        self.assertEqual(self.read(blob_path), _CONTENT)
+        for filepath in (self.filepath, placed_filepath):
+            self.assertTrue(os.path.samefile(filepath, blob_path))
+            self.assertTrue(os.access(filepath, os.W_OK))
+
+    def test_overwrite_does_not_write_through_placement(self):
+        self.store.add(self.filepath, _SHA256)
+        self.store.place(_SHA256, self.filepath)
+
+        IOHelper.write_to_file(self.filepath, [b'new model'], mode='wb')
+
+        self.assertEqual(self.read(self.filepath), b'new model')
+        self.assertEqual(self.read(self.store.get_blob_path(_SHA256)), _CONTENT)
+
+    def test_gc_keeps_placed_blobs(self):
+        self.store.add(self.filepath, _SHA256)
+        self.store.place(_SHA256, self.filepath)
+
+        self.gc()
+
+        self.assertTrue(self.store.has(_SHA256))
+
+    def test_gc_removes_blobs_that_are_no_longer_placed(self):
+        self.store.add(self.filepath, _SHA256)
+        self.store.place(_SHA256, self.filepath)
+        os.remove(self.filepath)
+
+        self.gc(dry_run=True)
+        self.assertTrue(self.store.has(_SHA256))
+
+        self.gc()
+        self.assertFalse(self.store.has(_SHA256))
+
+    def test_gc_removes_blob_of_moved_placement(self):
+        self.store.add(self.filepath, _SHA256)
+        self.store.place(_SHA256, self.filepath)
+        moved_filepath = os.path.join(self.dirpath, 'a', 'moved.safetensors')
+        os.rename(self.filepath, moved_filepath)
+
+        self.gc()
+
+        # The hardlink of the moved model is not counted as a placement, and it keeps its data.
+        self.assertFalse(self.store.has(_SHA256))
+        self.assertEqual(self.read(moved_filepath), _CONTENT)
+
+    def test_gc_keeps_blob_placed_elsewhere(self):
+        self.store.add(self.filepath, _SHA256)
+        self.store.place(_SHA256, self.filepath)
+        placed_filepath = self.write_model('b')
+        self.store.place(_SHA256, placed_filepath)
+        os.remove(self.filepath)
+
+        self.gc()
+
+        self.assertTrue(self.store.has(_SHA256))
+        self.assertTrue(os.path.samefile(
+            placed_filepath, self.store.get_blob_path(_SHA256)))
+
+
+if __name__ == '__main__':
+    unittest.main()
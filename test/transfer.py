@@ -0,0 +1,130 @@
+"""Tests of model transfers against the fake CivitAI server, so they do not need CivitAI.
+
+Usage: python test/transfer.py
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))), 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), 'benchmark'))
+
+from civitdl.batch._transfer import Transfer  # nopep8
+from helpers.core.iohelper import IOHelper  # nopep8
+from helpers.core.utils import ResourcesException  # nopep8
+from fakecivitai import FakeCivitAI, FakeCivitAIConfig  # nopep8
+
+_VERSION_ID = 200001
+
+
+class _RecordingSession(requests.Session):
+    """Session that records the Range header of every request."""
+
+    def __init__(self):
+        super().__init__()
+        self.ranges = []
+
+    def request(self, method, url, *args, **kwargs):
+        self.ranges.append((kwargs.get('headers') or {}).get('Range'))
+        return super().request(method, url, *args, **kwargs)
+
+
+def _drop_after(res: requests.Response, max_bytes: int):
+    """Makes res fail once max_bytes of its body were read, like a dropped connection."""
+    iter_content = res.iter_content
+
+    def iter_content_until_dropped(chunk_size=1, decode_unicode=False):
+        read = 0
+        for chunk in iter_content(chunk_size, decode_unicode):
+            if read + len(chunk) > max_bytes:
+                raise requests.ConnectionError('Connection dropped.')
+            read += len(chunk)
+            yield chunk
+    res.iter_content = iter_content_until_dropped
+    return res
+
+
+class _FakeCivitAITestCase(unittest.TestCase):
+    model_size: int
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fake = FakeCivitAI(FakeCivitAIConfig(
+            models=1, model_size=cls.model_size)).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fake.stop()
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp(prefix='civitdl-transfer-')
+        self.filepath = os.path.join(self.dirpath, 'model.safetensors')
+        self.session = _RecordingSession()
+        self.url = f'{self.fake.url}api/download/models/{_VERSION_ID}'
+        self.sha256_hash = self.fake.get_file(_VERSION_ID).sha256
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.dirpath, ignore_errors=True)
+
+    def read_model_file(self):
+        return b''.join(self.fake.get_file(_VERSION_ID).read(0, self.model_size - 1))
+
+
+class TestTransfer(_FakeCivitAITestCase):
+    model_size = 4 * 1024 * 1024
+
+    def test_resume_after_partial_file(self):
+        with self.assertRaises(requests.ConnectionError):
+            Transfer(self.session, 0).write(self.filepath, _drop_after(
+                self.session.get(self.url, stream=True), self.model_size // 2))
+        temp_filepath = IOHelper.get_temp_filepath(self.filepath)
+        offset = os.path.getsize(temp_filepath)
+        self.assertGreater(offset, 0)
+        self.assertFalse(os.path.exists(self.filepath))
+
+        self.session.ranges.clear()
+        digest = Transfer(self.session, 0).write(self.filepath, self.session.get(
+            self.url, stream=True), sha256_hash=self.sha256_hash)
+
+        self.assertIn(f'bytes={offset}-', self.session.ranges)
+        self.assertEqual(digest, self.sha256_hash)
+        with open(self.filepath, 'rb') as file:
+            self.assertEqual(file.read(), self.read_model_file())
+        self.assertFalse(os.path.exists(os.path.dirname(temp_filepath)))
+
+
+class TestSegments(_FakeCivitAITestCase):
+    # Large enough for two segments.
+    model_size = 16 * 1024 * 1024
+
+    def test_assembles_segments(self):
+        digest = Transfer(self.session, 0, segments=2).write(self.filepath, self.session.get(
+            self.url, stream=True), sha256_hash=self.sha256_hash)
+
+        half = self.model_size // 2
+        self.assertIn(f'bytes=0-{half - 1}', self.session.ranges)
+        self.assertIn(f'bytes={half}-{self.model_size - 1}', self.session.ranges)
+        self.assertEqual(digest, self.sha256_hash)
+        with open(self.filepath, 'rb') as file:
+            self.assertEqual(file.read(), self.read_model_file())
+
+    def test_hash_mismatch(self):
+        with self.assertRaises(ResourcesException):
+            Transfer(self.session, 0, segments=2).write(self.filepath, self.session.get(
+                self.url, stream=True), sha256_hash='0' * 64)
+
+        self.assertIn(f'bytes=0-{self.model_size // 2 - 1}', self.session.ranges)
+        self.assertFalse(os.path.exists(self.filepath))
+        self.assertFalse(os.path.exists(
+            IOHelper.get_temp_filepath(self.filepath)))
+
+
+if __name__ == '__main__':
+    unittest.main()